@@ -0,0 +1,149 @@
+"""
+プロジェクト収益レポートのバッチ実行（Streamlit を読み込まない）
+仕訳帳 / 稼働コスト / 取引マスタのパスから Table view と同じ表を書き出す
+daily は一度だけ作り、--period ごとに月次展開して <out>/<開始>_<終了>/ に保存する
+
+  python batch.py --journal journal.csv [journal2.zip ...] --cost utilization.csv \
+                  --master transaction.csv --period 2024-01:2024-06 --period 2024-07:2024-12 \
+                  --out reports --format xlsx
+
+--engine duckdb / sqlite では入力をローカル DB に読み込み、daily / 月次展開 / 稼働率を SQL で集計する
+"""
+import sys, time, argparse
+from pathlib import Path
+import pandas as pd
+
+import pipeline as pl
+import exports, warehouse
+
+UTIL_TABLES = ("稼働時間", "稼働率")
+
+
+def parse_period(text: str, d_min, d_max):
+    """"開始:終了"（YYYY-MM-DD または YYYY-MM、片側省略可）→ (開始日, 終了日)"""
+    start, _, end = text.partition(":")
+    start = pd.Timestamp(start).date() if start else d_min.date()
+    if not end:
+        end = d_max.date()
+    elif len(end) == 7:                           # YYYY-MM → 月末
+        end = pd.Period(end, "M").end_time.date()
+    else:
+        end = pd.Timestamp(end).date()
+    return start, end
+
+
+def parse_filters(items) -> dict:
+    """["取引担当者=山田", "Industry=製造"] → {列: [値, ...]}"""
+    sel = {}
+    for item in items or []:
+        col, sep, val = item.partition("=")
+        if not sep:
+            raise ValueError(f"--filter は 列=値 の形式で指定してください: {item}")
+        sel.setdefault(col, []).append(val)
+    return sel
+
+
+def write_tables(tables: dict, out_dir: Path, fmt: str, encoding: str,
+                 book="プロジェクト収益") -> list:
+    """{表名: DataFrame} → out_dir に書き出したパス（xlsx は 1 ブック 1 表 1 シート）"""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    ext, _ = exports.EXPORT_FORMATS[fmt]
+    if fmt == "xlsx":
+        path = out_dir / f"{book}{ext}"
+        exports.write_export(tables, path, fmt)
+        return [path]
+    paths = []
+    for name, df in tables.items():
+        path = out_dir / f"{name}{ext}"
+        exports.write_export({name: df}, path, fmt, encoding)
+        paths.append(path)
+    return paths
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="仕訳帳 / 稼働コスト / 取引マスタから収益レポートを書き出す")
+    p.add_argument("--journal", nargs="+", required=True, type=Path,
+                   help="仕訳帳 CSV / ZIP（複数可、ZIP は全 CSV を結合）")
+    p.add_argument("--cost", type=Path, help="稼働コスト CSV（utilization）")
+    p.add_argument("--master", type=Path, help="取引マスタ CSV（transaction）")
+    p.add_argument("--id-map", type=Path, help=f"追加の DealID マッピング CSV（{pl.ID_MAP_PATH.name} に追加）")
+    p.add_argument("--period", action="append",
+                   help="集計期間 開始:終了（YYYY-MM-DD / YYYY-MM、繰り返し可。省略時は仕訳帳の全期間）")
+    p.add_argument("--id", default="", help="取引ID（部分一致）")
+    p.add_argument("--filter", action="append", metavar="列=値",
+                   help="取引担当者 / Industry / Industry詳細 の絞り込み（繰り返し可）")
+    p.add_argument("--util-start", default=pl.UTIL_START,
+                   help="稼働率の集計開始月 YYYY-MM（all で全期間）")
+    p.add_argument("--stream-mb", type=int,
+                   help="仕訳帳をストリーミング読込する（チャンクあたりのメモリ目安 MB）")
+    p.add_argument("--engine", choices=["pandas", *warehouse.ENGINES], default="pandas",
+                   help="集計エンジン（duckdb / sqlite は仕訳帳と稼働コストを DB に読み込んで SQL で集計）")
+    p.add_argument("--db", type=Path,
+                   help=f"SQL エンジンの DB ファイル（省略時は {warehouse.WAREHOUSE_DIR}/ledger.<engine>）")
+    p.add_argument("--out", type=Path, default=Path("reports"), help="出力先ディレクトリ")
+    p.add_argument("--format", choices=list(exports.EXPORT_FORMATS), default="csv")
+    p.add_argument("--encoding", choices=exports.CSV_ENCODINGS, default="utf-8-sig",
+                   help="CSV の文字コード")
+    return p
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    t0 = time.perf_counter()
+    # SQL エンジンでは同じ形の関数を Warehouse のメソッドに差し替える（稼働コストは DB 上の表名）
+    load_inputs, report_tables, build_utilization = \
+        pl.load_inputs, pl.report_tables, pl.build_utilization
+    try:
+        if args.engine != "pandas":
+            wh = warehouse.Warehouse(args.engine, args.db)
+            load_inputs, report_tables, build_utilization = \
+                wh.load_inputs, wh.report_tables, wh.build_utilization
+        id_map = pl.load_id_map()
+        if args.id_map:
+            id_map = pl.merge_id_maps(id_map, pl.read_id_map(args.id_map, args.id_map.name))
+        daily, d_min, d_max, df_cost_raw, unmatched = load_inputs(
+            args.journal, args.cost, args.master, id_map, args.stream_mb)
+        selections = parse_filters(args.filter)
+        periods = [parse_period(p, d_min, d_max) for p in args.period or [":"]]
+    except (ValueError, OSError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 2
+    print(f"daily : {len(daily):,} 件（{d_min:%Y-%m-%d} 〜 {d_max:%Y-%m-%d}）"
+          f" {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    if len(unmatched):
+        print("結合できなかった取引コード : " + " / ".join(
+            f"{k} {v:,} 件" for k, v in unmatched["区分"].value_counts(sort=False).items()),
+            file=sys.stderr)
+        for path in write_tables({"結合できなかった取引コード": unmatched}, args.out,
+                                 args.format, args.encoding, book="結合できなかった取引コード"):
+            print(path)
+
+    try:
+        for start, end in periods:
+            tables = report_tables(daily, start, end, args.id, selections)
+            for path in write_tables(tables, args.out / f"{start:%Y%m%d}_{end:%Y%m%d}",
+                                     args.format, args.encoding):
+                print(path)
+    except (ValueError, OSError) as e:
+        print(f"エラー: {e}", file=sys.stderr)
+        return 2
+
+    if df_cost_raw is not None:
+        util = build_utilization(df_cost_raw, None if args.util_start == "all" else args.util_start)
+        if util is None:
+            print("稼働コストに コンサル名 / 稼働時間 / 日付 列が無いため稼働率は出力しません。",
+                  file=sys.stderr)
+        else:
+            gaps = pl.holiday_gaps(util[3])
+            if gaps:
+                print(f"{pl.HOLIDAYS_PATH.name} に祝日が無い年の月 : " + " / ".join(gaps)
+                      + "（営業日数は土日のみを除いて計算）", file=sys.stderr)
+            for path in write_tables(dict(zip(UTIL_TABLES, util[:2])), args.out,
+                                     args.format, args.encoding, book="稼働率"):
+                print(path)
+    print(f"完了 {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
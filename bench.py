@@ -0,0 +1,304 @@
+"""
+パイプラインのベンチマーク（Streamlit を読み込まない）
+freee 仕訳帳（cp932）/ HubSpot 稼働コスト / 取引マスタの合成データを指定規模で生成し、
+ステージごとの所要時間とピークメモリを計測して JSON に保存する
+所要時間は tracemalloc を止めた状態で --timing-runs 回実行した最小値、ピークメモリは
+別にもう 1 回 tracemalloc 下で実行して測る（tracemalloc は全確保をフックし、所要時間を
+ステージごとに不均一に膨らませるため、同じ実行では測らない）
+--compare で以前の結果と比較し、所要時間の比（今回 / 前回）を表示する
+
+  python bench.py --rows 1000000 --deals 5000 --repeat 3
+  python bench.py --rows 1000000 --deals 5000 --compare bench_results/20240101-120000.json
+"""
+import os, sys, json, time, argparse, platform, subprocess, tempfile, tracemalloc
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+import pipeline as pl
+import warehouse
+
+BENCH_DIR = Path(__file__).with_name("bench_results")
+BENCH_START = np.datetime64("2023-01-01")
+TIMING_RUNS = 3                                # ステージごとの時間計測回数（最小値を採る）
+BENCH_DAYS = 900                               # 取引日の範囲（日数）
+SALES_SHARE, EXPENSE_SHARE = 0.4, 0.3          # 売上行 / 費用行の割合（残りは対象外の科目）
+OTHER_ACCOUNTS = ["通信費", "地代家賃", "消耗品費", "支払手数料"]
+OWNERS = ["佐藤", "鈴木", "高橋", "田中", None]
+INDUSTRIES = {"製造": ["自動車", "電機", "化学"], "金融": ["銀行", "保険", "証券"],
+              "流通": ["小売", "卸売"]}
+
+
+# ──────────────────────────────────────────────
+# 合成データ
+#   取引の一部は id_map.csv の RecordID を部門に使い、DealID 置換の経路も通す
+# ──────────────────────────────────────────────
+def deal_ids(n_deals: int, id_map: pd.Series, seed=0):
+    """(仕訳帳の部門コード, 稼働コスト / マスタ側の取引 ID) の組を n_deals 件"""
+    rng = np.random.default_rng(seed)
+    n_map = min(len(id_map), n_deals // 4)
+    synth = rng.choice(10**10, n_deals - n_map, replace=False) + 10**10
+    rec = np.concatenate([id_map.index[:n_map].to_numpy(dtype=object), synth.astype(str)])
+    deal = np.concatenate([id_map.iloc[:n_map].to_numpy(dtype=object), synth.astype(str)])
+    return rec, deal
+
+
+def gen_journal(n_rows: int, rec_ids, seed=0) -> pd.DataFrame:
+    """freee 仕訳帳（貸方 / 借方の各列、売上・外注費等・対象外の科目が混在）"""
+    rng = np.random.default_rng(seed)
+    kind = rng.random(n_rows)
+    sales, expense = kind < SALES_SHARE, (kind >= SALES_SHARE) & (kind < SALES_SHARE + EXPENSE_SHARE)
+    deal = rng.integers(0, len(rec_ids), n_rows)
+    code = np.asarray(rec_ids, dtype=object)[deal]
+    code[rng.random(n_rows) < 0.03] = ""                           # 部門なしの行
+    amount = rng.integers(1_000, 2_000_000, n_rows)
+    date = (BENCH_START + rng.integers(0, BENCH_DAYS, n_rows)).astype("datetime64[D]")
+    empty = np.full(n_rows, "", dtype=object)
+    exp_acc = np.array(pl.EXPENSE_TARGETS, dtype=object)[rng.integers(0, 3, n_rows)]
+    other_acc = np.array(OTHER_ACCOUNTS, dtype=object)[rng.integers(0, len(OTHER_ACCOUNTS), n_rows)]
+    partner = lambda prefix, n: (prefix + pd.Series(deal % n).astype(str)).to_numpy(dtype=object)
+    return pd.DataFrame({
+        "取引日": pd.DatetimeIndex(date).strftime("%Y/%m/%d"),
+        "伝票番号": np.arange(n_rows),
+        "借方勘定科目": np.where(sales, "売掛金", np.where(expense, exp_acc, other_acc)),
+        "借方部門": np.where(expense, code, empty),
+        "借方取引先名": np.where(expense, partner("外注", 200), empty),
+        "借方金額": amount,
+        "貸方勘定科目": np.where(sales, "売上高", "普通預金"),
+        "貸方部門": np.where(sales, code, empty),
+        "貸方取引先名": np.where(sales, partner("顧客", 500), empty),
+        "貸方金額": amount,
+        "摘要": "ベンチマーク",
+    })
+
+
+def gen_utilization(n_rows: int, deal, n_consultants: int, seed=0) -> pd.DataFrame:
+    """HubSpot「UP社員/アサイン履歴」レポート（稼働時間は "8h" 等の表記ゆれを含む）"""
+    rng = np.random.default_rng(seed + 1)
+    hours = np.round(rng.uniform(1, 160, n_rows) * 2) / 2
+    hours_s = hours.astype(str).astype(object)
+    suffix = rng.random(n_rows) < 0.1
+    hours_s[suffix] = [f"{h:g}h" for h in hours[suffix]]
+    month = BENCH_START.astype("datetime64[M]") + rng.integers(0, BENCH_DAYS // 30, n_rows)
+    return pd.DataFrame({
+        "取引ID": np.asarray(deal, dtype=object)[rng.integers(0, len(deal), n_rows)],
+        "稼働コスト": rng.integers(10_000, 900_000, n_rows),
+        "会社名": "顧客" + pd.Series(rng.integers(0, 500, n_rows)).astype(str),
+        "コンサルタント名": "コンサル" + pd.Series(rng.integers(0, n_consultants, n_rows)).astype(str),
+        "稼働時間": hours_s,
+        "稼働月 - 月次": pd.DatetimeIndex(month.astype("datetime64[D]")).strftime("%Y-%m-%d"),
+        "アサイン履歴名": "A" + pd.Series(np.arange(n_rows)).astype(str),
+    })
+
+
+def gen_master(deal, seed=0) -> pd.DataFrame:
+    """HubSpot 取引エクスポート（取引の 8 割を収録）"""
+    rng = np.random.default_rng(seed + 2)
+    ids = np.asarray(deal, dtype=object)[rng.random(len(deal)) < 0.8]
+    ind = np.array(list(INDUSTRIES), dtype=object)[rng.integers(0, len(INDUSTRIES), len(ids))]
+    return pd.DataFrame({
+        "レコード ID": ids,
+        "取引名": "案件" + pd.Series(ids, dtype=str),
+        "金額": rng.integers(0, 9_000_000, len(ids)),
+        "取引担当者": np.array(OWNERS, dtype=object)[rng.integers(0, len(OWNERS), len(ids))],
+        "Industry": ind,
+        "Industry詳細": [INDUSTRIES[i][k % len(INDUSTRIES[i])]
+                         for i, k in zip(ind, rng.integers(0, 3, len(ids)))],
+        "提案商材": "DX",
+        "会社名": "顧客" + pd.Series(rng.integers(0, 500, len(ids))).astype(str),
+    })
+
+
+def write_inputs(out_dir: Path, rows, deals, cost_rows, consultants, seed=0) -> dict:
+    """合成データを CSV で書き出す → {"journal", "cost", "master": パス}"""
+    id_map = pl.load_id_map()
+    rec, deal = deal_ids(deals, id_map, seed)
+    paths = {k: out_dir / f"{k}.csv" for k in ("journal", "cost", "master")}
+    gen_journal(rows, rec, seed).to_csv(paths["journal"], index=False, encoding="cp932")
+    gen_utilization(cost_rows, deal, consultants, seed).to_csv(paths["cost"], index=False,
+                                                               encoding="utf-8-sig")
+    gen_master(deal, seed).to_csv(paths["master"], index=False, encoding="utf-8-sig")
+    return paths
+
+
+# ──────────────────────────────────────────────
+# 計測
+# ──────────────────────────────────────────────
+def _fresh(args):
+    """DataFrame の引数は実行ごとにコピーする（prepare_* / compute_metrics は引数を書き換える）"""
+    return [a.copy() if isinstance(a, pd.DataFrame) else a for a in args]
+
+
+def measure(fn, *args, runs=TIMING_RUNS):
+    """
+    fn(*args) → (戻り値, 秒, ピークメモリ MB)
+    秒は tracemalloc なしで runs 回実行した最小値、ピークメモリはもう 1 回 tracemalloc 下で実行して測る
+    """
+    sec = float("inf")
+    for _ in range(max(runs, 1)):
+        a = _fresh(args)
+        t0 = time.perf_counter()
+        res = fn(*a)
+        sec = min(sec, time.perf_counter() - t0)
+    a = _fresh(args)
+    tracemalloc.start()
+    try:
+        fn(*a)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return res, sec, peak / 2**20
+
+
+def monthly(daily: pd.DataFrame, start, end, expand=pl.expand_monthly):
+    """月次展開 + 月次サマリー（monthly_stage と同じ処理）"""
+    df_sales_p, df_profit_p, count_series, time_cols = expand(daily, start, end)
+    return [pl.monthly_summary(df, time_cols, ["合計", "平均"]) for df in (df_sales_p, df_profit_p)]
+
+
+def run_stages(paths: dict, engine=None, timing_runs=TIMING_RUNS) -> list:
+    """
+    1 回分のステージ計測 → [(ステージ名, 秒, ピーク MB), ...]（前段の出力を次段に渡す）
+    各ステージの秒は timing_runs 回の最小値（measure）
+    engine（duckdb / sqlite）を渡すと SQL バックエンドの <engine>_* ステージも計測する
+    （ピークメモリは Python 側の確保のみで、DB エンジン内部のメモリは含まない）
+    """
+    out = []
+
+    def stage(name, fn, *args):
+        res, sec, peak = measure(fn, *args, runs=timing_runs)
+        out.append((name, sec, peak))
+        return res
+
+    read = lambda p, schema: pl.read_csv_bytes(p, p.name, schema=schema)
+    id_map = pl.load_id_map()
+    df_src = stage("load_journal", read, paths["journal"], pl.JOURNAL_SCHEMA)
+    df_cost = stage("load_cost", read, paths["cost"], pl.COST_SCHEMA)
+    df_master = stage("load_master", read, paths["master"], pl.MASTER_SCHEMA)
+    df_src = stage("remap", pl.prepare_journal, df_src, id_map)
+    df_cost = pl.prepare_cost(df_cost)
+    agg = stage("pivot", pl.aggregate_journal, df_src)
+    cost_info = stage("cost_info", pl.build_cost_info, df_cost)
+    master_map = stage("master_map", lambda d: pl.build_master_map(pl.prepare_master(d)), df_master)
+    merged = stage("join", lambda *a: pl.join_deals(*a)[0], agg, cost_info, master_map)
+    daily = stage("metrics", pl.compute_metrics, merged)
+    start, end = df_src["取引日"].min(), df_src["取引日"].max()
+    index = stage("filter_index", pl.build_filter_index, daily)
+    mask = stage("filter", pl.filter_mask, index, "", start, end, {})
+    stage("monthly", monthly, daily[mask], start, end)
+    stage("utilization", pl.build_utilization, df_cost, None)
+
+    if engine:
+        wh = warehouse.Warehouse(engine, paths["journal"].with_name(f"bench.{engine}"))
+        try:
+            stage(f"{engine}_load", lambda: (
+                wh.load_journal(pl.path_items([paths["journal"]]), id_map),
+                wh.load_cost(pl.path_items([paths["cost"]])),
+                wh.load_master(master_map)))
+            sql_daily = stage(f"{engine}_daily", lambda: wh.daily_tables()[0])
+            stage(f"{engine}_monthly", monthly, sql_daily, start, end, wh.expand_monthly)
+            stage(f"{engine}_utilization", wh.build_utilization, "稼働", None)
+        finally:
+            wh.close()
+    return out
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(runs: list) -> dict:
+    """繰り返し計測 → {ステージ名: {"seconds"（中央値）, "min", "peak_mb"（最大）, "runs"}}"""
+    stages = {}
+    for run in runs:
+        for name, sec, peak in run:
+            s = stages.setdefault(name, {"runs": [], "peak_mb": 0.0})
+            s["runs"].append(round(sec, 6))
+            s["peak_mb"] = round(max(s["peak_mb"], peak), 2)
+    for s in stages.values():
+        s["seconds"], s["min"] = float(np.median(s["runs"])), min(s["runs"])
+    return stages
+
+
+def compare(result: dict, prev: dict):
+    """前回の結果との比較表（比 > 1 は遅くなった）"""
+    rows = []
+    for name, s in result["stages"].items():
+        p = prev.get("stages", {}).get(name)
+        ratio = s["seconds"] / p["seconds"] if p and p["seconds"] else None
+        rows.append({"stage": name, "seconds": s["seconds"], "prev": p and p["seconds"],
+                     "ratio": ratio, "peak_mb": s["peak_mb"], "prev_peak_mb": p and p["peak_mb"]})
+    return pd.DataFrame(rows)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description="合成データでパイプラインの各ステージを計測する")
+    p.add_argument("--rows", type=int, default=200_000, help="仕訳帳の行数")
+    p.add_argument("--deals", type=int, default=2_000, help="取引数")
+    p.add_argument("--cost-rows", type=int, default=50_000, help="稼働コストの行数")
+    p.add_argument("--consultants", type=int, default=100, help="コンサル人数")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--repeat", type=int, default=3, help="計測回数（所要時間は中央値）")
+    p.add_argument("--timing-runs", type=int, default=TIMING_RUNS,
+                   help="1 回の計測でステージを時間計測する回数（最小値を採る。ピークメモリは別の 1 回）")
+    p.add_argument("--data-dir", type=Path, help="合成データの保存先（省略時は一時ディレクトリ）")
+    p.add_argument("--out", type=Path, help=f"結果 JSON（省略時は {BENCH_DIR.name}/<日時>.json）")
+    p.add_argument("--compare", type=Path, help="比較する以前の結果 JSON")
+    p.add_argument("--engine", choices=warehouse.ENGINES,
+                   help="SQL バックエンドのステージも計測する（DB は合成データと同じ場所）")
+    return p
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    scale = {k: getattr(args, k) for k in ("rows", "deals", "cost_rows", "consultants", "seed")}
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or Path(tmp)
+        data_dir.mkdir(parents=True, exist_ok=True)
+        t0 = time.perf_counter()
+        paths = write_inputs(data_dir, args.rows, args.deals, args.cost_rows,
+                             args.consultants, args.seed)
+        print(f"合成データ生成 {time.perf_counter() - t0:.1f}s : "
+              + " / ".join(f"{k} {p.stat().st_size / 2**20:.1f}MB" for k, p in paths.items()),
+              file=sys.stderr)
+        try:
+            runs = [run_stages(paths, args.engine, args.timing_runs)
+                    for _ in range(max(args.repeat, 1))]
+        except ValueError as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            return 2
+
+    result = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "scale": scale, "repeat": len(runs), "timing_runs": max(args.timing_runs, 1),
+        "env": {"python": platform.python_version(), "pandas": pd.__version__,
+                "numpy": np.__version__, "platform": platform.platform(),
+                "cpus": os.cpu_count()},
+        "stages": summarize(runs),
+    }
+    result["total_seconds"] = sum(s["seconds"] for s in result["stages"].values())
+    out = args.out or BENCH_DIR / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.compare:
+        prev = json.loads(args.compare.read_text(encoding="utf-8"))
+        if prev.get("scale") != scale:
+            print(f"注意: 規模が前回と異なります（前回 {prev.get('scale')}）", file=sys.stderr)
+        print(compare(result, prev).to_string(index=False, float_format="{:.3f}".format))
+    else:
+        print(pd.DataFrame([{"stage": k, "seconds": s["seconds"], "peak_mb": s["peak_mb"]}
+                            for k, s in result["stages"].items()])
+              .to_string(index=False, float_format="{:.3f}".format))
+    print(out)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
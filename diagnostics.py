@@ -0,0 +1,124 @@
+"""
+ステージ計測（所要時間 / 行数 / キャッシュ命中 / メモリ増減）
+スクリプトの 1 回の実行ごとに Trace を作り、span で囲んだ区間を入れ子のまま記録する
+記録は実行の終わりに JSON Lines で CACHE_DIR/logs に追記する（Streamlit 非依存）
+"""
+import os, json, time, uuid, threading, tracemalloc, contextlib
+import pandas as pd
+
+from pipeline import CACHE_DIR
+
+LOG_DIR       = CACHE_DIR / "logs"
+LOG_PATH      = LOG_DIR / "stages.jsonl"
+LOG_MAX_BYTES = 10 * 1024**2      # 超えたら .1 に退避して書き直す
+
+_local = threading.local()        # 実行スレッドごとの Trace
+_tracing = {"users": 0}           # tracemalloc を使っている Trace の数
+_lock = threading.Lock()
+
+
+class Trace:
+    """1 回の実行の計測記録（records は区間の開始順）"""
+
+    def __init__(self, session=None, memory=False):
+        self.run, self.session = uuid.uuid4().hex[:12], session
+        self.started, self.records, self.stack = time.time(), [], []
+        self.memory = memory
+        self.on_span = None           # 区間の開始ごとに on_span(stage) を呼ぶ（ジョブの進捗 / 取消確認）
+        if memory:
+            with _lock:
+                if _tracing["users"] == 0 and not tracemalloc.is_tracing():
+                    tracemalloc.start()
+                _tracing["users"] += 1
+
+    def close(self):
+        if self.memory:
+            with _lock:
+                _tracing["users"] -= 1
+                if _tracing["users"] == 0:
+                    tracemalloc.stop()
+            self.memory = False
+
+
+def begin(session=None, memory=False) -> Trace:
+    """このスレッドの計測を開始（前回の Trace は閉じる）"""
+    prev = current()
+    if prev is not None:
+        prev.close()
+    _local.trace = Trace(session, memory)
+    return _local.trace
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+def count_rows(obj):
+    """結果の行数（先頭の DataFrame / Series、無ければ None）"""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj)
+    if isinstance(obj, (tuple, list)):
+        return next((n for n in map(count_rows, obj) if n is not None), None)
+    return None
+
+
+@contextlib.contextmanager
+def span(stage: str, **info):
+    """区間の計測（yield した dict に rows 等を書き足せる）。計測中でなければ何もしない"""
+    tr = current()
+    rec = {"stage": stage, **info}
+    if tr is None:
+        yield rec
+        return
+    if tr.on_span is not None:
+        tr.on_span(stage)
+    rec["depth"] = len(tr.stack)
+    tr.records.append(rec)
+    tr.stack.append(rec)
+    mem0 = tracemalloc.get_traced_memory()[0] if tr.memory else None
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        rec["ms"] = round((time.perf_counter() - t0) * 1000, 3)
+        if mem0 is not None:
+            rec["mem_delta"] = tracemalloc.get_traced_memory()[0] - mem0
+        tr.stack.pop()
+
+
+def mark_miss():
+    """実行中の区間をキャッシュ未命中にする（キャッシュ済み関数の本体から呼ぶ）"""
+    tr = current()
+    if tr is not None and tr.stack:
+        tr.stack[-1]["cache"] = "miss"
+
+
+def record(stage: str, ms: float, **info):
+    """計測済みの区間を追加（描画時間など）"""
+    tr = current()
+    if tr is not None:
+        tr.records.append({"stage": stage, "depth": len(tr.stack), "ms": round(ms, 3), **info})
+
+
+def summary(tr: Trace) -> pd.DataFrame:
+    """記録 → 表示用の表（入れ子は字下げ）"""
+    df = pd.DataFrame(tr.records)
+    if df.empty:
+        return df
+    df.insert(0, "ステージ", ["　" * d + s for d, s in zip(df.pop("depth"), df.pop("stage"))])
+    first = [c for c in ["ステージ", "ms", "rows", "cache", "mem_delta"] if c in df.columns]
+    return df[first + [c for c in df.columns if c not in first]]
+
+
+def write_log(tr: Trace, path=LOG_PATH, max_bytes=LOG_MAX_BYTES):
+    """記録を 1 区間 1 行の JSON で追記（実行 ID / セッション / 時刻付き）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        if path.stat().st_size > max_bytes:
+            os.replace(path, path.with_suffix(".jsonl.1"))
+    except OSError:
+        pass
+    head = {"run": tr.run, "session": tr.session, "ts": round(tr.started, 3)}
+    with open(path, "a", encoding="utf-8") as fp:
+        for rec in tr.records:
+            fp.write(json.dumps({**head, **rec}, ensure_ascii=False, default=str) + "\n")
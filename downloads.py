@@ -0,0 +1,145 @@
+"""
+Google Drive 共有リンクのダウンロードキャッシュ
+Drive のファイル ID（ID が取れない URL は URL のハッシュ）をキーに保存し、
+DOWNLOAD_TTL 以内は通信せずに再利用、それ以降は ETag / Last-Modified で更新を確認して
+変わっていなければ再ダウンロードしない。途中で切れたダウンロードは続きから再開する
+"""
+import os, re, json, time, hashlib
+from email.utils import formatdate
+import requests
+import gdown
+
+from pipeline import CACHE_DIR
+
+DOWNLOAD_DIR       = CACHE_DIR / "downloads"
+DOWNLOAD_MAX_BYTES = 4 * 1024**3          # 合計サイズ上限
+DOWNLOAD_MAX_AGE   = 14 * 24 * 60 * 60    # 最終利用からの秒数
+DOWNLOAD_TTL       = 10 * 60              # 更新確認を省略する秒数
+DOWNLOAD_TIMEOUT   = 30                   # 接続 / 受信待ちの秒数
+DRIVE_DOWNLOAD_URL = "https://drive.google.com/uc?export=download&id={id}"
+CHUNK_BYTES        = 64 * 1024
+
+
+def drive_file_id(url: str):
+    """共有リンク（/file/d/<ID>/… または ?id=<ID>）→ Drive のファイル ID（無ければ None）"""
+    m = re.search(r"/d/([\w-]{10,})", url) or re.search(r"[?&]id=([\w-]{10,})", url)
+    return m.group(1) if m else None
+
+
+def _paths(key: str):
+    base = DOWNLOAD_DIR / key
+    return base.with_suffix(".bin"), base.with_suffix(".part"), base.with_suffix(".json")
+
+
+def _read_meta(path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def _write_meta(path, meta):
+    tmp = path.with_suffix(".json.tmp")
+    tmp.write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _sha1(path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(CHUNK_BYTES), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def fetch(url: str, ttl=DOWNLOAD_TTL, timeout=DOWNLOAD_TIMEOUT) -> dict:
+    """
+    共有リンク → キャッシュ済みファイルのメタ情報
+    {"path", "sha1", "size", "etag", "last_modified", "checked", "downloaded", ...}
+    確認に失敗してもキャッシュがあればそれを返す（"stale": True）
+    """
+    file_id = drive_file_id(url)
+    key = file_id or hashlib.sha1(url.encode()).hexdigest()
+    data_p, part_p, meta_p = _paths(key)
+    meta = _read_meta(meta_p) or {}
+    cached = data_p.exists() and "sha1" in meta
+    if cached and time.time() - meta["checked"] < ttl:
+        os.utime(data_p)
+        return {**meta, "path": data_p, "downloaded": False}
+
+    DOWNLOAD_DIR.mkdir(parents=True, exist_ok=True)
+    headers, resume = {}, part_p.exists() and meta.get("partial")
+    if resume:                                    # 前回の続き（版が変わっていれば全体を再取得）
+        headers = {"Range": f"bytes={part_p.stat().st_size}-", "If-Range": meta["partial"]}
+    elif cached:                                  # 条件付き GET（未更新なら 304）
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    try:
+        with requests.get(DRIVE_DOWNLOAD_URL.format(id=file_id) if file_id else url,
+                          headers=headers, stream=True, timeout=timeout) as res:
+            if res.status_code == 304 and cached:
+                meta["checked"] = time.time()
+                _write_meta(meta_p, meta)
+                os.utime(data_p)
+                return {**meta, "path": data_p, "downloaded": False}
+            res.raise_for_status()
+            etag, modified = res.headers.get("ETag"), res.headers.get("Last-Modified")
+            if file_id and res.headers.get("Content-Type", "").startswith("text/html"):
+                # 大きなファイルは確認ページが返る → gdown に任せる
+                res.close()
+                gdown.download(url=url, output=str(part_p), quiet=True, fuzzy=True)
+                etag, modified = None, formatdate(part_p.stat().st_mtime, usegmt=True)
+            else:
+                _write_meta(meta_p, {**meta, "partial": etag or modified})
+                with open(part_p, "ab" if res.status_code == 206 else "wb") as fp:
+                    for block in res.iter_content(CHUNK_BYTES):
+                        fp.write(block)
+    except (requests.RequestException, OSError, gdown.exceptions.FileURLRetrievalError):
+        if cached:
+            return {**meta, "path": data_p, "downloaded": False, "stale": True}
+        raise
+
+    os.replace(part_p, data_p)
+    meta = {"url": url, "file_id": file_id, "key": key, "etag": etag,
+            "last_modified": modified, "size": data_p.stat().st_size,
+            "sha1": _sha1(data_p), "checked": time.time()}
+    _write_meta(meta_p, meta)
+    evict_downloads()
+    return {**meta, "path": data_p, "downloaded": True}
+
+
+def list_downloads() -> list:
+    """キャッシュ済みファイル（最近使った順）"""
+    items = []
+    for meta_p in DOWNLOAD_DIR.glob("*.json"):
+        meta, data_p = _read_meta(meta_p), meta_p.with_suffix(".bin")
+        try:
+            st_ = data_p.stat()
+        except OSError:
+            continue
+        if meta and "sha1" in meta:
+            items.append({**meta, "path": data_p, "used": st_.st_mtime})
+    return sorted(items, key=lambda m: m["used"], reverse=True)
+
+
+def evict_downloads(max_bytes=DOWNLOAD_MAX_BYTES, max_age=DOWNLOAD_MAX_AGE):
+    """
+    経過日数超過 → 合計サイズ超過の順で、最終利用が古いものから削除
+    中断したまま放置された .part / 書きかけのメタ情報も経過日数で削除する
+    """
+    now, total = time.time(), 0
+    for meta in list_downloads():
+        total += meta["size"]
+        if now - meta["used"] > max_age or total > max_bytes:
+            for p in _paths(meta["key"]):
+                p.unlink(missing_ok=True)
+            total -= meta["size"]
+    for p in [*DOWNLOAD_DIR.glob("*.part"), *DOWNLOAD_DIR.glob("*.tmp")]:
+        try:
+            if now - p.stat().st_mtime > max_age:
+                p.unlink()
+        except OSError:
+            continue
@@ -0,0 +1,77 @@
+"""
+ダウンロード用エクスポート（CSV / Parquet / Excel）
+内容ハッシュ + 形式 + 文字コードをキーに CACHE_DIR/exports へ書き出し、
+同じデータの再ダウンロードでは書き出し済みのファイルを返す
+CSV はチャンクごとに書き出すため、大きな表でも全体の文字列を作らない
+"""
+import os, time, hashlib
+import pandas as pd
+
+from pipeline import CACHE_DIR
+from snapshots import frame_digest
+
+EXPORT_DIR        = CACHE_DIR / "exports"
+EXPORT_MAX_AGE    = 24 * 60 * 60       # 最終利用からの秒数
+EXPORT_CHUNK_ROWS = 50_000             # CSV 書き出しの 1 チャンク行数
+EXPORT_FORMATS = {                     # 形式 → (拡張子, MIME)
+    "csv":     (".csv", "text/csv"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "xlsx":    (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+CSV_ENCODINGS = ["utf-8-sig", "cp932"]  # Excel で開くなら utf-8-sig、旧システム取込は cp932
+
+
+def iter_csv(df: pd.DataFrame, encoding="utf-8-sig", chunk_rows=EXPORT_CHUNK_ROWS):
+    """CSV をチャンク単位のバイト列で返す（BOM は先頭チャンクのみ、変換できない文字は ?）"""
+    for i in range(0, max(len(df), 1), chunk_rows):
+        text = df.iloc[i:i + chunk_rows].to_csv(index=False, header=(i == 0))
+        yield text.encode(encoding if i == 0 else encoding.replace("-sig", ""), errors="replace")
+
+
+def export_key(frames: dict, fmt: str, encoding=None) -> str:
+    parts = [fmt, encoding or ""] + [f"{n}:{frame_digest(df)}" for n, df in frames.items()]
+    return hashlib.sha1("/".join(parts).encode()).hexdigest()
+
+
+def export_file(frames: dict, fmt: str = "csv", encoding="utf-8-sig"):
+    """
+    {シート名: DataFrame} → 書き出し済みファイルのパス
+    csv / parquet は先頭の 1 表のみ、xlsx は 1 表 1 シート
+    """
+    ext, _ = EXPORT_FORMATS[fmt]
+    path = EXPORT_DIR / f"{export_key(frames, fmt, encoding if fmt == 'csv' else None)}{ext}"
+    if path.exists():
+        os.utime(path)
+        return path
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    write_export(frames, path, fmt, encoding)
+    evict_exports()
+    return path
+
+
+def write_export(frames: dict, path, fmt: str = "csv", encoding="utf-8-sig"):
+    """frames を path に書き出す（一時ファイルに書いてから置き換える）"""
+    tmp = path.with_suffix(".tmp")
+    df = next(iter(frames.values()))
+    if fmt == "csv":
+        with open(tmp, "wb") as fp:
+            for block in iter_csv(df, encoding):
+                fp.write(block)
+    elif fmt == "parquet":
+        df.to_parquet(tmp, index=False)
+    else:
+        with pd.ExcelWriter(tmp, engine="openpyxl") as xw:
+            for name, sheet in frames.items():
+                sheet.to_excel(xw, sheet_name=name[:31], index=False)
+    os.replace(tmp, path)
+
+
+def evict_exports(max_age=EXPORT_MAX_AGE):
+    """最終利用から max_age を過ぎた書き出し済みファイルを削除"""
+    now = time.time()
+    for p in EXPORT_DIR.glob("*"):
+        try:
+            if now - p.stat().st_mtime > max_age:
+                p.unlink()
+        except OSError:
+            continue
@@ -1,135 +1,14 @@
 import streamlit as st
 import pandas as pd
-import zipfile, io, re, tempfile, gdown, calendar
+import hashlib, time, uuid, functools
+from concurrent.futures import wait
+from typing import NamedTuple
 from datetime import date, datetime
-from dateutil.relativedelta import relativedelta
 from st_aggrid import AgGrid, GridOptionsBuilder
-from st_aggrid.shared import GridUpdateMode
+from st_aggrid.shared import GridUpdateMode, JsCode
 
-# ──────────────────────────────────────────────
-# 固定マッピング : RecordID (B列) ➜ DealID (C列)
-# ──────────────────────────────────────────────
-ID_MAP_FIXED = {
-    'AKE202210_KEIEI_U': '9775650935',
-    'AMA202211_SYSTEM_P': '13111634538',
-    'AMA202304_2BREPO_P': '13111594792',
-    'AMA202304_ECREPO_P': '13111634452',
-    'AMA202304_ECSYST_P': '13111594849',
-    'AMA202305_BILLIN_P': '13334264959',
-    'AMA202306_SCMPMO_P': '13826848558',
-    'AMA202307_ELSIGN_P': '13965251380',
-    'AMA202307_MGTADV_U': '13906057056',
-    'ARA202308_JIGYOU_P': '12746802825',
-    'BRI202309_OTHERS_P': '12850387035',
-    'BRI202310_PMOSUP_P': '16033621034',
-    'CLE202304_CDMOTR_U': '13523440943',
-    'DAI202309_OTHERS_P': '15098798720',
-    'DEK202307_OTHERS_P': '12911619969',
-    'DEK202308_OTHERS_U': '13964560773',
-    'DEK202312_FASMAA_U': '16351470488',
-    'DEK202312_OTHERS_U': '16037489190',
-    'DEN202210_JIGYOU_P': '10172816231',
-    'DEN202302_JIGYOU_U': '12030335245',
-    'DEN202309_JIGYOU_P': '13909275047',
-    'DEN202309_OTHERS_P': '14767850896',
-    'ELN202303_VISASQ_U': '12602652171',
-    'FAN202302_HOKUBE_U': '11770846345',
-    'FUJ202302_JIGYOU_U': '12158729512',
-    'FUT202308_DXSTRA_P': '14148089088',
-    'HIR202211_ESSYST_P': '10362965791',
-    'HIR202302_ESCONS_U': '12073670611',
-    'HIR202302_JIGYOU_U': '12073670418',
-    'HIR202302_JPSGAN_U': '12073670158',
-    'HIR202303_JIGYOU_U': '12170849132',
-    'HIR202304_JIGYOU_U': '12223160017',
-    'HIR202305_JIGYOU_U': '12363647079',
-    'HIR202306_JIGYOU_U': '12515803893',
-    'HIR202307_JIGYOU_U': '13111138855',
-    'HIR202308_OTHERS_U': '13739060018',
-    'HIR202309_JIGYOU_U': '13964605132',
-    'HIT202302_JIGYOU_U': '11934460122',
-    'HIT202304_DXCONS_U': '12394681781',
-    'HIT202305_OTHERS_P': '12394681487',
-    'HIT202306_OTHERS_P': '12561539312',
-    'HIT202307_OTHERS_P': '13111138884',
-    'HIT202308_OTHERS_P': '13737542047',
-    'HIT202309_OTHERS_P': '14767850830',
-    'INM202307_DXCONS_P': '12747279127',
-    'INM202309_DXCONS_P': '14767043959',
-    'JDC202308_JIGYOU_U': '13739310719',
-    'JDC202309_OTHERS_U': '14671654128',
-    'KAK202303_DXMKTG_P': '12561292342',
-    'KAK202304_SUSTAI_P': '12223160034',
-    'KAK202306_OTHERS_P': '12665061861',
-    'KAK202307_OTHERS_P': '12910901831',
-    'KAK202308_OTHERS_P': '13739059963',
-    'KAK202309_OTHERS_P': '14671654171',
-    'KOK202306_OTHERS_P': '12910901839',
-    'KOK202307_OTHERS_P': '12910901845',
-    'KOK202308_OTHERS_P': '13737542079',
-    'KOK202309_OTHERS_P': '14671654191',
-    'KYO202210_MDTYPE_P': '10172816310',
-    'KYO202303_OTHERS_P': '12561292366',
-    'KYO202304_OTHERS_P': '12257979771',
-    'LIF202308_OTHERS_P': '14148089119',
-    'LIF202309_OTHERS_P': '15100050932',
-    'MIK202308_OTHERS_P': '13737542093',
-    'MON202210_TAXSPA_P': '10455428996',
-    'MON202211_TAXSPA_P': '10455429076',
-    'MON202301_TAXSPA_P': '11770846395',
-    'MON202302_TAXSPA_P': '12158729536',
-    'MON202303_OTHERS_P': '12456413016',
-    'MON202304_OTHERS_P': '12223160047',
-    'MON202306_TAXSPA_P': '12561539221',
-    'MON202307_OTHERS_P': '12911619960',
-    'MON202308_OTHERS_P': '13737542107',
-    'MON202309_OTHERS_P': '15100050944',
-    'NIT202210_OPMKTG_P': '10172590823',
-    'NRI202210_DXCONS_P': '10172816325',
-    'NSS202302_DXSTRA_P': '11770846424',
-    'NSS202306_OTHERS_P': '12561539273',
-    'NSS202307_OTHERS_P': '12911220631',
-    'NSS202308_OTHERS_P': '13739060041',
-    'NSS202309_OTHERS_P': '13964605170',
-    'OKI202307_OTHERS_P': '12911619977',
-    'OKI202308_OTHERS_P': '13739060051',
-    'OKI202309_OTHERS_P': '14671654213',
-    'RIC202309_OTHERS_P': '14767171462',
-    'RYO202308_DXSTRA_P': '14148089146',
-    'SHP202210_DXSTRA_P': '10455429113',
-    'SHP202307_OTHERS_P': '12910901871',
-    'SHP202308_OTHERS_P': '13737542123',
-    'SHP202309_OTHERS_P': '14767850911',
-    'SMB202210_JIGYOU_P': '10172816344',
-    'SMB202302_JIGYOU_U': '11770846443',
-    'SMB202304_JIGYOU_P': '12257979795',
-    'SMB202306_JIGYOU_P': '12602652214',
-    'SMB202307_JIGYOU_P': '12910901890',
-    'SMB202308_JIGYOU_P': '13737542137',
-    'SMB202309_JIGYOU_P': '14768031259',
-    'SMT202210_SYSMIG_P': '10172816352',
-    'SMT202210_SYSTUN_P': '10172816371',
-    'SMT202212_JIGYOU_P': '10363337802',
-    'SMT202303_JIGYOU_P': '12561292418',
-    'SMT202304_JIGYOU_P': '12257979805',
-    'SMT202305_OTHERS_P': '12394681563',
-    'SMT202306_OTHERS_P': '12561539286',
-    'SMT202307_OTHERS_P': '12911220662',
-    'SMT202308_OTHERS_P': '13739060064',
-    'SMT202309_OTHERS_P': '13964605187',
-    'SNS202309_OTHERS_P': '13964605191',
-    'TAX202210_OTHERS_P': '10455429145',
-    'TAX202302_HOKUBE_U': '11770846459',
-    'TSC202301_SYSTEM_P': '9739381018',
-    'TTS202304_JIGRESEAC_P': '12783695123',
-    'TTS202306_VISASQ_U': '13374247579',
-    'UAC202308_OTHERS_P': '13963049397',
-    'UAC202307_OTHERS_P': '13411248700',
-    'YON202301_DXSTRA_P': '12456413034',
-    'YON202308_OTHERS_U': '13737542160',
-    'YON202309_DXSTRA_P': '14446752905',
-    'YON202312_DXSTRA_P': '15481667376'
-}
+import pipeline as pl
+import snapshots, ledger, downloads, exports, diagnostics, jobs
 
 # ──────────────────────────────────────────────
 # ページ設定
@@ -137,69 +16,395 @@ ID_MAP_FIXED = {
 st.set_page_config(page_title="プロジェクト収益 v7.2", layout="wide")
 
 # ──────────────────────────────────────────────
-# 共通ユーティリティ
+# 入力ソース & ステージキャッシュ
+#   各ステージは入力ファイルの内容ハッシュをキーにキャッシュし、
+#   フィルター操作による再実行ではフィルタと月次展開のみ再計算する
 # ──────────────────────────────────────────────
-def detect_col(cols, patterns):
-    for p in patterns:
-        hits = [c for c in cols if re.sub(r"\s+", "", str(c)).casefold() == p]
-        if hits:
-            return hits[0]
-    return None
+CACHE_TTL     = 60 * 60    # 秒
+CACHE_ENTRIES = 8          # ステージごとの保持件数
+
+
+class Source(NamedTuple):
+    """キャッシュキー付き入力ファイル（同一性は内容ハッシュで判定）"""
+    key: str                          # 内容の SHA-1
+    name: str
+    buf: object                       # バイナリバッファ（スナップショットは None）
+    member: str | None = None         # ZIP 内の対象 CSV
+    encodings: tuple = pl.ENCODINGS
+
+    def cache_key(self):
+        return (self.key, self.name, self.member, self.encodings)
+
+    def read(self, schema=None) -> pd.DataFrame:
+        return pl.read_csv_bytes(self.buf, self.name, self.member,
+                                 self.encodings, schema)
+
+
+class SourceSet(NamedTuple):
+    """複数ファイル / ZIP 内の全 CSV（並列に読み、読込元の列を付けて結合）"""
+    parts: tuple
+
+    @property
+    def key(self):
+        return hashlib.sha1(repr([p.cache_key() for p in self.parts]).encode()).hexdigest()
+
+    @property
+    def name(self):
+        return f"{self.parts[0].member or self.parts[0].name} 他 {len(self.parts) - 1} 件"
+
+    @property
+    def buf(self):
+        return self.parts
+
+    def items(self):
+        return [(p.buf, p.name, p.member, p.encodings) for p in self.parts]
+
+    def read(self, schema=None) -> pd.DataFrame:
+        return pl.read_csv_many(self.items(), schema)
+
+
+class StreamRef(NamedTuple):
+    """大容量モードの仕訳帳（チャンク読込しながら集計。スナップショットは作らない）"""
+    src: Source | SourceSet
+    memory_mb: int
+
+
+class LedgerRef(NamedTuple):
+    """差分取り込み台帳（版数が変わればキャッシュも作り直す）"""
+    name: str
+    version: int
+
+
+def content_key(uploaded) -> str:
+    """アップロード内容の SHA-1（file_id 単位でセッションにメモ）"""
+    memo = st.session_state.setdefault("_content_keys", {})
+    fid = getattr(uploaded, "file_id", None) or uploaded.name
+    if fid not in memo:
+        with uploaded.getbuffer() as view:
+            memo[fid] = hashlib.sha1(view).hexdigest()
+    return memo[fid]
+
+
+stage_cache = st.cache_data(ttl=CACHE_TTL, max_entries=CACHE_ENTRIES,
+                            hash_funcs={Source: Source.cache_key},
+                            show_spinner=False)
+
+
+def traced_stage(name: str):
+    """
+    stage_cache + 計測（所要時間 / 結果の行数 / メモリ増減）
+    キャッシュ済み関数の本体が実行されれば miss、されなければ hit として記録する
+    """
+    def deco(fn):
+        @functools.wraps(fn)            # キャッシュキーは元の関数名とソースから作られる
+        def body(*args):
+            diagnostics.mark_miss()
+            return fn(*args)
+        cached = stage_cache(body)
+
+        @functools.wraps(fn)
+        def stage(*args):
+            with diagnostics.span(name, cache="hit") as rec:
+                res = cached(*args)
+                rec["rows"] = diagnostics.count_rows(res)
+            return res
+        return stage
+    return deco
+
+
+def parsed_input(src: Source, kind: str, schema, prepare, *args) -> pd.DataFrame:
+    """
+    パース + 正規化（prepare）済みの入力
+    スナップショット（パース直後の行）があれば CSV を読まずに開き、無ければ作成する
+    prepare は開くたびに現在の id_map 等で適用する（台帳への取り込みと同じ置換前の行を保存）
+    """
+    if src.buf is None:                       # サイドバーで選んだスナップショット
+        key = src.key
+    else:
+        key = snapshots.snapshot_key(src.key, "raw")
+    with diagnostics.span("ingest", kind=kind) as rec:
+        df = snapshots.load_snapshot(kind, key)
+        rec["snapshot"] = df is not None
+        if df is None:
+            if src.buf is None:
+                raise ValueError("スナップショットが見つかりません（削除済みの可能性があります）。")
+            df = src.read(schema)
+            snapshots.save_snapshot(kind, key, df, src.name)
+        rec["rows"] = len(df)
+    with diagnostics.span("remap" if kind == "journal" else "prepare", kind=kind):
+        df = prepare(df, *args)
+    return df
+
+
+@traced_stage("journal")
+def journal_stage(src: Source | SourceSet | StreamRef | LedgerRef, id_map: pd.Series):
+    """仕訳帳 → 取引コード単位の集計 + 取引日の範囲（id_map の内容もキーに含む）"""
+    if isinstance(src, LedgerRef):
+        return ledger.ledger_daily(src.name, id_map)
+    if isinstance(src, StreamRef):
+        s = src.src
+        items = s.items() if isinstance(s, SourceSet) else [(s.buf, s.name, s.member, s.encodings)]
+        with diagnostics.span("ingest", kind="journal", mode="stream"):   # 読込 + 置換 + 集計
+            return pl.stream_journal(items, id_map, src.memory_mb, progress=lambda i, n, rows:
+                jobs.step(0.05 + 0.9 * i / n, f"仕訳帳 {i + 1}/{n} · {rows:,} 行"))
+    df_src = parsed_input(src, "journal", pl.JOURNAL_SCHEMA, pl.prepare_journal, id_map)
+    with diagnostics.span("pivot"):
+        return pl.aggregate_journal(df_src), df_src["取引日"].min(), df_src["取引日"].max()
+
+
+@traced_stage("master")
+def master_stage(src: Source):
+    return pl.build_master_map(
+        parsed_input(src, "master", pl.MASTER_SCHEMA, pl.prepare_master))
+
+
+@traced_stage("cost")
+def cost_stage(src: Source):
+    return parsed_input(src, "cost", pl.COST_SCHEMA, pl.prepare_cost)
+
+
+@traced_stage("id_map")
+def id_map_stage(src: Source):
+    return pl.read_id_map(src.buf, src.name)
+
+
+@traced_stage("join")
+def join_stage(journal: Source | SourceSet | StreamRef | LedgerRef, cost: Source | None, master: Source | None,
+               id_map: pd.Series):
+    """仕訳帳集計 + 人件費 + マスタ補完（取引キー索引で結合）→ (結合後の表, 結合できなかった取引コード)"""
+    daily, _, _ = journal_stage(journal, id_map)
+    cost_info  = pl.build_cost_info(cost_stage(cost)) if cost else None
+    master_map = master_stage(master) if master else None
+    return pl.join_deals(daily, cost_info, master_map)
+
+
+@traced_stage("daily")
+def daily_stage(journal: Source | SourceSet | StreamRef | LedgerRef, cost: Source | None, master: Source | None,
+                id_map: pd.Series):
+    """仕訳帳集計 + 人件費 + マスタ補完 + 指標"""
+    merged, _ = join_stage(journal, cost, master, id_map)
+    with diagnostics.span("metrics"):
+        return pl.compute_metrics(merged)
+
+
+@traced_stage("filter_index")
+def filter_index_stage(journal: Source | SourceSet | StreamRef | LedgerRef, cost: Source | None, master: Source | None,
+                       id_map: pd.Series):
+    return pl.build_filter_index(daily_stage(journal, cost, master, id_map))
+
+
+@traced_stage("monthly")
+def monthly_stage(journal, cost, master, id_map: pd.Series, filters: tuple):
+    """フィルタ後の月次展開 + 月次サマリー（Chart / Table view 用）"""
+    id_val, start_date, end_date, selections = filters
+    daily = daily_stage(journal, cost, master, id_map)
+    fidx = filter_index_stage(journal, cost, master, id_map)
+    with diagnostics.span("filter"):
+        mask = pl.filter_mask(fidx, id_val, start_date, end_date, dict(selections))
+    with diagnostics.span("expand") as rec:
+        df_sales_p, df_profit_p, count_series, time_cols = \
+            pl.expand_monthly(daily[mask], start_date, end_date)
+        rec["rows"] = len(df_sales_p)
+    summary_sales  = pl.monthly_summary(df_sales_p, time_cols,
+                                        ["①月次売上合計","②平均売上単価"])
+    summary_profit = pl.monthly_summary(df_profit_p, time_cols,
+                                        ["③月次粗利合計","④平均粗利単価"])
+    return df_sales_p, df_profit_p, count_series, time_cols, summary_sales, summary_profit
+
+
+@traced_stage("detail")
+def detail_stage(cost: Source):
+    return pl.build_consultant_detail(cost_stage(cost))
+
+
+@traced_stage("utilization")
+def util_stage(cost: Source, start: str | None):
+    return pl.build_utilization(cost_stage(cost), start)
 
 
-def normalize_id(x):
-    if pd.isna(x):
-        return None
-    s = str(x).strip()
-    return None if s == "" or s.lower() in {"nan", "none"} else s
+# ── CSV / ZIP ローダ ---------------------------------------------------------
+ALL_MEMBERS = "（すべての CSV を結合）"
 
 
-# ── CSV / ZIP ローダ ---------------------------------------------------------
-def load_csv(uploaded):
-    """① CSV ② ZIP 内 CSV を DataFrame で返す"""
+def load_csv(uploaded, allow_all=False):
+    """① CSV ② ZIP 内 CSV を Source で返す（allow_all なら ZIP 内の全 CSV を SourceSet で）"""
     if uploaded is None:
         return None
 
-    # ZIP
+    member = None
     if uploaded.name.lower().endswith(".zip"):
         try:
-            with zipfile.ZipFile(uploaded) as zf:
-                csv_files = [n for n in zf.namelist()
-                             if n.lower().endswith(".csv") and not n.endswith("/")]
-                if not csv_files:
-                    st.error("ZIP に CSV が見つかりません。")
-                    return None
-                target = csv_files[0] if len(csv_files) == 1 else \
-                         st.selectbox("ZIP 内 CSV を選択してください", csv_files)
-                with zf.open(target) as fp:
-                    for enc in ("utf-8-sig", "cp932", "utf-8"):
-                        try:
-                            txt = fp.read().decode(enc)
-                            return pd.read_csv(io.StringIO(txt))
-                        except Exception:
-                            fp.seek(0)
-        except zipfile.BadZipFile:
-            st.error("ZIP ファイルが壊れています。")
+            csv_files = pl.zip_csv_members(uploaded)
+        except ValueError as e:
+            st.error(str(e))
+            return None
+        if not csv_files:
+            st.error("ZIP に CSV が見つかりません。")
             return None
+        member = csv_files[0] if len(csv_files) == 1 else \
+                 st.selectbox(f"{uploaded.name} 内の CSV を選択してください",
+                              [*csv_files, ALL_MEMBERS] if allow_all else csv_files,
+                              key=f"member_{getattr(uploaded, 'file_id', uploaded.name)}")
+        if member == ALL_MEMBERS:
+            key = content_key(uploaded)
+            return SourceSet(tuple(Source(key, uploaded.name, uploaded, m) for m in csv_files))
+    return Source(content_key(uploaded), uploaded.name, uploaded, member)
+
+
+def load_csvs(files):
+    """複数アップロード → Source（1 件）/ SourceSet（複数件、ZIP の全 CSV も展開）"""
+    parts = []
+    for f in files:
+        src = load_csv(f, allow_all=True)
+        if src is not None:
+            parts.extend(src.parts if isinstance(src, SourceSet) else [src])
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else SourceSet(tuple(parts))
 
-    # 通常 CSV
-    for enc in ("utf-8-sig", "cp932", "utf-8"):
-        try:
-            txt = uploaded.read().decode(enc)
-            return pd.read_csv(io.StringIO(txt))
-        except Exception:
-            uploaded.seek(0)
 
-    st.error("CSV の読み込みに失敗しました。文字コードを確認してください。")
-    return None
+def run_stage(stage, src, *args):
+    """ステージ実行（読込失敗時はエラー表示して None）"""
+    if src is None:
+        return None
+    try:
+        return stage(src, *args)
+    except ValueError as e:
+        st.error(str(e))
+        return None
+
+
+# ── バックグラウンドジョブ -----------------------------------------------------
+#   重いステージはワーカースレッドで実行し、スクリプトは進捗を表示しながら待つ
+#   フィルター変更等で再実行されても同じ入力なら実行中のジョブに合流し、
+#   入力が変われば（または中止ボタンで）前のジョブを取り消す
+JOB_POLL = 0.25    # 進捗表示の更新間隔（秒）
+
+
+def arg_key(a):
+    """ジョブキー用の引数の識別子（入力は内容ハッシュ、DataFrame / Series は内容のハッシュ）"""
+    if isinstance(a, Source):
+        return a.cache_key()
+    if isinstance(a, SourceSet):
+        return a.key
+    if isinstance(a, StreamRef):
+        return (arg_key(a.src), a.memory_mb)
+    if isinstance(a, (pd.DataFrame, pd.Series)):
+        return snapshots.frame_digest(a)
+    return a
+
+
+def cancel_job(label: str, key: str):
+    st.session_state.setdefault("_jobs_cancelled", {})[label] = key
+    jobs.release(key, st.session_state["_diag_session"])
+
+
+def run_job(label: str, stage, *args):
+    """
+    stage(*args) をバックグラウンドジョブで実行して結果を返す
+    完了まで進捗バーと中止ボタンを表示。中止 / 読込失敗時は None
+    """
+    key = hashlib.sha1(repr((stage.__name__, *map(arg_key, args))).encode()).hexdigest()
+    session = st.session_state["_diag_session"]
+    slots = st.session_state.setdefault("_jobs", {})
+    if slots.get(label) not in (None, key):            # 入力が変わった → 前のジョブを手放す
+        jobs.release(slots[label], session)
+    slots[label] = key
+
+    done = st.session_state.setdefault("_jobs_done", {})
+    if done.get(label) == key:                          # 完了済み → ステージキャッシュから
+        return run_stage(stage, *args)
+    cancelled = st.session_state.setdefault("_jobs_cancelled", {})
+    if cancelled.get(label) == key:
+        st.info(f"{label}の処理を中止しました。")
+        st.button("▶ 再実行", key=f"retry_{label}", on_click=cancelled.pop, args=(label, None))
+        return None
+
+    t0 = time.perf_counter()
+    job = jobs.submit(key, stage, *args, label=label, session=session)
+    if not wait([job.future], timeout=JOB_POLL).done:
+        box = st.empty()
+        with box.container():
+            bar = st.progress(job.fraction, text=f"{label} : {job.message}")
+            st.button("⏹ 中止", key=f"cancel_{label}", on_click=cancel_job, args=(label, key))
+        while not wait([job.future], timeout=JOB_POLL).done:
+            bar.progress(job.fraction, text=f"{label} : {job.message}")
+        box.empty()
+
+    diagnostics.record("job", (time.perf_counter() - t0) * 1000, label=label,
+                       attached=job.requests > 1)
+    if job.trace is not None and not job.reported:      # ワーカー側の区間をこの実行の記録に入れる
+        job.reported = True
+        trace.records += [{**r, "depth": r["depth"] + 1} for r in job.trace.records]
+    jobs.collect(key)
+    slots.pop(label, None)
+    try:
+        res = job.result()
+    except jobs.Cancelled:
+        return None
+    except ValueError as e:
+        st.error(str(e))
+        return None
+    done[label] = key
+    return res
 
 
 # ── Google Drive 共有リンク ---------------------------------------------------
-def read_gdrive_csv_gdown(url: str, **kw) -> pd.DataFrame:
-    """共有リンク → gdown で DL → DataFrame"""
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".csv") as tmp:
-        gdown.download(url=url, output=tmp.name, quiet=False, fuzzy=True)
-        return pd.read_csv(tmp.name, **kw)
+def read_gdrive_csv_gdown(url: str, encoding="cp932") -> Source:
+    """共有リンク → ダウンロードキャッシュ → Source（キャッシュファイルから直接パース）"""
+    hit = downloads.fetch(url)
+    if hit.get("stale"):
+        st.warning("Google Drive に接続できないため、前回ダウンロードしたファイルを使用します。")
+    return Source(hit["sha1"], "gdrive.csv", hit["path"], encodings=(encoding,))
+
+
+# ── 差分取り込み台帳 ----------------------------------------------------------
+def fold_into_ledger(src: Source, name: str) -> LedgerRef:
+    """仕訳帳を台帳に追記（取り込み済みの入力は読まない）→ 最新版の LedgerRef"""
+    if src is not None and not ledger.has_source(name, src.key):
+        try:
+            if src.buf is None:
+                res = ledger.fold_snapshot(name, src.key)
+            else:
+                res = ledger.fold_journal(name, src.read(pl.JOURNAL_SCHEMA), src.key)
+            st.success(f"台帳「{name}」に {res['added']:,} 行を追加しました"
+                       f"（取り込み済み {res['skipped']:,} 行は除外）。")
+        except ValueError as e:
+            st.error(str(e))
+    meta = ledger.ledger_meta(name)
+    return LedgerRef(name, meta["version"]) if meta else None
+
+
+# ── ステージ計測 -------------------------------------------------------------
+#   実行ごとに Trace を作り、ステージ / 描画の区間を記録する
+#   末尾でログ（diagnostics.LOG_PATH）に追記し、サイドバーの診断パネルに表示する
+trace = diagnostics.begin(st.session_state.setdefault("_diag_session", uuid.uuid4().hex[:8]),
+                          memory=st.session_state.get("diag_memory", False))
+
+
+def finish_trace():
+    """実行の終わり : 計測記録をログに追記して診断パネルを表示"""
+    try:
+        diagnostics.write_log(trace)
+    except OSError:
+        pass
+    with st.sidebar.expander("🩺 診断（ステージ計測）", expanded=False):
+        st.toggle("メモリ増減も計測（低速）", key="diag_memory",
+                  help="tracemalloc で各区間の確保メモリの増減を記録します（次の実行から）")
+        df = diagnostics.summary(trace)
+        if df.empty:
+            st.caption("記録はありません。")
+        else:
+            st.dataframe(df, hide_index=True, use_container_width=True, column_config={
+                "ms": st.column_config.NumberColumn("ms", format="%.1f"),
+                "rows": st.column_config.NumberColumn("行数", format="localized"),
+                "mem_delta": st.column_config.NumberColumn("メモリ増減 (B)", format="localized"),
+            })
+        st.caption(f"実行 {trace.run} · ログ {diagnostics.LOG_PATH.name}")
+        for job in jobs.running():
+            st.caption(f"⏳ {job.label} : {job.fraction:.0%} {job.message}"
+                       f"（待機 {len(job.waiters)} セッション）")
+    trace.close()
 
 # ──────────────────────────────────────────────
 # サイドバー : データ入力（Expander）
@@ -209,7 +414,8 @@ with st.sidebar.expander("📂 データアップロード / 選択", expanded=T
     tab_local, tab_drive = st.tabs(["ローカル CSV / ZIP", "Google Drive 共有リンク"])
 
     with tab_local:
-        uploaded_file = st.file_uploader("仕訳帳 (CSV / ZIP), journal", type=["csv", "zip"])
+        uploaded_files = st.file_uploader("仕訳帳 (CSV / ZIP), journal", type=["csv", "zip"],
+                                          accept_multiple_files=True)
 
     with tab_drive:
         gdrive_url = st.text_input("共有リンクを貼って Enter",
@@ -218,20 +424,60 @@ with st.sidebar.expander("📂 データアップロード / 選択", expanded=T
             st.warning("リンク形式が正しくありません。")
             gdrive_url = ""
 
+    # 差分取り込み : 新しいエクスポートのうち未取り込みの仕訳だけを台帳に追記
+    incremental = st.toggle("差分取り込み（台帳に追記）", value=False)
+    ledger_name = (st.text_input("台帳名", value="default") or "default") if incremental else None
+
+    # 大容量モード : 仕訳帳をチャンクごとに読み、対象勘定科目だけを集計しながら畳み込む
+    streaming = st.toggle("大容量モード（ストリーミング読込）", value=False,
+                          disabled=incremental)
+    stream_mb = st.number_input("チャンクあたりのメモリ目安 (MB)", min_value=16,
+                                max_value=4096, value=pl.STREAM_MEMORY_MB, step=16,
+                                disabled=not streaming or incremental)
+
     st.markdown("---")
 
     # 取引マスタ / 稼働コスト
     cost_file   = st.file_uploader("稼働コスト (CSV), utilization", type="csv")
     master_file = st.file_uploader("取引マスタ (CSV), transaction", type="csv")
 
+    st.markdown("---")
+
+    # DealID マッピング : id_map.csv + 追加アップロード分
+    map_file = st.file_uploader("DealID マッピング追加 (CSV), RecordID → DealID", type="csv")
+    id_map = pl.load_id_map()
+    extra_map = run_stage(id_map_stage, load_csv(map_file))
+    if extra_map is not None:
+        id_map = pl.merge_id_maps(id_map, extra_map)
+        if st.button("💾 マッピングファイルに保存"):
+            pl.save_id_map(id_map)
+            st.success(f"{len(extra_map):,} 件をマッピングファイルに保存しました。")
+    st.caption(f"DealID マッピング : {len(id_map):,} 件")
+
+    # スナップショット : 以前パースした入力を CSV なしで開く（アップロードが優先）
+    snap_sel = {}
+    for kind, label in snapshots.SNAPSHOT_KINDS.items():
+        snaps = sorted(snapshots.list_snapshots(kind), key=lambda m: m["created"], reverse=True)
+        if not snaps:
+            continue
+        if not snap_sel:
+            st.markdown("---")
+        names = {m["key"]: f"{m['label']} · {m['rows']:,} 行 · "
+                           f"{datetime.fromtimestamp(m['created']):%m/%d %H:%M}" for m in snaps}
+        key = st.selectbox(f"🗂 {label}スナップショット", [None, *names],
+                           format_func=lambda k: "（使用しない）" if k is None else names[k])
+        snap_sel[kind] = Source(key, names[key], None) if key else None
+
 # ──────────────────────────────────────────────
 # ファイル未アップロード時のガイダンス表示
 # ──────────────────────────────────────────────
 guidance_condition = (
-    (uploaded_file is None) and
+    (not uploaded_files) and
     (cost_file is None) and
     (master_file is None) and
-    (not gdrive_url)
+    (not gdrive_url) and
+    (not any(snap_sel.values())) and
+    (not (incremental and ledger.ledger_meta(ledger_name)))
 )
 if guidance_condition:
     st.markdown("## Read me: アップロードデータの取得方法")
@@ -283,418 +529,354 @@ if guidance_condition:
 # ──────────────────────────────────────────────
 # 仕訳帳読込
 # ──────────────────────────────────────────────
-df_src = None
-if uploaded_file is not None:
-    df_src = load_csv(uploaded_file)
+journal = None
+if uploaded_files:
+    journal = load_csvs(uploaded_files)
 elif gdrive_url:
     try:
-        df_src = read_gdrive_csv_gdown(gdrive_url, encoding="cp932")
+        journal = read_gdrive_csv_gdown(gdrive_url, encoding="cp932")
     except Exception as e:
         st.error(f"Google Drive 読み込み失敗: {e}")
-if df_src is None:
-    st.stop()
-df_src["取引日"] = pd.to_datetime(df_src["取引日"], errors="coerce")
-
-# ---------- RecordID → DealID 置換（固定マッピング） ----------
-TARGET_COLS = ["貸方部門", "借方部門"]
-for col in TARGET_COLS:
-    if col in df_src.columns:
-        df_src[col] = df_src[col].map(lambda x: ID_MAP_FIXED.get(normalize_id(x), x))
-
-# 取引マスタ読込 -----------------------------------------------------
-master_map = None
-if master_file:
-    df_master = load_csv(master_file)
-    if df_master is not None:
-        df_master.columns = df_master.columns.map(str.strip)
-        id_col   = detect_col(df_master.columns, ["取引id","レコードid","recordid","dealid"])
-        amt_col  = detect_col(df_master.columns, ["金額","売上金額","見積金額","amount"])
-        if id_col and amt_col:
-            df_master[id_col]  = df_master[id_col].map(normalize_id)
-            df_master[amt_col] = pd.to_numeric(df_master[amt_col], errors="coerce").fillna(0)
-            keep = {id_col:"取引コード", amt_col:"マスター金額"}
-            for src, dst in [
-                (["取引先","会社名","customer","client"],"マスター取引先"),
-                (["取引名","案件名","dealname","title"],"取引名"),
-                (["取引担当者","担当者","owner","sales"],"取引担当者"),
-                (["industry","業界"],"Industry"),
-                (["industry詳細","industrydetail","業界詳細"],"Industry詳細"),
-                (["提案商材","proposal","product"],"提案商材")
-            ]:
-                c = detect_col(df_master.columns, src)
-                if c: keep[c] = dst
-            master_map = (df_master[list(keep)]
-                          .dropna(subset=[id_col])
-                          .rename(columns=keep)
-                          .drop_duplicates(subset=["取引コード"]))
-
-# 稼働コスト読込 -----------------------------------------------------
-df_cost_raw = None
-if cost_file:
-    df_cost_raw = load_csv(cost_file)
-    if df_cost_raw is not None:
-        df_cost_raw.columns = df_cost_raw.columns.map(str.strip)
-
-# -------------- 既存ロジックで daily を作成 (売上・費用・人件費) --------------
-# 売上・費用整形
-df_sales = df_src[df_src.get("貸方勘定科目") == "売上高"].copy()
-df_sales_out = pd.DataFrame({
-    "取引コード": df_sales["貸方部門"].astype(str).str.strip(),
-    "取引先": df_sales["貸方取引先名"],
-    "勘定科目": "売上高",
-    "金額": pd.to_numeric(df_sales["貸方金額"], errors="coerce").fillna(0),
-    "日付": df_sales["取引日"]
-})
-
-targets = ["外注費","交際費","旅費交通費"]
-df_exp = df_src[df_src.get("借方勘定科目").isin(targets)].copy()
-df_exp_out = pd.DataFrame({
-    "取引コード": df_exp["借方部門"].astype(str).str.strip(),
-    "取引先": df_exp["借方取引先名"],
-    "勘定科目": df_exp["借方勘定科目"],
-    "金額": pd.to_numeric(df_exp["借方金額"], errors="coerce").fillna(0),
-    "日付": df_exp["取引日"]
-})
-combo = pd.concat([df_sales_out, df_exp_out], ignore_index=True)
-
-# pivot
-daily = (combo.pivot_table(index="取引コード", columns="勘定科目",
-                           values="金額", aggfunc="sum",
-                           fill_value=0)
-         .reset_index())
-meta = (combo.groupby("取引コード")
-             .agg({"日付":["min","max"],"取引先":"first"}).reset_index())
-meta.columns = ["取引コード","日付（最小）","日付（最大）","取引先"]
-daily = daily.merge(meta, on="取引コード", how="left")
-if "売上高" not in daily.columns:
-    daily["売上高"] = 0
-
-# 人件費 (稼働コスト CSV) ------------------------------------------------------
-if df_cost_raw is not None:
-    id_c   = detect_col(df_cost_raw.columns, ["取引id","レコードid","recordid"])
-    cost_c = detect_col(df_cost_raw.columns, ["稼働コスト","人件費","cost"])
-    name_c = detect_col(df_cost_raw.columns, ["会社名","取引先","client","customer"])
-    if id_c and cost_c:
-        df_cost_raw[id_c] = df_cost_raw[id_c].map(normalize_id)
-        df_cost = df_cost_raw.dropna(subset=[id_c]).copy()
-        df_cost["人件費"] = pd.to_numeric(df_cost[cost_c], errors="coerce").fillna(0)
-        agg = {"人件費":"sum"}
-        if name_c: agg[name_c] = "first"
-        cost_info = (
-            df_cost.groupby(id_c, as_index=False)
-                   .agg(agg)
-                   .rename(columns={
-                        id_c:   "取引コード",
-                        cost_c: "人件費",
-                        **({name_c: "稼働取引先"} if name_c else {})
-                   })
-        )
-        daily["取引コード"] = daily["取引コード"].map(normalize_id)
-        daily = daily.merge(cost_info, on="取引コード", how="left")
-    else:
-        daily["人件費"] = 0
 else:
-    daily["人件費"] = 0
-
-# マスタ補完 -----------------------------------------------------------
-if master_map is not None:
-    daily = daily.merge(master_map, on="取引コード", how="left")
-    need_fix = daily["売上高"] == 0
-    daily.loc[need_fix, "売上高"] = daily.loc[need_fix, "マスター金額"]
-    has_cost_name = daily["稼働取引先"].notna()
-    daily.loc[need_fix & has_cost_name, "取引先"] = \
-        daily.loc[need_fix & has_cost_name, "稼働取引先"]
-
-# 指標計算 -------------------------------------------------------------
-for c in ["売上高","外注費","交際費","旅費交通費","人件費"]:
-    daily[c] = pd.to_numeric(daily[c], errors="coerce").fillna(0)
-daily["月数"] = daily.apply(
-    lambda r: max((r["日付（最大）"].year - r["日付（最小）"].year)*12 +
-                  (r["日付（最大）"].month - r["日付（最小）"].month) + 1, 1),
-    axis=1)
-daily["月次売上"] = daily.apply(
-    lambda r: r["売上高"]/r["月数"] if r["月数"] else 0, axis=1)
-daily["粗利"] = (daily["売上高"] - daily["外注費"] - daily["交際費"]
-                 - daily["旅費交通費"] - daily["人件費"])
-daily["粗利率"] = daily.apply(
-    lambda r: (r["粗利"]/r["売上高"]*100) if r["売上高"]>0 else 0, axis=1)
-daily.rename(columns={"取引コード":"レコードID"}, inplace=True)
+    journal = snap_sel.get("journal")
+if incremental:
+    journal = fold_into_ledger(journal, ledger_name)
+elif streaming and journal is not None and journal.buf is not None:
+    journal = StreamRef(journal, int(stream_mb))
+journal_res = run_job("仕訳帳の取り込み", journal_stage, journal, id_map) \
+              if journal is not None else None
+if journal_res is None:
+    finish_trace()
+    st.stop()
+_, journal_min, journal_max = journal_res
+
+# 取引マスタ / 稼働コスト読込 ---------------------------------------------
+master = load_csv(master_file) or snap_sel.get("master")
+if run_stage(master_stage, master) is None:
+    master = None
+cost = load_csv(cost_file) or snap_sel.get("cost")
+df_cost_raw = run_stage(cost_stage, cost)
+if df_cost_raw is None:
+    cost = None
+
+# -------------- daily を作成 (売上・費用・人件費・マスタ補完・指標) --------------
+daily = run_job("daily の作成", daily_stage, journal, cost, master, id_map)
+if daily is None:
+    finish_trace()
+    st.stop()
 
 # ──────────────────────────────────────────────
 # フィルター UI
 # ──────────────────────────────────────────────
 st.sidebar.markdown("### 🔍 フィルター設定")
 id_val = st.sidebar.text_input("取引ID（部分一致可）", "")
-min_date = df_src["取引日"].min().date()
-max_date = df_src["取引日"].max().date()
+min_date = journal_min.date()
+max_date = journal_max.date()
 start_date, end_date = st.sidebar.date_input("期間範囲", [min_date, max_date])
 
-owner_sel = ind_sel = ind_det_sel = []
-if "取引担当者" in daily.columns:
-    owner_sel = st.sidebar.multiselect("取引担当者",
-                                       sorted(daily["取引担当者"].dropna().unique()))
-if "Industry" in daily.columns:
-    ind_sel = st.sidebar.multiselect("Industry",
-                                     sorted(daily["Industry"].dropna().unique()))
-if "Industry詳細" in daily.columns:
-    ind_det_sel = st.sidebar.multiselect("Industry詳細",
-                                         sorted(daily["Industry詳細"].dropna().unique()))
-
-mask  = daily["レコードID"].str.contains(id_val, na=False)
-mask &= daily["日付（最大）"].dt.date >= start_date
-mask &= daily["日付（最小）"].dt.date <= end_date
-if owner_sel:
-    mask &= daily["取引担当者"].isin(owner_sel)
-if ind_sel:
-    mask &= daily["Industry"].isin(ind_sel)
-if ind_det_sel:
-    mask &= daily["Industry詳細"].isin(ind_det_sel)
-df_filtered = daily[mask].copy()
+# 取引担当者 / Industry / Industry詳細（選択肢は索引から）
+fidx = filter_index_stage(journal, cost, master, id_map)
+selections = {c: st.sidebar.multiselect(c, cat["options"])
+              for c, cat in fidx["cats"].items()}
 
-# ──────────────────────────────────────────────
-# 月次テーブル & 案件数（期間内のみ）
-# ──────────────────────────────────────────────
-records_sales, records_profit = [], []
-for _, r in df_filtered.iterrows():
-    for i in range(int(r["月数"])):
-        dt_m = r["日付（最小）"] + relativedelta(months=i)
-        if not (start_date <= dt_m.date() <= end_date):
-            continue
-        ym = dt_m.strftime("%y/%m")
-        records_sales.append({"年月表示":ym,"レコードID":r["レコードID"],
-                              "取引先":r["取引先"],
-                              "月次売上":round(r["月次売上"])})
-        records_profit.append({"年月表示":ym,"レコードID":r["レコードID"],
-                               "取引先":r["取引先"],
-                               "月次粗利":round(r["粗利"]/r["月数"]) if r["月数"] else 0})
-df_ms = pd.DataFrame(records_sales)
-df_mp = pd.DataFrame(records_profit)
-
-df_sales_p  = (df_ms.pivot_table(index=["レコードID","取引先"],
-                                 columns="年月表示",
-                                 values="月次売上", fill_value=0).reset_index())
-df_profit_p = (df_mp.pivot_table(index=["レコードID","取引先"],
-                                 columns="年月表示",
-                                 values="月次粗利", fill_value=0).reset_index())
-time_cols = sorted(df_ms["年月表示"].unique().tolist())
-
-for df_num in (df_sales_p, df_profit_p):
-    for col in time_cols:
-        df_num[col] = (df_num[col]
-                       .astype(str)            # 念のため str に統一
-                       .str.replace(",", "")   # カンマ除去
-                       .astype(float)          # 数値化
-                       .fillna(0))
-
-summary_sales = pd.DataFrame({
-    "レコードID":["",""], "取引先":["①月次売上合計","②平均売上単価"],
-    **{c:[df_sales_p[c].sum(), df_sales_p[c].mean()] for c in time_cols}
-})
-summary_profit = pd.DataFrame({
-    "レコードID":["",""], "取引先":["③月次粗利合計","④平均粗利単価"],
-    **{c:[df_profit_p[c].sum(), df_profit_p[c].mean()] for c in time_cols}
-})
-for c in time_cols:
-    summary_sales[c]  = summary_sales[c].map(lambda x:f"{int(x):,}")
-    summary_profit[c] = summary_profit[c].map(lambda x:f"{int(x):,}")
-
-count_series = (df_ms[df_ms["月次売上"]>0]
-                .groupby("年月表示")["レコードID"].nunique()
-                .reindex(time_cols, fill_value=0))
+filters = (id_val, start_date, end_date,
+           tuple((c, tuple(v)) for c, v in selections.items()))
+util_start = st.sidebar.date_input("稼働率の集計開始月",
+                                   value=pd.Timestamp(pl.UTIL_START).date()) \
+             if df_cost_raw is not None else None
 
 # ──────────────────────────────────────────────
-# Utilization 計算
+# ビュー単位の遅延計算
+#   各タブのデータはそのタブを開いた時だけ作り（同一実行内ではメモ）、
+#   作成・描画の所要時間とデータのメモリをタブ末尾に表示する
 # ──────────────────────────────────────────────
-util_hours_pivot = pd.DataFrame()
-util_pct_pivot   = pd.DataFrame()
-std_hours_row    = {}
-
-if df_cost_raw is not None:
-    # 対象列
-    cons_c  = detect_col(df_cost_raw.columns, ["コンサルタント名","氏名","name"])
-    hours_c = detect_col(df_cost_raw.columns, ["稼働時間","hours","workinghours","h"])
-    date_c  = detect_col(df_cost_raw.columns, ["稼働月-月次","稼働月 - 月次","稼働日","date"])
-
-    if cons_c and hours_c and date_c:
-        dc = df_cost_raw[[cons_c, hours_c, date_c]].copy()
-
-        # 稼働時間を数値化
-        dc[hours_c] = (dc[hours_c].astype(str)
-                                   .str.replace(r"[^\d\.]", "", regex=True)
-                                   .replace("", "0")
-                                   .astype(float))
-
-        dc[date_c] = pd.to_datetime(dc[date_c], errors="coerce")
-        dc = dc.dropna(subset=[date_c]) 
-        dc["年月表示"] = dc[date_c].dt.strftime("%y/%m")
-
-        # ---------- 期間フィルタ：24/01 以降 ----------
-        util_time_cols = [c for c in sorted(dc["年月表示"].unique())
-                          if c >= "24/01"]
-        dc = dc[dc["年月表示"].isin(util_time_cols)]
-
-        # 月次稼働時間
-        util_hours = (dc.pivot_table(index=cons_c, columns="年月表示",
-                                     values=hours_c, aggfunc="sum",
-                                     fill_value=0)
-                      .reindex(columns=util_time_cols, fill_value=0))
-        util_hours_pivot = util_hours.reset_index()
-
-        # 標準稼働時間
-        for col in util_time_cols:
-            y, m = 2000 + int(col[:2]), int(col[3:])
-            _, last = calendar.monthrange(y, m)
-            workdays = pd.date_range(f"{y}-{m:02d}-01",
-                                     f"{y}-{m:02d}-{last}", freq="B").size
-            std_hours_row[col] = workdays * 8
-
-        # チャージャビリティ %
-        util_pct = util_hours.copy()
-        for col in util_time_cols:
-            util_pct[col] = util_pct[col] / std_hours_row[col]
-        util_pct_pivot = util_pct.reset_index()
-    else:
-        st.sidebar.warning("稼働コストに コンサル名 / 稼働時間 / 日付 列が見つかりません。")
+view_stats = {}    # ビュー名 → {"build_ms", "bytes", "render_ms"}
+
+
+def frames_nbytes(obj) -> int:
+    """結果に含まれる DataFrame / Series のメモリ（バイト）"""
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(deep=True).sum())
+    if isinstance(obj, pd.Series):
+        return int(obj.memory_usage(deep=True))
+    if isinstance(obj, (tuple, list)):
+        return sum(frames_nbytes(o) for o in obj)
+    if isinstance(obj, dict):
+        return sum(frames_nbytes(o) for o in obj.values())
+    return 0
+
+
+def view_data(view: str, builder, *args):
+    """ビューのデータを初回参照時にだけ作る（作成時間 / メモリを view_stats に記録）"""
+    s = view_stats.setdefault(view, {"build_ms": 0.0, "bytes": 0})
+    key = builder.__name__
+    if key not in s:
+        t = time.perf_counter()
+        s[key] = builder(*args)
+        s["build_ms"] += (time.perf_counter() - t) * 1000
+        s["bytes"] += frames_nbytes(s[key])
+        s["built_at"] = time.perf_counter()
+    return s[key]
+
+
+def monthly_view():
+    return view_data("月次", monthly_stage, journal, cost, master, id_map, filters)
+
+
+def view_footer(view: str, started: float):
+    """タブ末尾 : 初回描画までの時間とデータのメモリ（このタブで作成した分のみ作成時間に計上）"""
+    s = view_stats.setdefault(view, {"build_ms": 0.0, "bytes": 0})
+    s["render_ms"] = (time.perf_counter() - started) * 1000
+    diagnostics.record("render", s["render_ms"], view=view)
+    build_ms = s["build_ms"] if s.get("built_at", 0) >= started else 0
+    st.caption(f"⏱ 表示 {s['render_ms']:,.0f} ms（うちデータ作成 {build_ms:,.0f} ms）"
+               f" · データ {s['bytes'] / 2**20:,.1f} MB")
+
 
 # ──────────────────────────────────────────────
 # 画面表示
+#   データは数値のまま渡し、桁区切り・% 表記は column_config で描画側に任せる
+#   タブは選択中のものだけを実行する（on_change="rerun" で .open が有効になる）
 # ──────────────────────────────────────────────
-tab1, tab2, tab3 = st.tabs(["📊 Chart view","📋 Table view","📈 Utilization"])
+def money_config(cols):
+    """金額列 : 桁区切り表示"""
+    return {c: st.column_config.NumberColumn(c, format="localized") for c in cols}
+
+
+# ダウンロード : CSV の文字コードは出力ごとに既定を決め、画面で切り替え可能
+EXPORT_ENCODING = {"粗利集計": "utf-8-sig", "月次売上一覧": "cp932", "月次粗利一覧": "cp932",
+                   "結合できなかった取引コード": "utf-8-sig"}
+
+
+def file_download(label: str, frames: dict, fmt: str, file_name: str,
+                  encoding=None, key=None, target=st):
+    """
+    ダウンロードボタン（ファイルはクリック時に作成し、内容ハッシュでキャッシュ）
+    書き出したファイルは開いたハンドルで渡す（Streamlit 側が読み込んで配信する）
+    """
+    target.download_button(label, file_name=file_name, mime=exports.EXPORT_FORMATS[fmt][1],
+                           data=lambda: exports.export_file(frames, fmt, encoding).open("rb"),
+                           key=key or f"dl_{file_name}")
+
+
+# グリッド表示 : 並び替え・数値フィルタ・ページングはサーバー側で行い、表示ページの行だけを送る
+GRID_PAGE_SIZES = [25, 50, 100, 200]
+GRID_NUMBER_FMT = JsCode("function(p){return p.value == null ? '' : "
+                         "Number(p.value).toLocaleString();}")
+GRID_PCT_FMT    = JsCode("function(p){return p.value == null ? '' : "
+                         "Number(p.value).toFixed(1) + '%';}")
+
+
+def paged_grid(name: str, df: pd.DataFrame, num_cols, date_cols=(), pct_cols=()):
+    """AgGrid（サーバー側ページング）。num_cols は桁区切り、date_cols は YY/MM 表示"""
+    c_sort, c_desc, c_filt, c_size, c_page = st.columns([3, 1, 3, 1, 1])
+    sort_col = c_sort.selectbox("並び替え", [None, *df.columns], key=f"{name}_sort",
+                                format_func=lambda c: "（元の順）" if c is None else c)
+    desc = c_desc.toggle("降順", key=f"{name}_desc")
+    f_col = c_filt.selectbox("数値で絞り込み", [None, *num_cols, *pct_cols], key=f"{name}_filt",
+                             format_func=lambda c: "（なし）" if c is None else c)
+    ranges = {}
+    if f_col is not None:
+        lo_c, hi_c = st.columns(2)
+        ranges[f_col] = (lo_c.number_input(f"{f_col} 下限", value=None, key=f"{name}_lo"),
+                         hi_c.number_input(f"{f_col} 上限", value=None, key=f"{name}_hi"))
+    size = c_size.selectbox("件数", GRID_PAGE_SIZES, index=1, key=f"{name}_size")
+    _, total = pl.grid_window(df, None, True, ranges, 1, 0)
+    pages = max(-(-total // size), 1)
+    page = c_page.number_input("ページ", min_value=1, max_value=pages, value=1, key=f"{name}_page")
+    window, total = pl.grid_window(df, sort_col, not desc, ranges, min(page, pages), size)
+
+    window = window.copy()
+    for c in date_cols:
+        window[c] = pd.to_datetime(window[c], errors="coerce").dt.strftime("%y/%m")
+    gb = GridOptionsBuilder.from_dataframe(window)
+    gb.configure_default_column(sortable=False, filter=False, resizable=True)
+    for c in num_cols:
+        gb.configure_column(c, type=["numericColumn"], valueFormatter=GRID_NUMBER_FMT)
+    for c in pct_cols:
+        gb.configure_column(c, type=["numericColumn"], valueFormatter=GRID_PCT_FMT)
+    AgGrid(window, gridOptions=gb.build(), height=min(40 + 30 * len(window), 640),
+           update_mode=GridUpdateMode.NO_UPDATE, allow_unsafe_jscode=True,
+           key=f"{name}_grid")
+    first = (min(page, pages) - 1) * size
+    st.caption(f"{total:,} 件中 {min(first + 1, total):,}–{first + len(window):,} 件を表示"
+               f"（全 {len(df):,} 件）")
+
+
+def export_row(name: str, df: pd.DataFrame):
+    """CSV（文字コード選択）+ Parquet のダウンロード行"""
+    c_csv, c_pq, c_enc = st.columns([2, 2, 3])
+    enc = c_enc.selectbox(f"{name} CSV の文字コード", exports.CSV_ENCODINGS,
+                          index=exports.CSV_ENCODINGS.index(EXPORT_ENCODING[name]),
+                          key=f"enc_{name}", label_visibility="collapsed")
+    file_download(f"💾 {name}CSV", {name: df}, "csv", f"{name}.csv", enc, target=c_csv)
+    file_download(f"💾 {name} Parquet", {name: df}, "parquet", f"{name}.parquet", target=c_pq)
+
+
+tab1, tab2, tab3 = st.tabs(["📊 Chart view","📋 Table view","📈 Utilization"],
+                           key="view", on_change="rerun")
 
 # ----- Chart view ------------------------------------------------------------
-with tab1:
-    st.subheader("月次合計売上・粗利")
-    st.line_chart(pd.DataFrame({
-        "月次売上合計":[int(summary_sales.loc[0,c].replace(',','')) for c in time_cols],
-        "月次粗利合計":[int(summary_profit.loc[0,c].replace(',','')) for c in time_cols]
-    }, index=time_cols))
-    st.subheader("月次平均売上・粗利")
-    st.line_chart(pd.DataFrame({
-        "平均売上単価":[int(summary_sales.loc[1,c].replace(',','')) for c in time_cols],
-        "平均粗利単価":[int(summary_profit.loc[1,c].replace(',','')) for c in time_cols]
-    }, index=time_cols))
-    st.subheader("案件数")
-    st.bar_chart(pd.DataFrame({"案件数":count_series}, index=time_cols))
+if tab1.open is not False:
+    with tab1:
+        t0 = time.perf_counter()
+        df_sales_p, df_profit_p, count_series, time_cols, summary_sales, summary_profit = \
+            monthly_view()
+        st.subheader("月次合計売上・粗利")
+        st.line_chart(pd.DataFrame({
+            "月次売上合計": summary_sales.loc[0, time_cols].to_numpy(dtype=float),
+            "月次粗利合計": summary_profit.loc[0, time_cols].to_numpy(dtype=float)
+        }, index=time_cols))
+        st.subheader("月次平均売上・粗利")
+        st.line_chart(pd.DataFrame({
+            "平均売上単価": summary_sales.loc[1, time_cols].to_numpy(dtype=float),
+            "平均粗利単価": summary_profit.loc[1, time_cols].to_numpy(dtype=float)
+        }, index=time_cols))
+        st.subheader("案件数")
+        st.bar_chart(pd.DataFrame({"案件数":count_series}, index=time_cols))
+        view_footer("月次", t0)
 
 # ----- Table view ------------------------------------------------------------
-with tab2:
-    st.subheader("📄 プロジェクト収益一覧")
-    # 表示列を拡張：レコードIDの後に日付最小・最大（YY/MM）を挿入
-    show_cols = [
-        "レコードID","日付（最小）","日付（最大）","取引先","取引名","取引担当者",
-        "Industry","Industry詳細","提案商材",
-        "売上高","人件費","外注費","交際費","旅費交通費",
-        "粗利","粗利率"
-    ]
-    df_disp = df_filtered[show_cols].copy()
-    # 日付最小・最大をYY/MM形式で表示
-    for c in ["日付（最小）","日付（最大）"]:
-        df_disp[c] = pd.to_datetime(df_disp[c], errors="coerce").dt.strftime("%y/%m")
-    # 数値をカンマ区切りでフォーマット
-    num_cols = ["売上高","人件費","外注費","交際費","旅費交通費","粗利"]
-    for c in num_cols:
-        df_disp[c] = df_disp[c].map(lambda x: f"{int(x):,}")
-    # 粗利率をパーセント表示
-    df_disp["粗利率"] = df_disp["粗利率"].map(lambda x: f"{x:.1f}%")
-
-    st.dataframe(df_disp, use_container_width=True)
-    st.download_button(
-        "💾 粗利集計CSV",
-        data=df_filtered.to_csv(index=False, encoding="utf-8-sig"),
-        file_name="粗利集計.csv"
-    )
+if tab2.open is not False:
+    with tab2:
+        t0 = time.perf_counter()
+        df_sales_p, df_profit_p, count_series, time_cols, summary_sales, summary_profit = \
+            monthly_view()
+        with diagnostics.span("filter", view="表"):
+            mask = pl.filter_mask(fidx, id_val, start_date, end_date, selections)
+        df_filtered = daily[mask]
+
+        st.subheader("📄 プロジェクト収益一覧")
+        # 表示列を拡張：レコードIDの後に日付最小・最大（YY/MM）を挿入
+        show_cols = [
+            "レコードID","日付（最小）","日付（最大）","取引先","取引名","取引担当者",
+            "Industry","Industry詳細","提案商材",
+            "売上高","人件費","外注費","交際費","旅費交通費",
+            "粗利","粗利率"
+        ]
+        df_disp = df_filtered[show_cols]
+        num_cols = ["売上高","人件費","外注費","交際費","旅費交通費","粗利"]
+        grid_mode = st.toggle("グリッド表示（サーバー側ページング）", value=False,
+                              help="並び替え・絞り込み・ページ分割をサーバー側で行い、表示中のページだけを送ります")
+        if grid_mode:
+            paged_grid("粗利集計", df_disp, num_cols,
+                       date_cols=["日付（最小）","日付（最大）"], pct_cols=["粗利率"])
+        else:
+            st.dataframe(df_disp, use_container_width=True, column_config={
+                # 日付最小・最大をYY/MM形式で表示
+                **{c: st.column_config.DateColumn(c, format="YY/MM")
+                   for c in ["日付（最小）","日付（最大）"]},
+                # 数値をカンマ区切り、粗利率をパーセント表示
+                **money_config(num_cols),
+                "粗利率": st.column_config.NumberColumn("粗利率", format="%.1f%%"),
+            })
+        export_row("粗利集計", df_filtered)
+
+        # 結合できなかった取引コード（人件費 / マスタが無い案件、仕訳の無い稼働コスト / マスタ）
+        _, unmatched = join_stage(journal, cost, master, id_map)
+        if len(unmatched):
+            counts = unmatched["区分"].value_counts(sort=False)
+            with st.expander("⚠ 結合できなかった取引コード（"
+                             + " / ".join(f"{k} {v:,} 件" for k, v in counts.items()) + "）"):
+                st.dataframe(unmatched, use_container_width=True, hide_index=True)
+                export_row("結合できなかった取引コード", unmatched)
+
+        # 月次売上 / 月次粗利
+        for title, name, df_p in [("📋 月次売上", "月次売上一覧", df_sales_p),
+                                  ("📋 月次粗利", "月次粗利一覧", df_profit_p)]:
+            st.subheader(title)
+            if grid_mode:
+                paged_grid(name, df_p, time_cols)
+            else:
+                st.dataframe(df_p, use_container_width=True,
+                             column_config=money_config(time_cols))
+            export_row(name, df_p)
+
+        # 3 表をまとめた Excel（1 表 1 シート）
+        file_download("💾 Excel（粗利集計 / 月次売上 / 月次粗利）",
+                      {"粗利集計": df_filtered, "月次売上一覧": df_sales_p,
+                       "月次粗利一覧": df_profit_p}, "xlsx", "プロジェクト収益.xlsx")
+        view_footer("月次", t0)
 
-    # 月次売上
-    st.subheader("📋 月次売上")
-    def _format(df):
-        for c in time_cols:
-            df[c] = df[c].map(lambda x: f"{int(x):,}")
-        return df
-    st.dataframe(_format(df_sales_p.copy()), use_container_width=True)
-    st.download_button("💾 月次売上一覧CSV",
-        data=df_sales_p.to_csv(index=False, encoding="cp932"),
-        file_name="月次売上一覧.csv")
-
-    # 月次粗利
-    st.subheader("📋 月次粗利")
-    st.dataframe(_format(df_profit_p.copy()), use_container_width=True)
-    st.download_button("💾 月次粗利一覧CSV",
-                       data=df_profit_p.to_csv(index=False, encoding="cp932"),
-                       file_name="月次粗利一覧.csv")    
-
-# ----- Utilization view ------------------------------------------------------
 # ----- Utilization view ------------------------------------------------------
-with tab3:
-    # ① 標準稼働時間
-    st.subheader("標準稼働時間 / 月")
-    if std_hours_row:
-        with st.expander("標準稼働時間", expanded=False):
-            st.caption("平日日数 × 8h")
-            st.table(pd.DataFrame([std_hours_row], index=["標準稼働時間(h)"]))
-    else:
-        st.info("稼働コストファイルに稼働時間が無いため利用率を計算できません。")
-
-    # ② 月次稼働時間とチャージャビリティ
-    if not util_hours_pivot.empty:
-        st.subheader("月次稼働時間 (h)")
-        st.dataframe(util_hours_pivot, use_container_width=True)
-
-        st.subheader("月次稼働率(%)")
-        pct_df = util_pct_pivot.copy()
-        for c in util_time_cols:
-            pct_df[c] = pct_df[c].map(lambda x: f"{x:.0%}")
-        st.dataframe(pct_df, use_container_width=True)
-
-        # ──────────── ここから詳細セクション ────────────
-        st.markdown("---")
-        st.subheader("コンサルタント別稼働率推移と詳細データ")
-
-        # プルダウンでコンサル選択
-        cons_col = util_hours_pivot.columns[0]
-        names    = sorted(util_hours_pivot[cons_col].unique())
-        sel      = st.selectbox("コンサルタントを選択", names)
-
-        # 折れ線グラフ：選択者のチャージャビリティ
-        sel_pct = util_pct_pivot.set_index(cons_col).loc[sel, util_time_cols]
-        df_chart = pd.DataFrame({"稼働率": sel_pct.values}, index=util_time_cols)
-        import altair as alt
-        chart = (
-            alt.Chart(df_chart.reset_index().melt("index"))
-               .mark_line(point=True)
-               .encode(
-                   x=alt.X("index:N", title="年月"),
-                   y=alt.Y("value:Q", axis=alt.Axis(format=".0%", title="稼働率")),
-                   color=alt.value("#1f77b4")
-               )
-               .properties(height=300)
-        )
-        st.altair_chart(chart, use_container_width=True)
-
-        # 詳細テーブル：該当コンサル×全月
-        df_detail = df_cost_raw.copy()
-        df_detail[date_c] = pd.to_datetime(df_detail[date_c], errors="coerce")
-        df_detail["稼働月-月次"] = df_detail[date_c].dt.strftime("%y/%m")
-
-        assign_c = detect_col(df_detail.columns,
-                              ["アサイン履歴名","assignhistory","history"])
-
-        df_det = df_detail[
-            (df_detail[cons_col] == sel) &
-            (df_detail["稼働月-月次"].isin(util_time_cols))
-        ].copy()
-
-        # 数値化 & フォーマット
-        df_det[hours_c] = pd.to_numeric(df_det[hours_c], errors="coerce").fillna(0)
-        df_det[cost_c]  = pd.to_numeric(df_det[cost_c], errors="coerce").fillna(0)
-        df_det["稼働時間"]   = df_det[hours_c].map(lambda x: f"{x:,}")
-        df_det["稼働コスト"] = df_det[cost_c].map(lambda x: f"{int(x):,}")
-
-        # 列順・ヘッダーを日本語化
-        df_det = df_det[["稼働月-月次", id_c, name_c, assign_c, "稼働時間", "稼働コスト"]]
-        df_det.columns = ["稼働月-月次","取引ID","会社名","アサイン履歴名","稼働時間","稼働コスト"]
-
-        st.dataframe(df_det, use_container_width=True)
-        # ──────────── 詳細セクション ここまで ────────────
+if tab3.open is not False:
+    with tab3:
+        t0 = time.perf_counter()
+        util_hours_pivot = pd.DataFrame()
+        util_pct_pivot   = pd.DataFrame()
+        std_hours_row    = {}
+        if df_cost_raw is not None:
+            util_res = view_data("Utilization", util_stage, cost,
+                                 f"{util_start:%Y-%m}" if util_start else None)
+            if util_res is not None:
+                util_hours_pivot, util_pct_pivot, std_hours_row, util_time_cols = util_res
+                gaps = pl.holiday_gaps(util_time_cols)
+                if gaps:
+                    st.warning(f"{pl.HOLIDAYS_PATH.name} に祝日が無い年の月があります（"
+                               + "、".join(gaps) + "）。これらの月の営業日数は土日のみを除いています。")
+            else:
+                st.warning("稼働コストに コンサル名 / 稼働時間 / 日付 列が見つかりません。")
+
+        # ① 標準稼働時間
+        st.subheader("標準稼働時間 / 月")
+        if std_hours_row:
+            with st.expander("標準稼働時間", expanded=False):
+                st.caption(f"営業日数（土日・祝日を除く）× {pl.STD_HOURS_PER_DAY}h"
+                           f"　祝日は {pl.HOLIDAYS_PATH.name} で設定")
+                st.table(pd.DataFrame([std_hours_row], index=["標準稼働時間(h)"]))
+        else:
+            st.info("稼働コストファイルに稼働時間が無いため利用率を計算できません。")
+
+        # ② 月次稼働時間とチャージャビリティ
+        if not util_hours_pivot.empty:
+            st.subheader("月次稼働時間 (h)")
+            st.dataframe(util_hours_pivot, use_container_width=True)
+
+            st.subheader("月次稼働率(%)")
+            pct_df = util_pct_pivot.copy()
+            pct_df[util_time_cols] *= 100
+            st.dataframe(pct_df, use_container_width=True, column_config={
+                c: st.column_config.NumberColumn(c, format="%.0f%%") for c in util_time_cols})
+
+            # ──────────── ここから詳細セクション ────────────
+            st.markdown("---")
+            st.subheader("コンサルタント別稼働率推移と詳細データ")
+
+            # プルダウンでコンサル選択
+            cons_col = util_hours_pivot.columns[0]
+            names    = sorted(util_hours_pivot[cons_col].unique())
+            sel      = st.selectbox("コンサルタントを選択", names)
+
+            # 折れ線グラフ：選択者のチャージャビリティ
+            sel_pct = util_pct_pivot.set_index(cons_col).loc[sel, util_time_cols]
+            df_chart = pd.DataFrame({"稼働率": sel_pct.values}, index=util_time_cols)
+            import altair as alt
+            chart = (
+                alt.Chart(df_chart.reset_index().melt("index"))
+                   .mark_line(point=True)
+                   .encode(
+                       x=alt.X("index:N", title="年月"),
+                       y=alt.Y("value:Q", axis=alt.Axis(format=".0%", title="稼働率")),
+                       color=alt.value("#1f77b4")
+                   )
+                   .properties(height=300)
+            )
+            st.altair_chart(chart, use_container_width=True)
+
+            # 詳細テーブル：該当コンサル×全月（索引の該当範囲だけを切り出す）
+            detail, bounds = view_data("Utilization", detail_stage, cost)
+            df_det = detail.iloc[slice(*bounds.get(sel, (0, 0)))]
+            df_det = df_det[df_det["稼働月-月次"].isin(util_time_cols)]
+
+            st.dataframe(df_det, use_container_width=True,
+                         column_config=money_config(["稼働時間","稼働コスト"]))
+            # ──────────── 詳細セクション ここまで ────────────
+
+        else:
+            st.info("利用率を計算できるデータがありません。")
+        view_footer("Utilization", t0)
 
-    else:
-        st.info("利用率を計算できるデータがありません。")
+# ──────────────────────────────────────────────
+# 診断パネル / 計測ログ
+# ──────────────────────────────────────────────
+finish_trace()
@@ -0,0 +1,139 @@
+"""
+重い再計算のバックグラウンド実行（Streamlit 非依存）
+入力のキーごとにジョブを 1 つだけワーカースレッドで実行し、同じキーの要求は実行中のジョブに合流する
+ジョブは進捗（割合 / メッセージ）を報告し、待っているセッションが居なくなれば取り消される
+取り消しはステージの区切り（計測区間の開始）とストリーミング読込のチャンクごとに確認する
+"""
+import time, threading
+from concurrent.futures import ThreadPoolExecutor
+
+import diagnostics
+
+JOB_WORKERS = 2                # 同時に実行するジョブ数
+JOB_KEEP    = 10 * 60          # 終了後に結果を保持する秒数（受け取られなければ破棄）
+
+
+class Cancelled(Exception):
+    """ジョブが取り消された"""
+
+
+class Job:
+    """1 件のバックグラウンド実行（進捗は fraction / message、結果は future）"""
+
+    def __init__(self, key, label=""):
+        self.key, self.label = key, label
+        self.fraction, self.message = 0.0, "待機中"
+        self.started, self.finished = time.time(), None
+        self.waiters = set()                    # 結果を待っているセッション
+        self.requests = 0                       # submit された回数（2 回目以降は合流）
+        self.trace = None                       # ワーカー側の計測記録（diagnostics.Trace）
+        self.reported = False                   # 計測記録を呼び出し側に引き渡し済みか
+        self._cancel = threading.Event()
+        self.future = None
+
+    def step(self, fraction=None, message=None):
+        """進捗を更新し、取り消されていれば Cancelled を送出"""
+        if fraction is not None:
+            self.fraction = min(max(fraction, 0.0), 1.0)
+        if message is not None:
+            self.message = message
+        if self._cancel.is_set():
+            raise Cancelled(self.key)
+
+    def cancel(self):
+        self._cancel.set()
+        self.future.cancel()                    # 待機中なら実行しない
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def failed(self) -> bool:
+        return self.done() and (self.future.cancelled() or self.future.exception() is not None)
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+
+_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="pf-job")
+_jobs = {}                        # キー → Job
+_lock = threading.Lock()
+_local = threading.local()        # ワーカースレッドで実行中の Job
+
+
+def current():
+    return getattr(_local, "job", None)
+
+
+def step(fraction=None, message=None):
+    """実行中のジョブの進捗を更新（ジョブの外では何もしない）"""
+    job = current()
+    if job is not None:
+        job.step(fraction, message)
+
+
+def _run(job: Job, fn, args):
+    _local.job = job
+    job.trace = diagnostics.begin(session=f"job:{job.label}")
+    job.trace.on_span = lambda stage: job.step(message=stage)
+    try:
+        job.step(0.0, "開始")
+        res = fn(*args)
+        job.step(1.0, "完了")
+        return res
+    finally:
+        job.finished = time.time()
+        job.trace.close()
+        _local.job = None
+
+
+def _evict(now):
+    for key, job in list(_jobs.items()):
+        if job.done() and (job.failed() or now - (job.finished or now) > JOB_KEEP):
+            del _jobs[key]
+
+
+def submit(key, fn, *args, label="", session=None) -> Job:
+    """
+    key のジョブを返す（実行中 / 終了済みがあればそれに合流、無ければ fn(*args) を投入）
+    session を渡すと待機セッションに加える（release で外す）
+    """
+    with _lock:
+        _evict(time.time())
+        job = _jobs.get(key)
+        if job is None or job.cancelled:
+            job = _jobs[key] = Job(key, label)
+            job.future = _pool.submit(_run, job, fn, args)
+        job.requests += 1
+        if session is not None:
+            job.waiters.add(session)
+    return job
+
+
+def release(key, session):
+    """session がジョブを待たなくなった → 待つセッションが居なくなれば取り消す"""
+    with _lock:
+        job = _jobs.get(key)
+        if job is None:
+            return
+        job.waiters.discard(session)
+        if not job.waiters and not job.done():
+            job.cancel()
+            del _jobs[key]
+
+
+def collect(key):
+    """結果を受け取ったジョブを一覧から外す（以降の同じ要求はステージキャッシュが返す）"""
+    with _lock:
+        job = _jobs.get(key)
+        if job is not None and job.done():
+            del _jobs[key]
+
+
+def running() -> list:
+    """実行中のジョブ（開始順）"""
+    with _lock:
+        return sorted((j for j in _jobs.values() if not j.done()), key=lambda j: j.started)
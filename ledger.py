@@ -0,0 +1,125 @@
+"""
+仕訳帳の差分取り込み（台帳）
+置換前の部門コード単位の累積集計と、取り込み済み仕訳行の指紋を保存しておき、
+新しいエクスポートは未取り込みの行だけを集計して畳み込む
+DealID 置換は台帳を読む時に集計結果へ適用するため、マッピング変更にも追従する
+"""
+import re, json, time, threading
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+
+import pipeline as pl
+import snapshots
+
+LEDGER_DIR = pl.CACHE_DIR / "ledgers"
+_lock = threading.Lock()
+
+
+def _paths(name: str) -> dict:
+    base = LEDGER_DIR / re.sub(r"[^\w\-]", "_", name or "default")
+    return {"dir": base, "state": base / "state.feather",
+            "fps": base / "fingerprints.npy", "meta": base / "meta.json"}
+
+
+def row_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    """
+    仕訳行の指紋（uint64）
+    行内容のハッシュに同一内容の出現順を加え、同じ仕訳が複数行あっても潰さない
+    """
+    cols = sorted(c for c in df.columns if c != pl.SOURCE_COL)   # 読込元の違いは同一行扱い
+    h = pd.util.hash_pandas_object(df[cols], index=False).to_numpy()
+    occ = pd.Series(h).groupby(h).cumcount().to_numpy()
+    return pd.util.hash_pandas_object(pd.DataFrame({"h": h, "n": occ}),
+                                      index=False).to_numpy()
+
+
+def ledger_meta(name: str):
+    """台帳のメタ情報（無ければ None）"""
+    try:
+        return json.loads(_paths(name)["meta"].read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def has_source(name: str, source_key: str) -> bool:
+    """その入力（内容ハッシュ）を取り込み済みか"""
+    meta = ledger_meta(name)
+    return bool(meta) and source_key in meta["sources"]
+
+
+def load_ledger(name: str):
+    """(累積集計, 指紋, メタ)。台帳が無ければ (None, 空配列, None)"""
+    p, meta = _paths(name), ledger_meta(name)
+    if meta is None:
+        return None, np.array([], dtype=np.uint64), None
+    return feather.read_table(p["state"], memory_map=True).to_pandas(), np.load(p["fps"]), meta
+
+
+def fold_journal(name: str, df_src: pd.DataFrame, source_key: str = "") -> dict:
+    """
+    仕訳帳（DealID 置換前）を台帳に畳み込む
+    戻り値: {"added": 追加行数, "skipped": 取り込み済みで除外した行数, "version": 台帳版数}
+    """
+    df_src["取引日"] = pd.to_datetime(df_src["取引日"], errors="coerce")
+    with _lock:
+        state, fps, meta = load_ledger(name)
+        meta = meta or {"version": 0, "rows": 0, "date_min": None,
+                        "date_max": None, "sources": []}
+        if source_key and source_key in meta["sources"]:
+            return {"added": 0, "skipped": len(df_src), "version": meta["version"]}
+
+        fp = row_fingerprints(df_src)
+        new = ~np.isin(fp, fps)
+        delta = df_src[new]
+        if len(delta):
+            part = pl.aggregate_lines(pl.journal_lines(delta), mergeable=True)
+            state = pl.merge_aggregates([state, part] if state is not None else [part])
+            fps = np.union1d(fps, fp[new])
+            dates = [d for d in (meta["date_min"], meta["date_max"]) if d] + \
+                    [delta["取引日"].min(), delta["取引日"].max()]
+            dates = [pd.Timestamp(d) for d in dates if pd.notna(d)]
+            meta.update(version=meta["version"] + 1, rows=meta["rows"] + len(delta),
+                        date_min=min(dates).isoformat() if dates else None,
+                        date_max=max(dates).isoformat() if dates else None)
+        if source_key:
+            meta["sources"].append(source_key)
+        meta["updated"] = time.time()
+        _save(name, state, fps, meta)
+    return {"added": int(new.sum()), "skipped": int((~new).sum()), "version": meta["version"]}
+
+
+def fold_snapshot(name: str, key: str) -> dict:
+    """
+    仕訳帳スナップショットを台帳に畳み込む（戻り値は fold_journal と同じ）
+    スナップショットはパース直後の行なので、アップロードから取り込んだ同じ行とは指紋が一致する
+    """
+    meta = snapshots.snapshot_meta("journal", key)
+    df_src = snapshots.load_snapshot("journal", key) if meta else None
+    if df_src is None:
+        raise ValueError("スナップショットが見つかりません（削除済みの可能性があります）。")
+    if not meta.get("raw"):
+        raise ValueError("DealID 置換済みの旧形式のスナップショットは台帳に取り込めません。"
+                         "元の仕訳帳をアップロードしてください。")
+    return fold_journal(name, df_src, key)
+
+
+def _save(name, state, fps, meta):
+    p = _paths(name)
+    p["dir"].mkdir(parents=True, exist_ok=True)
+    if state is not None:
+        feather.write_feather(state.reset_index(drop=True), p["state"].with_suffix(".tmp"))
+        p["state"].with_suffix(".tmp").replace(p["state"])
+    np.save(p["fps"].with_suffix(".tmp.npy"), fps)
+    p["fps"].with_suffix(".tmp.npy").replace(p["fps"])
+    p["meta"].write_text(json.dumps(meta, ensure_ascii=False), encoding="utf-8")
+
+
+def ledger_daily(name: str, id_map):
+    """台帳 → aggregate_journal と同じ形の集計（DealID 置換を適用）+ 取引日の範囲"""
+    state, _, meta = load_ledger(name)
+    if state is None or not meta["date_min"]:
+        raise ValueError("台帳にデータがありません。仕訳帳をアップロードしてください。")
+    codes = pl.remap_ids(state["取引コード"], id_map).astype(str).str.strip()
+    return (pl.merge_aggregates([state], codes).drop(columns=pl.MERGE_FLAG, errors="ignore"),
+            pd.Timestamp(meta["date_min"]), pd.Timestamp(meta["date_max"]))
@@ -0,0 +1,1080 @@
+"""
+プロジェクト収益パイプライン（Streamlit 非依存）
+仕訳帳 → daily → Utilization の各ステージを純粋関数として提供する
+"""
+import io, os, re, zipfile, codecs, contextlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+# ローカルキャッシュ（スナップショット等）のルート
+CACHE_DIR = Path(__file__).with_name(".pf_cache")
+
+# RecordID (B列) ➜ DealID (C列) のマッピングファイル（アプリと同じディレクトリ）
+ID_MAP_PATH = Path(__file__).with_name("id_map.csv")
+
+# 祝日ファイル（日付, 名称）: 標準稼働時間の営業日から除く。無ければ土日のみ除く
+HOLIDAYS_PATH = Path(__file__).with_name("holidays.csv")
+UTIL_START = "2024-01"        # Utilization の集計開始月（None で全期間）
+STD_HOURS_PER_DAY = 8
+ID_MAP_SCHEMA = [
+    (["recordid","レコードid"], str),
+    (["dealid","取引id"], str),
+]
+
+TARGET_COLS = ["貸方部門", "借方部門"]
+NULL_TOKENS = ["", "nan", "none"]      # normalize_id で欠損とみなす文字列
+EXPENSE_TARGETS = ["外注費", "交際費", "旅費交通費"]
+ENCODINGS = ("utf-8-sig", "cp932", "utf-8")
+SNIFF_BYTES = 64 * 1024    # 文字コード判定に使う先頭バイト数
+STREAM_DECODE_BYTES = 2**20  # 先頭で判定できないストリームを全体デコードするときのブロック
+CSV_ERROR = "CSV の読み込みに失敗しました。文字コードを確認してください。"
+STREAM_MEMORY_MB = 256     # ストリーミング読込の 1 チャンクあたりメモリ目安
+STREAM_EXPANSION = 8       # CSV 1 バイトあたりの DataFrame 上のメモリ（概算）
+STREAM_MERGE_EVERY = 16    # 部分集計をこのチャンク数ごとに畳み込む
+MERGE_FLAG = "_売上取引先"   # 部分集計の取引先が売上行由来か（merge_aggregates 用）
+SOURCE_COL = "ソースファイル"  # 複数ファイル結合時に付与する読込元の列
+
+# 稼働コスト CSV の列エイリアス（detect_col 用）
+COST_ALIASES = {
+    "id":     ["取引id","レコードid","recordid"],
+    "cost":   ["稼働コスト","人件費","cost"],
+    "name":   ["会社名","取引先","client","customer"],
+    "cons":   ["コンサルタント名","氏名","name"],
+    "hours":  ["稼働時間","hours","workinghours","h"],
+    "date":   ["稼働月-月次","稼働月 - 月次","稼働日","date"],
+    "assign": ["アサイン履歴名","assignhistory","history"],
+}
+
+# 取引マスタ CSV の列エイリアス（任意列 → daily 上の列名）
+MASTER_ID_ALIASES  = ["取引id","レコードid","recordid","dealid"]
+MASTER_AMT_ALIASES = ["金額","売上金額","見積金額","amount"]
+MASTER_OPTIONAL = [
+    (["取引先","会社名","customer","client"],"マスター取引先"),
+    (["取引名","案件名","dealname","title"],"取引名"),
+    (["取引担当者","担当者","owner","sales"],"取引担当者"),
+    (["industry","業界"],"Industry"),
+    (["industry詳細","industrydetail","業界詳細"],"Industry詳細"),
+    (["提案商材","proposal","product"],"提案商材")
+]
+
+# ── 読込スキーマ : (detect_col パターン, dtype) --------------------------------
+#   列に一致したものだけを usecols に入れ、dtype を宣言して読む
+#   dtype が "date" の列は読込時に日付化、None は型推論に任せる
+JOURNAL_SCHEMA = [
+    (["取引日"], "date"),
+    (["貸方勘定科目"], "category"), (["借方勘定科目"], "category"),
+    (["貸方部門"], "category"),     (["借方部門"], "category"),
+    (["貸方取引先名"], str),        (["借方取引先名"], str),
+    (["貸方金額"], "float64"),      (["借方金額"], "float64"),
+]
+COST_SCHEMA = [
+    (COST_ALIASES["id"], str),
+    (COST_ALIASES["cost"], "float64"),
+    (COST_ALIASES["name"], str),
+    (COST_ALIASES["cons"], str),
+    (COST_ALIASES["hours"], None),      # "8h" 等の表記ゆれは Utilization 側で数値化
+    (COST_ALIASES["date"], "date"),
+    (COST_ALIASES["assign"], str),
+]
+MASTER_SCHEMA = [
+    (MASTER_ID_ALIASES, str),
+    (MASTER_AMT_ALIASES, "float64"),
+    *[(src, str) for src, _ in MASTER_OPTIONAL],
+]
+
+
+# ──────────────────────────────────────────────
+# 共通ユーティリティ
+# ──────────────────────────────────────────────
+def detect_col(cols, patterns):
+    for p in patterns:
+        hits = [c for c in cols if re.sub(r"\s+", "", str(c)).casefold() == p]
+        if hits:
+            return hits[0]
+    return None
+
+
+def normalize_id(x):
+    if pd.isna(x):
+        return None
+    s = str(x).strip()
+    return None if s == "" or s.lower() in {"nan", "none"} else s
+
+
+# ── ID 列のベクトル処理 : ユニーク値だけを加工して codes で展開 -------------------
+def _factorize(s: pd.Series):
+    """(codes, uniques)。カテゴリ列は既存の codes / categories をそのまま使う"""
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.cat.codes.to_numpy(), s.cat.categories
+    return pd.factorize(s)
+
+
+def _take(values, codes, fill):
+    """values[codes]（codes == -1 は fill）"""
+    return np.append(np.asarray(values, dtype=object), fill)[codes]
+
+
+def _normalize_uniques(uniques) -> np.ndarray:
+    u = pd.Series(uniques, dtype=object).astype(str).str.strip()
+    out = u.to_numpy(dtype=object)
+    out[u.str.lower().isin(NULL_TOKENS).to_numpy()] = None
+    return out
+
+
+def normalize_ids(s: pd.Series) -> pd.Series:
+    """normalize_id のベクトル版（strip / 欠損トークン判定はユニーク値ごとに 1 回）"""
+    codes, uniques = _factorize(s)
+    return pd.Series(_take(_normalize_uniques(uniques), codes, None),
+                     index=s.index, name=s.name)
+
+
+def remap_ids(s: pd.Series, mapping) -> pd.Series:
+    """
+    mapping.get(normalize_id(x), x) のベクトル版（mapping は dict / Series）
+    辞書引きは部門コードのユニーク値ごとに 1 回。カテゴリ列はカテゴリのまま返す
+    """
+    codes, uniques = _factorize(s)
+    orig = pd.Series(uniques, dtype=object)
+    mapped = pd.Series(_normalize_uniques(uniques), dtype=object).map(mapping)
+    new_codes, new_uniques = pd.factorize(mapped.where(mapped.notna(), orig))
+    codes = np.append(new_codes, -1)[codes]
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return pd.Series(pd.Categorical.from_codes(codes, new_uniques),
+                         index=s.index, name=s.name)
+    return pd.Series(_take(new_uniques, codes, np.nan), index=s.index, name=s.name)
+
+
+def read_options(columns, schema) -> dict:
+    """スキーマ → pd.read_csv の usecols / dtype / parse_dates"""
+    usecols, dtype, dates = [], {}, []
+    for patterns, kind in schema:
+        c = detect_col(columns, patterns)
+        if c is None or c in usecols:
+            continue
+        usecols.append(c)
+        if kind == "date":
+            dates.append(c)
+        elif kind is not None:
+            dtype[c] = kind
+    return {"usecols": usecols, "dtype": dtype, "parse_dates": dates}
+
+
+def cost_columns(cols):
+    """稼働コスト CSV の列名を COST_ALIASES のキーで返す（無ければ None）"""
+    return {k: detect_col(cols, v) for k, v in COST_ALIASES.items()}
+
+
+# ── CSV / ZIP ローダ ---------------------------------------------------------
+def _as_buffer(data):
+    """bytes はコピーせず BytesIO で包み、バッファ / ファイルパスはそのまま返す"""
+    return io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+
+
+def zip_csv_members(data) -> list:
+    """ZIP 内の CSV メンバー名一覧（data はバイト列 / バイナリバッファ）"""
+    try:
+        with zipfile.ZipFile(_as_buffer(data)) as zf:
+            return [n for n in zf.namelist()
+                    if n.lower().endswith(".csv") and not n.endswith("/")]
+    except zipfile.BadZipFile:
+        raise ValueError("ZIP ファイルが壊れています。")
+
+
+def sniff_encoding(head: bytes, encodings=ENCODINGS) -> str:
+    """
+    先頭バイト列だけで文字コードを判定する
+    末尾で切れたマルチバイト文字は許容（インクリメンタルデコーダ）
+    """
+    for enc in encodings:
+        try:
+            codecs.getincrementaldecoder(enc)().decode(head, final=False)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(CSV_ERROR)
+
+
+def _parse_csv(opener, encodings, schema=None) -> pd.DataFrame:
+    """
+    opener() が返すバイナリストリームを文字コード指定で直接パースする
+    先頭 SNIFF_BYTES で判定した文字コードを優先し、デコード失敗時のみ残りを試す
+    schema 指定時はヘッダ行から列を解決し、必要列のみ型宣言付きで読む
+    """
+    with opener() as fp:
+        head = fp.read(SNIFF_BYTES)
+    enc = sniff_encoding(head, encodings)
+    for e in [enc] + [e for e in encodings if e != enc]:
+        try:
+            kw = {}
+            if schema is not None:
+                header = pd.read_csv(io.BytesIO(head.split(b"\n", 1)[0]), encoding=e, nrows=0)
+                kw = read_options(header.columns, schema)
+            try:
+                with opener() as fp:
+                    return pd.read_csv(fp, encoding=e, thousands=",", **kw) if kw \
+                           else pd.read_csv(fp, encoding=e)
+            except ValueError:
+                if not kw:
+                    raise
+                # 型宣言に合わない値 → 列指定のみで読み、数値化は後段に任せる
+                with opener() as fp:
+                    return pd.read_csv(fp, encoding=e, usecols=kw["usecols"])
+        except UnicodeError:
+            continue
+        except ValueError:
+            break
+    raise ValueError(CSV_ERROR)
+
+
+def chunk_rows_for(head: bytes, memory_mb=STREAM_MEMORY_MB) -> int:
+    """先頭サンプルの平均行長から、memory_mb に収まるチャンク行数を見積もる"""
+    line = max(len(head) / max(head.count(b"\n"), 1), 1)
+    return max(int(memory_mb * 2**20 / (line * STREAM_EXPANSION)), 1_000)
+
+
+def stream_encoding(opener, head: bytes, encodings=ENCODINGS) -> str:
+    """
+    ストリーミング読込の文字コード判定
+    先頭が ASCII のみだと候補を区別できないため、全体を候補順にインクリメンタルデコードし、
+    最後まで通った最初の候補を使う（_parse_csv のフォールバックと同じ順）
+    """
+    if not head.isascii():
+        return sniff_encoding(head, encodings)
+    for enc in encodings:
+        dec = codecs.getincrementaldecoder(enc)()
+        try:
+            with opener() as fp:
+                for block in iter(lambda: fp.read(STREAM_DECODE_BYTES), b""):
+                    dec.decode(block)
+            dec.decode(b"", final=True)
+            return enc
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(CSV_ERROR)
+
+
+def _iter_csv(opener, encodings, schema, memory_mb):
+    """opener() のストリームを memory_mb 目安のチャンクで順に読む"""
+    with opener() as fp:
+        head = fp.read(SNIFF_BYTES)
+    enc = stream_encoding(opener, head, encodings)
+    kw, floats = {}, []
+    if schema is not None:
+        header = pd.read_csv(io.BytesIO(head.split(b"\n", 1)[0]), encoding=enc, nrows=0)
+        kw = read_options(header.columns, schema)
+        # 数値列は途中のチャンクで型宣言に合わない値が出ても止めない（数値化は後段）
+        floats = [c for c, t in kw["dtype"].items() if t == "float64"]
+        kw["dtype"] = {c: t for c, t in kw["dtype"].items() if t != "float64"}
+    try:
+        with opener() as fp:
+            for chunk in pd.read_csv(fp, encoding=enc, thousands=",",
+                                     chunksize=chunk_rows_for(head, memory_mb), **kw):
+                # 一括読込（float64 宣言）と同じ型に揃える。数値化できない列はそのまま
+                for c in floats:
+                    try:
+                        chunk[c] = chunk[c].astype("float64")
+                    except (ValueError, TypeError):
+                        pass
+                yield chunk
+    except UnicodeError:
+        raise ValueError(CSV_ERROR)
+
+
+def _rewinder(buf):
+    """先頭から読み直したストリームを返す opener（ファイルパスは開き直す）"""
+    if isinstance(buf, Path):
+        return lambda: open(buf, "rb")
+
+    def rewind():
+        buf.seek(0)
+        return contextlib.nullcontext(buf)
+    return rewind
+
+
+def read_csv_chunks(data, name: str = "", member=None, encodings=ENCODINGS,
+                    schema=None, memory_mb=STREAM_MEMORY_MB):
+    """read_csv_bytes のチャンク版（全体を一度にメモリへ載せない）"""
+    buf = _as_buffer(data)
+    if name.lower().endswith(".zip"):
+        members = zip_csv_members(buf)
+        if not members:
+            raise ValueError("ZIP に CSV が見つかりません。")
+        with zipfile.ZipFile(buf) as zf:
+            yield from _iter_csv(lambda: zf.open(member or members[0]),
+                                 encodings, schema, memory_mb)
+        return
+
+    yield from _iter_csv(_rewinder(buf), encodings, schema, memory_mb)
+
+
+def read_csv_bytes(data, name: str = "", member=None,
+                   encodings=ENCODINGS, schema=None) -> pd.DataFrame:
+    """
+    ① CSV ② ZIP 内 CSV（member、省略時は先頭）を DataFrame で返す
+    data はバイト列 / バイナリバッファ / ファイルパス。str への全体デコードは行わない
+    schema（JOURNAL_SCHEMA 等）指定時は必要列のみを型宣言付きで読む
+    """
+    buf = _as_buffer(data)
+
+    # ZIP : メンバーを展開ストリームのまま読む
+    if name.lower().endswith(".zip"):
+        members = zip_csv_members(buf)
+        if not members:
+            raise ValueError("ZIP に CSV が見つかりません。")
+        with zipfile.ZipFile(buf) as zf:
+            return _parse_csv(lambda: zf.open(member or members[0]), encodings, schema)
+
+    # 通常 CSV
+    return _parse_csv(_rewinder(buf), encodings, schema)
+
+
+def _raw_bytes(data):
+    """バッファ → bytes（並列読込ではスレッドごとに独立した BytesIO で包む）"""
+    if isinstance(data, (bytes, bytearray)):
+        return data
+    if isinstance(data, Path):
+        return data.read_bytes()
+    if hasattr(data, "getvalue"):
+        return data.getvalue()
+    data.seek(0)
+    return data.read()
+
+
+def concat_frames(frames, names) -> pd.DataFrame:
+    """
+    列構成を確認して縦結合し、読込元（names）を SOURCE_COL に付与する
+    カテゴリ列はカテゴリを和集合に揃えてカテゴリのまま結合する
+    """
+    cols = list(frames[0].columns)
+    for df, name in zip(frames[1:], names[1:]):
+        if set(df.columns) != set(cols):
+            lack, extra = set(cols) - set(df.columns), set(df.columns) - set(cols)
+            raise ValueError(f"{name} の列構成が {names[0]} と一致しません"
+                             f"（不足: {', '.join(lack) or 'なし'} / 余分: {', '.join(extra) or 'なし'}）")
+    cats = {c: pd.CategoricalDtype(pd.api.types.union_categoricals(
+                [df[c] for df in frames], ignore_order=True).categories)
+            for c in cols if all(isinstance(df[c].dtype, pd.CategoricalDtype) for df in frames)}
+    out = pd.concat([df[cols].astype(cats) for df in frames], ignore_index=True)
+    out[SOURCE_COL] = pd.Categorical(np.repeat(np.asarray(names, dtype=object),
+                                               [len(df) for df in frames]))
+    return out
+
+
+def read_csv_many(items, schema=None, max_workers=None) -> pd.DataFrame:
+    """
+    複数の CSV / ZIP メンバーをスレッドプールで並列に読み、concat_frames で結合
+    items は (data, name, member, encodings) の列。読込元の名前は ZIP メンバー名を優先
+    """
+    raws, jobs = {}, []
+    for data, name, member, encodings in items:
+        if id(data) not in raws:
+            raws[id(data)] = _raw_bytes(data)
+        jobs.append((raws[id(data)], name, member, encodings))
+    workers = max_workers or min(len(jobs), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        frames = list(ex.map(lambda j: read_csv_bytes(*j, schema=schema), jobs))
+    return concat_frames(frames, [member or name for _, name, member, _ in jobs])
+
+
+# ──────────────────────────────────────────────
+# DealID マッピングストア
+#   RecordID を index に持つ Series として保持し、remap_ids の辞書引きに使う
+# ──────────────────────────────────────────────
+_id_map_cache = {}    # path → (mtime_ns, Series)
+
+
+def read_id_map(data, name: str = "") -> pd.Series:
+    """マッピング CSV（RecordID, DealID）→ RecordID を index とする Series"""
+    df = read_csv_bytes(data, name, schema=ID_MAP_SCHEMA)
+    rec_c = detect_col(df.columns, ID_MAP_SCHEMA[0][0])
+    deal_c = detect_col(df.columns, ID_MAP_SCHEMA[1][0])
+    if not (rec_c and deal_c):
+        raise ValueError("マッピング CSV に RecordID / DealID 列が見つかりません。")
+    m = pd.Series(normalize_ids(df[deal_c]).to_numpy(),
+                  index=normalize_ids(df[rec_c]).to_numpy(), name="DealID")
+    m = m[m.index.notna() & m.notna()]
+    m = m[~m.index.duplicated(keep="last")]
+    m.index.name = "RecordID"
+    return m
+
+
+def load_id_map(path=ID_MAP_PATH) -> pd.Series:
+    """マッピングファイルを読込（プロセス内で保持し、mtime が変わった時だけ再読込）"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return read_id_map(b"RecordID,DealID\n")
+    hit = _id_map_cache.get(str(path))
+    if hit and hit[0] == mtime:
+        return hit[1]
+    with open(path, "rb") as fp:
+        m = read_id_map(fp, str(path))
+    _id_map_cache[str(path)] = (mtime, m)
+    return m
+
+
+def merge_id_maps(base: pd.Series, extra: pd.Series) -> pd.Series:
+    """extra を優先して結合"""
+    m = pd.concat([base, extra])
+    return m[~m.index.duplicated(keep="last")]
+
+
+def save_id_map(m: pd.Series, path=ID_MAP_PATH):
+    """マッピングファイルへ書き出し（一時ファイル経由で置換）"""
+    tmp = Path(f"{path}.tmp")
+    m.sort_index().to_csv(tmp, encoding="utf-8", index_label="RecordID", header=["DealID"])
+    os.replace(tmp, path)
+
+
+# ──────────────────────────────────────────────
+# 仕訳帳ステージ
+# ──────────────────────────────────────────────
+def prepare_journal(df_src: pd.DataFrame, id_map=None) -> pd.DataFrame:
+    """取引日の日付化と RecordID → DealID 置換（省略時はマッピングファイル）"""
+    id_map = load_id_map() if id_map is None else id_map
+    df_src["取引日"] = pd.to_datetime(df_src["取引日"], errors="coerce")
+    for col in TARGET_COLS:
+        if col in df_src.columns:
+            df_src[col] = remap_ids(df_src[col], id_map)
+    return df_src
+
+
+def journal_chunks(items, id_map=None, memory_mb=STREAM_MEMORY_MB, progress=None):
+    """
+    巨大な仕訳帳をチャンクごとに読み、対象勘定科目の行へ絞って prepare_journal する
+    items は (data, name, member, encodings) の列（複数ファイルは順に読む）
+    progress を渡すとチャンクごとに progress(ファイル番号, ファイル数, 読んだ行数) を呼ぶ
+    yield: (絞り込み後のチャンク（空もある）, 絞り込み前の取引日の最小, 最大)
+    """
+    id_map = load_id_map() if id_map is None else id_map
+    items = list(items)
+    cols, rows = None, 0
+    for i, (data, name, member, encodings), chunk in (
+            (i, it, c) for i, it in enumerate(items)
+            for c in read_csv_chunks(*it, schema=JOURNAL_SCHEMA, memory_mb=memory_mb)):
+        rows += len(chunk)
+        if progress is not None:
+            progress(i, len(items), rows)
+        if cols is None:
+            cols = set(chunk.columns)
+        elif set(chunk.columns) != cols:
+            raise ValueError(f"{member or name} の列構成が他の仕訳帳と一致しません。")
+        dates = pd.to_datetime(chunk["取引日"], errors="coerce")
+        keep = (chunk.get("貸方勘定科目") == "売上高") | \
+               (chunk.get("借方勘定科目").isin(EXPENSE_TARGETS))
+        yield prepare_journal(chunk[keep].copy(), id_map), dates.min(), dates.max()
+    if cols is None:
+        raise ValueError(CSV_ERROR)
+
+
+def stream_journal(items, id_map=None, memory_mb=STREAM_MEMORY_MB, progress=None):
+    """
+    巨大な仕訳帳をチャンクごとに 対象勘定科目の行へ絞り → 集計し、部分集計を畳み込む
+    引数は journal_chunks と同じ
+    戻り値は aggregate_journal と同じ形の集計 + 取引日の最小 / 最大
+    """
+    parts, d_min, d_max = [], pd.NaT, pd.NaT
+    for chunk, lo, hi in journal_chunks(items, id_map, memory_mb, progress):
+        d_min = min(d_min, lo) if pd.notna(d_min) else lo
+        d_max = max(d_max, hi) if pd.notna(d_max) else hi
+        if len(chunk):
+            parts.append(aggregate_lines(journal_lines(chunk), mergeable=True))
+        if len(parts) >= STREAM_MERGE_EVERY:
+            parts = [merge_aggregates(parts)]
+    if not parts:
+        parts = [aggregate_journal(chunk)]
+    return merge_aggregates(parts).drop(columns=MERGE_FLAG, errors="ignore"), d_min, d_max
+
+
+def journal_lines(df_src: pd.DataFrame) -> pd.DataFrame:
+    """売上・費用の仕訳行を 取引コード / 取引先 / 勘定科目 / 金額 / 日付 に整形"""
+    df_sales = df_src[df_src.get("貸方勘定科目") == "売上高"].copy()
+    df_sales_out = pd.DataFrame({
+        "取引コード": df_sales["貸方部門"].astype(str).str.strip(),
+        "取引先": df_sales["貸方取引先名"],
+        "勘定科目": "売上高",
+        "金額": pd.to_numeric(df_sales["貸方金額"], errors="coerce").fillna(0),
+        "日付": df_sales["取引日"]
+    })
+
+    df_exp = df_src[df_src.get("借方勘定科目").isin(EXPENSE_TARGETS)].copy()
+    df_exp_out = pd.DataFrame({
+        "取引コード": df_exp["借方部門"].astype(str).str.strip(),
+        "取引先": df_exp["借方取引先名"],
+        "勘定科目": df_exp["借方勘定科目"],
+        "金額": pd.to_numeric(df_exp["借方金額"], errors="coerce").fillna(0),
+        "日付": df_exp["取引日"]
+    })
+    return pd.concat([df_sales_out, df_exp_out], ignore_index=True)
+
+
+def aggregate_journal(df_src: pd.DataFrame) -> pd.DataFrame:
+    """売上・費用を取引コード単位に集計（勘定科目別金額 + 日付最小/最大 + 取引先）"""
+    return aggregate_lines(journal_lines(df_src))
+
+
+def aggregate_lines(combo: pd.DataFrame, mergeable=False) -> pd.DataFrame:
+    """
+    journal_lines の行 → 取引コード単位の集計
+    mergeable=True では取引先が売上行由来かを MERGE_FLAG 列に残す（merge_aggregates 用）
+    """
+    daily = (combo.pivot_table(index="取引コード", columns="勘定科目",
+                               values="金額", aggfunc="sum",
+                               fill_value=0)
+             .reset_index())
+    meta = (combo.groupby("取引コード")
+                 .agg({"日付":["min","max"],"取引先":"first"}).reset_index())
+    meta.columns = ["取引コード","日付（最小）","日付（最大）","取引先"]
+    if mergeable:
+        flag = (combo["勘定科目"] == "売上高") & combo["取引先"].notna()
+        meta[MERGE_FLAG] = meta["取引コード"].map(flag.groupby(combo["取引コード"]).any())
+    daily = daily.merge(meta, on="取引コード", how="left")
+    if "売上高" not in daily.columns:
+        daily["売上高"] = 0
+    return daily
+
+
+def merge_aggregates(parts, codes=None) -> pd.DataFrame:
+    """
+    取引コード単位の部分集計（aggregate_lines の出力）を 1 つに畳み込む
+    金額は合計、日付は最小 / 最大
+    取引先は aggregate_journal と同じく売上行由来を優先し、その中で先に現れた値を残す
+    codes を渡すと結合前に 取引コード を置き換える（DealID 置換後の再集計）
+    """
+    df = pd.concat(parts, ignore_index=True)
+    if codes is not None:
+        df["取引コード"] = np.asarray(codes, dtype=object)
+    agg = {"日付（最小）": "min", "日付（最大）": "max", "取引先": "first"}
+    if MERGE_FLAG in df.columns:
+        df[MERGE_FLAG] = df[MERGE_FLAG].fillna(False).astype(bool)
+        df = df.sort_values(MERGE_FLAG, ascending=False, kind="stable")
+        agg[MERGE_FLAG] = "max"
+    amounts = sorted(c for c in df.columns if c in ["売上高", *EXPENSE_TARGETS])
+    out = (df.groupby("取引コード", as_index=False)
+             .agg({**{c: "sum" for c in amounts}, **agg}))
+    if "売上高" not in out.columns:
+        out["売上高"] = 0
+    return out
+
+
+# ──────────────────────────────────────────────
+# 取引マスタ / 稼働コスト ステージ
+# ──────────────────────────────────────────────
+def prepare_master(df_master: pd.DataFrame) -> pd.DataFrame:
+    """取引マスタ CSV の列名整形と 取引 ID の正規化・金額の数値化"""
+    df_master.columns = df_master.columns.map(str.strip)
+    id_col  = detect_col(df_master.columns, MASTER_ID_ALIASES)
+    amt_col = detect_col(df_master.columns, MASTER_AMT_ALIASES)
+    if id_col:
+        df_master[id_col]  = normalize_ids(df_master[id_col])
+    if amt_col:
+        df_master[amt_col] = pd.to_numeric(df_master[amt_col], errors="coerce").fillna(0)
+    return df_master
+
+
+def build_master_map(df_master: pd.DataFrame):
+    """取引マスタ（prepare_master 済み）→ 取引コード単位の補完テーブル（ID / 金額列が無ければ None）"""
+    id_col  = detect_col(df_master.columns, MASTER_ID_ALIASES)
+    amt_col = detect_col(df_master.columns, MASTER_AMT_ALIASES)
+    if not (id_col and amt_col):
+        return None
+    keep = {id_col:"取引コード", amt_col:"マスター金額"}
+    for src, dst in MASTER_OPTIONAL:
+        c = detect_col(df_master.columns, src)
+        if c: keep[c] = dst
+    return (df_master[list(keep)]
+            .dropna(subset=[id_col])
+            .rename(columns=keep)
+            .drop_duplicates(subset=["取引コード"]))
+
+
+def prepare_cost(df_cost_raw: pd.DataFrame) -> pd.DataFrame:
+    """稼働コスト CSV の列名整形と取引 ID の正規化・コストの数値化"""
+    df_cost_raw.columns = df_cost_raw.columns.map(str.strip)
+    cc = cost_columns(df_cost_raw.columns)
+    if cc["id"]:
+        df_cost_raw[cc["id"]] = normalize_ids(df_cost_raw[cc["id"]])
+    if cc["cost"]:
+        df_cost_raw[cc["cost"]] = pd.to_numeric(df_cost_raw[cc["cost"]], errors="coerce")
+    return df_cost_raw
+
+
+def build_cost_info(df_cost_raw: pd.DataFrame):
+    """取引コード単位の人件費（ID / コスト列が無ければ None）"""
+    cc = cost_columns(df_cost_raw.columns)
+    id_c, cost_c, name_c = cc["id"], cc["cost"], cc["name"]
+    if not (id_c and cost_c):
+        return None
+    df_cost = df_cost_raw.dropna(subset=[id_c]).copy()
+    df_cost["人件費"] = pd.to_numeric(df_cost[cost_c], errors="coerce").fillna(0)
+    agg = {"人件費":"sum"}
+    if name_c: agg[name_c] = "first"
+    return (df_cost.groupby(id_c, as_index=False)
+                   .agg(agg)
+                   .rename(columns={
+                        id_c:   "取引コード",
+                        cost_c: "人件費",
+                        **({name_c: "稼働取引先"} if name_c else {})
+                   }))
+
+
+# ──────────────────────────────────────────────
+# daily 組み立て
+# ──────────────────────────────────────────────
+def build_daily(daily: pd.DataFrame, cost_info=None, master_map=None) -> pd.DataFrame:
+    """仕訳帳集計に 人件費 / マスタ補完 / 指標 を付与（取引コード → レコードID）"""
+    return compute_metrics(join_deals(daily, cost_info, master_map)[0])
+
+
+# ── 取引キー索引 -------------------------------------------------------------
+#   仕訳帳集計 / 人件費 / マスタの 取引コード を 1 つの共通カテゴリに揃え、
+#   各表の行位置を整数コードで引いて列を並べる（文字列キーのハッシュ結合をしない）
+UNMATCHED_KINDS = {
+    "cost":   "人件費なし",              # 仕訳帳にあり稼働コストに無い
+    "master": "マスタなし",              # 仕訳帳にあり取引マスタに無い
+    "cost_only":   "仕訳なし（稼働コスト）",
+    "master_only": "仕訳なし（取引マスタ）",
+}
+
+
+def deal_key_index(*keys):
+    """
+    各表の 取引コード（正規化済み）を 1 回の factorize で共通カテゴリに揃える
+    戻り値: (カテゴリ, [表ごとの整数コード（欠損は -1）])
+    """
+    codes, cats = pd.factorize(np.concatenate([k.to_numpy(dtype=object) for k in keys]))
+    return cats, np.split(codes, np.cumsum([len(k) for k in keys])[:-1])
+
+
+def _positions(n_cats: int, codes: np.ndarray) -> np.ndarray:
+    """カテゴリ → その表の行位置（表に無いカテゴリは -1）。表のキーは一意であること"""
+    pos = np.full(n_cats + 1, -1)                # 末尾 = 欠損キー（-1）の行き先
+    pos[codes[codes >= 0]] = np.flatnonzero(codes >= 0)
+    return pos
+
+
+def _unmatched(cats, codes: np.ndarray, sides: dict) -> pd.DataFrame:
+    """sides = {"cost" / "master": その表の整数コード} → 結合できなかった 取引コード [取引コード, 区分]"""
+    in_daily = np.zeros(len(cats), dtype=bool)
+    in_daily[codes[codes >= 0]] = True
+    found = []
+    for side, t_codes in sides.items():
+        has = _positions(len(cats), t_codes)[:-1] >= 0
+        found += [(cats[in_daily & ~has], UNMATCHED_KINDS[side]),
+                  (cats[has & ~in_daily], UNMATCHED_KINDS[f"{side}_only"])]
+    return pd.DataFrame({
+        "取引コード": np.concatenate([k for k, _ in found] or [np.array([], dtype=object)]),
+        "区分": np.repeat([u for _, u in found], [len(k) for k, _ in found]).astype(object),
+    })
+
+
+def unmatched_keys(keys, side_keys: dict) -> pd.DataFrame:
+    """
+    join_deals の 結合できなかった 取引コード をキーの列だけから求める（SQL バックエンド用）
+    keys は仕訳帳集計の並びの正規化済みキー、side_keys は {"cost" / "master": その表のキー（一意）}
+    """
+    cats, (codes, *side_codes) = deal_key_index(keys, *side_keys.values())
+    return _unmatched(cats, codes, dict(zip(side_keys, side_codes)))
+
+
+def join_deals(daily: pd.DataFrame, cost_info=None, master_map=None):
+    """
+    仕訳帳集計に 人件費（稼働コスト）とマスタ補完を結合（指標計算の前段）
+    戻り値: (結合後の表, 結合できなかった 取引コード の表 [取引コード, 区分])
+    列の並びと値は 取引コード での left merge と同じ
+    """
+    daily = daily.reset_index(drop=True)
+    keys = normalize_ids(daily["取引コード"])
+    sides = {k: t for k, t in (("cost", cost_info), ("master", master_map)) if t is not None}
+    cats, (codes, *side_codes) = deal_key_index(keys, *(t["取引コード"] for t in sides.values()))
+    if cost_info is None:
+        daily["人件費"] = 0
+
+    for table, t_codes in zip(sides.values(), side_codes):
+        rows = _positions(len(cats), t_codes)[codes]    # daily の各行 → table の行（無ければ -1）
+        for c in table.columns.drop("取引コード"):
+            daily[c] = pd.Series(table[c].array.take(rows, allow_fill=True), index=daily.index)
+    unmatched = _unmatched(cats, codes, dict(zip(sides, side_codes)))
+
+    if cost_info is not None:
+        daily["取引コード"] = keys                   # 列の正規化は従来どおり人件費の結合時のみ
+
+    # マスタ補完
+    if master_map is not None:
+        need_fix = daily["売上高"] == 0
+        daily.loc[need_fix, "売上高"] = daily.loc[need_fix, "マスター金額"]
+        if "稼働取引先" in daily.columns:
+            has_cost_name = daily["稼働取引先"].notna()
+            daily.loc[need_fix & has_cost_name, "取引先"] = \
+                daily.loc[need_fix & has_cost_name, "稼働取引先"]
+    return daily, unmatched
+
+
+def compute_metrics(daily: pd.DataFrame) -> pd.DataFrame:
+    """指標計算（月数・月次売上・粗利・粗利率）"""
+    for c in ["売上高","外注費","交際費","旅費交通費","人件費"]:
+        if c not in daily.columns:
+            daily[c] = 0
+        daily[c] = pd.to_numeric(daily[c], errors="coerce").fillna(0)
+    d_min, d_max = daily["日付（最小）"].dt, daily["日付（最大）"].dt
+    months = ((d_max.year - d_min.year)*12 + (d_max.month - d_min.month) + 1).clip(lower=1)
+    sales = daily["売上高"]
+    daily["月数"] = months
+    daily["月次売上"] = np.where(months != 0, sales / months.where(months != 0, 1), 0)
+    daily["粗利"] = (sales - daily["外注費"] - daily["交際費"]
+                     - daily["旅費交通費"] - daily["人件費"])
+    daily["粗利率"] = np.where(sales > 0, daily["粗利"] / sales.where(sales > 0, 1) * 100, 0)
+    return daily.rename(columns={"取引コード":"レコードID"})
+
+
+# ──────────────────────────────────────────────
+# フィルター索引
+#   daily から一度だけ作り、フィルター変更時は配列演算だけでマスクを作る
+# ──────────────────────────────────────────────
+FILTER_CAT_COLS = ["取引担当者", "Industry", "Industry詳細"]
+
+
+def build_filter_index(daily: pd.DataFrame) -> dict:
+    """
+    レコードID : 改行区切りで連結した検索用文字列と各 ID の開始位置
+    日付       : 日単位の int64 序数（NaT は valid=False）
+    属性列     : カテゴリコード（欠損は -1）と選択肢
+    """
+    ids = daily["レコードID"]
+    has_id = ids.notna().to_numpy()
+    id_strs = ids.astype(str).where(has_id, "").tolist()
+    starts = np.cumsum([0] + [len(s) + 1 for s in id_strs[:-1]]) if id_strs else np.array([], int)
+
+    d_min = daily["日付（最小）"].to_numpy(dtype="datetime64[D]")
+    d_max = daily["日付（最大）"].to_numpy(dtype="datetime64[D]")
+
+    cats = {}
+    for c in FILTER_CAT_COLS:
+        if c in daily.columns:
+            codes, uniques = pd.factorize(daily[c])
+            cats[c] = {"codes": codes, "values": list(uniques),
+                       "options": sorted(uniques)}
+    return {
+        "n": len(daily), "id_text": "\n".join(id_strs), "id_starts": starts,
+        "has_id": has_id,
+        "d_min": d_min.astype(np.int64), "d_max": d_max.astype(np.int64),
+        "d_valid": ~(np.isnat(d_min) | np.isnat(d_max)),
+        "cats": cats,
+    }
+
+
+def filter_mask(index: dict, id_query: str, start_date, end_date,
+                selections: dict) -> np.ndarray:
+    """
+    レコードID 部分一致（正規表現ではなくリテラル）× 期間重なり × 属性の複数選択
+    selections : {列名: 選択値リスト}（空リストは絞り込まない）
+    """
+    mask = index["has_id"].copy()
+    if id_query:
+        hit = np.zeros(index["n"], dtype=bool)
+        text, starts = index["id_text"], index["id_starts"]
+        pos = [m.start() for m in re.finditer(re.escape(id_query), text)]
+        hit[np.searchsorted(starts, pos, side="right") - 1] = True
+        mask &= hit
+
+    start = np.datetime64(start_date, "D").astype(np.int64)
+    end   = np.datetime64(end_date, "D").astype(np.int64)
+    mask &= index["d_valid"] & (index["d_max"] >= start) & (index["d_min"] <= end)
+
+    for c, sel in selections.items():
+        if sel and c in index["cats"]:
+            cat = index["cats"][c]
+            lut = np.zeros(len(cat["values"]) + 1, dtype=bool)   # 末尾 = 欠損(-1)
+            lut[[i for i, v in enumerate(cat["values"]) if v in set(sel)]] = True
+            mask &= lut[cat["codes"]]
+    return mask
+
+
+# ──────────────────────────────────────────────
+# 月次展開
+# ──────────────────────────────────────────────
+def expand_monthly(df: pd.DataFrame, start_date, end_date):
+    """
+    案件を 日付（最小）から 月数 ヶ月分に展開し、期間内の月だけを集計する
+    （各月の日付は 日付（最小）の日、月末を超える場合は月末）
+    戻り値: (df_sales_p, df_profit_p, count_series, time_cols)
+    """
+    n, sales, profit = monthly_values(df)
+    row = np.repeat(np.arange(len(df)), n)
+    offset = np.arange(row.size) - np.repeat(np.cumsum(n) - n, n)
+
+    # 月のオフセットを月序数（datetime64[M]）で加算し、日を月末でクリップ
+    d_min = df["日付（最小）"].to_numpy(dtype="datetime64[D]")[row]
+    month = d_min.astype("datetime64[M]") + offset
+    days_in_month = ((month + 1).astype("datetime64[D]")
+                     - month.astype("datetime64[D]")).astype(np.int64)
+    day = (d_min - d_min.astype("datetime64[M]").astype("datetime64[D]")).astype(np.int64)
+    dt_m = month.astype("datetime64[D]") + np.minimum(day, days_in_month - 1)
+
+    keep = ((dt_m >= np.datetime64(start_date, "D")) &
+            (dt_m <= np.datetime64(end_date, "D")))
+    row, month = row[keep], month[keep]
+
+    # 年月表示はユニークな月だけ整形
+    months, month_codes = np.unique(month, return_inverse=True)
+    labels = pd.DatetimeIndex(months).strftime("%y/%m").to_numpy()
+
+    long = pd.DataFrame({
+        "レコードID": df["レコードID"].to_numpy()[row],
+        "取引先":     df["取引先"].to_numpy()[row],
+        "年月表示":   labels[month_codes],
+        "月次売上":   sales[row],
+        "月次粗利":   profit[row],
+    })
+    time_cols = labels.tolist()
+    df_sales_p, df_profit_p = pivot_monthly(long, time_cols)
+    count_series = (long[long["月次売上"] > 0]
+                    .groupby("年月表示")["レコードID"].nunique()
+                    .reindex(time_cols, fill_value=0))
+    return df_sales_p, df_profit_p, count_series, time_cols
+
+
+def monthly_values(df: pd.DataFrame):
+    """案件ごとの (月数, 1 ヶ月あたりの売上, 粗利)。どちらも円単位に丸める"""
+    n = df["月数"].fillna(0).to_numpy(dtype=np.int64)
+    sales  = np.round(df["月次売上"].to_numpy(dtype=float))
+    profit = np.where(n != 0, np.round(df["粗利"].to_numpy(dtype=float)
+                                       / np.where(n != 0, n, 1)), 0)
+    return n, sales, profit
+
+
+def pivot_monthly(long: pd.DataFrame, time_cols):
+    """月次の縦持ち（レコードID / 取引先 / 年月表示 / 月次売上 / 月次粗利）→ (月次売上, 月次粗利) の横持ち"""
+    wide = (long.groupby(["レコードID","取引先","年月表示"])[["月次売上","月次粗利"]]
+                .mean()
+                .unstack("年月表示", fill_value=0))
+    return [
+        wide[v].reindex(columns=time_cols, fill_value=0).reset_index()
+        if not wide.empty else
+        pd.DataFrame(columns=["レコードID","取引先", *time_cols]).astype({c: float for c in time_cols})
+        for v in ("月次売上","月次粗利")
+    ]
+
+
+def monthly_summary(df_p: pd.DataFrame, time_cols, labels) -> pd.DataFrame:
+    """月次テーブルの 合計 / 平均 の 2 行（数値のまま、labels は 取引先 列に入る。月が無ければラベルのみ）"""
+    s = df_p[time_cols].astype(float).agg(["sum","mean"]).reset_index(drop=True) \
+        if len(time_cols) else pd.DataFrame(index=range(2))
+    s.insert(0, "取引先", labels)
+    s.insert(0, "レコードID", "")
+    return s
+
+
+# ──────────────────────────────────────────────
+# Utilization ステージ
+# ──────────────────────────────────────────────
+def load_holidays(path=HOLIDAYS_PATH) -> np.ndarray:
+    """祝日ファイル → datetime64[D] の配列（ファイルが無ければ空）"""
+    try:
+        with open(path, "rb") as fp:
+            df = read_csv_bytes(fp, str(path))
+    except FileNotFoundError:
+        return np.array([], dtype="datetime64[D]")
+    d = pd.to_datetime(df.iloc[:, 0], errors="coerce").dropna()
+    return np.unique(d.to_numpy().astype("datetime64[D]"))
+
+
+def business_days(months: np.ndarray, holidays=None) -> np.ndarray:
+    """datetime64[M] の各月の営業日数（土日 + holidays を除く）"""
+    holidays = load_holidays() if holidays is None else holidays
+    first = months.astype("datetime64[D]")
+    return np.busday_count(first, (months + 1).astype("datetime64[D]"), holidays=holidays)
+
+
+def holiday_gaps(time_cols, holidays=None) -> list:
+    """
+    time_cols（"%y/%m"）のうち、祝日ファイルの対象年（最初〜最後の祝日の年）から外れる月
+    これらの月の営業日数は土日だけを除いた値になる
+    """
+    holidays = load_holidays() if holidays is None else holidays
+    if not len(holidays):
+        return list(time_cols)
+    years = holidays.astype("datetime64[Y]").astype(np.int64) + 1970
+    return [c for c in time_cols
+            if not years.min() <= 2000 + int(c[:2]) <= years.max()]
+
+
+def parse_hours(s: pd.Series) -> np.ndarray:
+    """稼働時間の表記ゆれ（"8h" 等）を数値化（数字と . 以外を除去、空は 0）。ユニーク値ごとに 1 回"""
+    codes, uniques = _factorize(s)
+    u = (pd.Series(uniques, dtype=object).astype(str)
+           .str.replace(r"[^\d\.]", "", regex=True).replace("", "0").astype(float))
+    return np.append(u.to_numpy(), 0.0)[codes]
+
+
+def build_utilization(df_cost_raw: pd.DataFrame, start=UTIL_START, holidays=None):
+    """
+    コンサル × 月 の稼働時間 / 標準稼働時間 / チャージャビリティ
+    start（"YYYY-MM"、None で全期間）以降の、データがある月を対象にする
+    標準稼働時間 = 営業日数（土日・祝日を除く）× STD_HOURS_PER_DAY
+    戻り値: (util_hours_pivot, util_pct_pivot, std_hours_row, util_time_cols)
+            必要列が無ければ None
+    """
+    cc = cost_columns(df_cost_raw.columns)
+    cons_c, hours_c, date_c = cc["cons"], cc["hours"], cc["date"]
+    if not (cons_c and hours_c and date_c):
+        return None
+
+    hours = parse_hours(df_cost_raw[hours_c])
+    months = pd.to_datetime(df_cost_raw[date_c], errors="coerce").to_numpy().astype("datetime64[M]")
+    keep = ~np.isnat(months)
+    if start is not None:
+        keep &= months >= np.datetime64(start, "M")
+
+    # コンサル × 月 の行列に一括で加算（コンサル名は昇順、欠損は除外）
+    ci, cons = pd.factorize(df_cost_raw[cons_c], sort=True)
+    mi, month_u = pd.factorize(months[keep].astype("int64"), sort=True)
+    month_u = np.asarray(month_u).astype("datetime64[M]")
+    keep_ci = ci[keep]
+    valid = keep_ci >= 0
+    mat = np.bincount(keep_ci[valid] * len(month_u) + mi[valid], weights=hours[keep][valid],
+                      minlength=len(cons) * len(month_u)).reshape(len(cons), len(month_u))
+
+    # 対象期間に稼働のあるコンサルのみ（pivot_table と同じ行）
+    rows = np.isin(np.arange(len(cons)), keep_ci[valid])
+    return utilization_tables(mat[rows], cons[rows], month_u, cons_c, holidays)
+
+
+def utilization_tables(mat: np.ndarray, cons, month_u: np.ndarray, cons_c: str, holidays=None):
+    """コンサル × 月（datetime64[M]）の稼働時間行列 → build_utilization の戻り値"""
+    util_time_cols = list(pd.DatetimeIndex(month_u).strftime("%y/%m"))
+    columns = pd.Index(util_time_cols, name="年月表示")
+    std = business_days(month_u, holidays) * STD_HOURS_PER_DAY
+    std_hours_row = dict(zip(util_time_cols, std.tolist()))
+
+    index = pd.Index(cons, name=cons_c)
+    util_hours = pd.DataFrame(mat, index=index, columns=columns)
+    util_pct = pd.DataFrame(mat / std, index=index, columns=columns)
+    return util_hours.reset_index(), util_pct.reset_index(), std_hours_row, util_time_cols
+
+
+def grid_window(df: pd.DataFrame, sort_col=None, ascending=True, ranges=None,
+                page=1, page_size=50):
+    """
+    サーバー側ページング : 数値範囲フィルタ → 並び替え → page（1 始まり）の行だけを返す
+    ranges は {列: (下限, 上限)}（None は制限なし）
+    戻り値: (表示する行, フィルタ後の件数)
+    """
+    mask = np.ones(len(df), dtype=bool)
+    for c, (lo, hi) in (ranges or {}).items():
+        v = pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=float)
+        if lo is not None:
+            mask &= v >= lo
+        if hi is not None:
+            mask &= v <= hi
+    idx = np.flatnonzero(mask)
+    if sort_col is not None:
+        key = df[sort_col].iloc[idx].reset_index(drop=True)
+        try:
+            order = key.sort_values(ascending=ascending, kind="stable").index
+        except TypeError:                                   # 型が混在する列は文字列として
+            order = key.astype(str).sort_values(ascending=ascending, kind="stable").index
+        idx = idx[order.to_numpy()]
+    start = (max(page, 1) - 1) * page_size
+    return df.iloc[idx[start:start + page_size]], len(idx)
+
+
+DETAIL_COLS = ["稼働月-月次", "取引ID", "会社名", "アサイン履歴名", "稼働時間", "稼働コスト"]
+
+
+def build_consultant_detail(df_cost_raw: pd.DataFrame):
+    """
+    Utilization 詳細表の索引（稼働コスト 1 件につき 1 回作る）
+    戻り値: (コンサル名で安定ソートした DETAIL_COLS の表, {コンサル名: (開始行, 終了行)})
+            必要列が無ければ None
+    """
+    cc = cost_columns(df_cost_raw.columns)
+    if not (cc["cons"] and cc["date"]):
+        return None
+    col = lambda k: df_cost_raw[cc[k]].to_numpy() if cc[k] else None
+    num = lambda k: pd.to_numeric(df_cost_raw[cc[k]], errors="coerce").fillna(0).to_numpy() \
+                    if cc[k] else np.zeros(len(df_cost_raw))
+    detail = pd.DataFrame({
+        "稼働月-月次": pd.to_datetime(df_cost_raw[cc["date"]], errors="coerce").dt.strftime("%y/%m").to_numpy(),
+        "取引ID": col("id"), "会社名": col("name"), "アサイン履歴名": col("assign"),
+        "稼働時間": num("hours"), "稼働コスト": num("cost"),
+    }, columns=DETAIL_COLS)
+
+    codes, names = pd.factorize(df_cost_raw[cc["cons"]], sort=True)
+    order = np.argsort(codes, kind="stable")
+    detail = detail.iloc[order].reset_index(drop=True)
+    bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+    return detail, {n: (bounds[i], bounds[i + 1]) for i, n in enumerate(names)}
+
+
+# ──────────────────────────────────────────────
+# バッチ実行（Streamlit なし）
+#   ファイルパスから daily を一度だけ作り、期間ごとに月次展開する
+# ──────────────────────────────────────────────
+def path_items(paths) -> list:
+    """ファイルパス（CSV / ZIP）→ read_csv_many / stream_journal 用の items（ZIP は全 CSV）"""
+    items = []
+    for p in map(Path, paths):
+        if p.suffix.lower() == ".zip":
+            members = zip_csv_members(p)
+            if not members:
+                raise ValueError(f"{p.name} に CSV が見つかりません。")
+            items += [(p, p.name, m, ENCODINGS) for m in members]
+        else:
+            items.append((p, p.name, None, ENCODINGS))
+    return items
+
+
+def read_items(items, schema=None) -> pd.DataFrame:
+    """items が 1 件なら read_csv_bytes、複数なら read_csv_many（読込元の列付き）"""
+    return read_csv_bytes(*items[0], schema=schema) if len(items) == 1 \
+           else read_csv_many(items, schema)
+
+
+def load_inputs(journal_paths, cost_path=None, master_path=None, id_map=None,
+                memory_mb=None):
+    """
+    仕訳帳（複数可）/ 稼働コスト / 取引マスタのパス
+    → (daily, 取引日の最小, 最大, 稼働コスト, 結合できなかった取引コード)
+    memory_mb を指定すると仕訳帳をストリーミング読込する（大容量モードと同じ）
+    稼働コストが無ければ 稼働コスト は None
+    """
+    id_map = load_id_map() if id_map is None else id_map
+    items = path_items(journal_paths)
+    if memory_mb:
+        agg, d_min, d_max = stream_journal(items, id_map, memory_mb)
+    else:
+        df_src = prepare_journal(read_items(items, JOURNAL_SCHEMA), id_map)
+        agg, d_min, d_max = aggregate_journal(df_src), df_src["取引日"].min(), df_src["取引日"].max()
+    df_cost_raw = prepare_cost(read_items(path_items([cost_path]), COST_SCHEMA)) \
+                  if cost_path else None
+    master_map = build_master_map(prepare_master(read_items(path_items([master_path]),
+                                                            MASTER_SCHEMA))) \
+                 if master_path else None
+    cost_info = build_cost_info(df_cost_raw) if df_cost_raw is not None else None
+    merged, unmatched = join_deals(agg, cost_info, master_map)
+    return compute_metrics(merged), d_min, d_max, df_cost_raw, unmatched
+
+
+def report_tables(daily: pd.DataFrame, start_date, end_date, id_query="",
+                  selections=None, expand=None) -> dict:
+    """
+    daily → Table view と同じ出力表 {表名: DataFrame}
+    粗利集計（フィルタ後の daily）/ 月次売上一覧 / 月次粗利一覧 / 月次サマリー
+    expand は月次展開の関数（省略時は expand_monthly、SQL バックエンドは Warehouse.expand_monthly）
+    """
+    expand = expand or expand_monthly
+    mask = filter_mask(build_filter_index(daily), id_query, start_date, end_date,
+                       selections or {})
+    df_sales_p, df_profit_p, count_series, time_cols = \
+        expand(daily[mask], start_date, end_date)
+    summary = pd.concat([
+        monthly_summary(df_sales_p, time_cols, ["①月次売上合計","②平均売上単価"]),
+        monthly_summary(df_profit_p, time_cols, ["③月次粗利合計","④平均粗利単価"]),
+        pd.DataFrame([["", "案件数", *count_series.tolist()]],
+                     columns=["レコードID","取引先", *time_cols]),
+    ], ignore_index=True)
+    return {"粗利集計": daily[mask], "月次売上一覧": df_sales_p,
+            "月次粗利一覧": df_profit_p, "月次サマリー": summary}
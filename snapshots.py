@@ -0,0 +1,95 @@
+"""
+パース済み入力の列指向スナップショット（Feather / Arrow IPC）
+パース直後（prepare_* 前）の DataFrame を内容ハッシュで保存し、次回以降は CSV を読まずに
+メモリマップで開く。容量 / 経過日数を超えたものは古い順に削除する
+（prepare 済みで保存していた旧形式は meta の raw が無い。台帳には取り込めない）
+"""
+import os, json, time, hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from pipeline import CACHE_DIR
+
+SNAPSHOT_DIR       = CACHE_DIR / "snapshots"
+SNAPSHOT_MAX_BYTES = 2 * 1024**3          # 合計サイズ上限
+SNAPSHOT_MAX_AGE   = 30 * 24 * 60 * 60    # 最終利用からの秒数
+SNAPSHOT_KINDS     = {"journal": "仕訳帳", "cost": "稼働コスト", "master": "取引マスタ"}
+
+
+def frame_digest(obj) -> str:
+    """DataFrame / Series の内容ハッシュ（index 込み）"""
+    h = pd.util.hash_pandas_object(obj, index=True).to_numpy()
+    return hashlib.sha1(h.tobytes()).hexdigest()
+
+
+def snapshot_key(*parts) -> str:
+    return hashlib.sha1("/".join(map(str, parts)).encode()).hexdigest()
+
+
+def _paths(kind: str, key: str):
+    base = SNAPSHOT_DIR / f"{kind}-{key}"
+    return base.with_suffix(".feather"), base.with_suffix(".json")
+
+
+def save_snapshot(kind: str, key: str, df: pd.DataFrame, label: str = "") -> bool:
+    """非圧縮 Feather + メタ情報 JSON で保存（失敗時は False、処理は続行）"""
+    data_p, meta_p = _paths(kind, key)
+    try:
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        tmp = data_p.with_suffix(".tmp")
+        feather.write_feather(df.reset_index(drop=True), tmp, compression="uncompressed")
+        os.replace(tmp, data_p)
+        meta_p.write_text(json.dumps({
+            "kind": kind, "key": key, "label": label,
+            "rows": len(df), "created": time.time(), "raw": True,
+        }, ensure_ascii=False), encoding="utf-8")
+    except (OSError, pa.ArrowException):
+        return False
+    evict_snapshots()
+    return True
+
+
+def load_snapshot(kind: str, key: str):
+    """メモリマップで読込（無ければ None）。最終利用時刻を更新する"""
+    data_p, _ = _paths(kind, key)
+    try:
+        table = feather.read_table(data_p, memory_map=True)
+        os.utime(data_p)
+    except (OSError, pa.ArrowException):
+        return None
+    return table.to_pandas()
+
+
+def snapshot_meta(kind: str, key: str):
+    """メタ情報（無ければ None）"""
+    _, meta_p = _paths(kind, key)
+    try:
+        return json.loads(meta_p.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def list_snapshots(kind: str | None = None) -> list:
+    """保存済みスナップショット（最近使った順）"""
+    items = []
+    for meta_p in SNAPSHOT_DIR.glob("*.json"):
+        try:
+            meta = json.loads(meta_p.read_text(encoding="utf-8"))
+            st_ = meta_p.with_suffix(".feather").stat()
+        except (OSError, ValueError):
+            continue
+        if kind is None or meta["kind"] == kind:
+            items.append({**meta, "size": st_.st_size, "used": st_.st_mtime})
+    return sorted(items, key=lambda m: m["used"], reverse=True)
+
+
+def evict_snapshots(max_bytes=SNAPSHOT_MAX_BYTES, max_age=SNAPSHOT_MAX_AGE):
+    """経過日数超過 → 合計サイズ超過の順で、最終利用が古いものから削除"""
+    now, total = time.time(), 0
+    for meta in list_snapshots():
+        total += meta["size"]
+        if now - meta["used"] > max_age or total > max_bytes:
+            for p in _paths(meta["kind"], meta["key"]):
+                p.unlink(missing_ok=True)
+            total -= meta["size"]
@@ -0,0 +1,36 @@
+"""
+pytest 共通設定 : リポジトリ直下のモジュールを import 可能にし、
+キャッシュ（台帳 / スナップショット）をテストごとの一時ディレクトリに向ける
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import pipeline as pl
+import bench
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    import ledger, snapshots
+    monkeypatch.setattr(ledger, "LEDGER_DIR", tmp_path / "ledgers")
+    monkeypatch.setattr(snapshots, "SNAPSHOT_DIR", tmp_path / "snapshots")
+    return tmp_path
+
+
+@pytest.fixture(scope="session")
+def journal_csv(tmp_path_factory) -> Path:
+    """合成 freee 仕訳帳（cp932、部門の一部は id_map.csv の RecordID）"""
+    rec, _ = bench.deal_ids(300, pl.load_id_map())
+    path = tmp_path_factory.mktemp("inputs") / "journal.csv"
+    bench.gen_journal(5_000, rec).to_csv(path, index=False, encoding="cp932")
+    return path
+
+
+@pytest.fixture(scope="session")
+def daily(journal_csv):
+    """journal_csv の daily（load_inputs の結果）"""
+    return pl.load_inputs([journal_csv])[0]
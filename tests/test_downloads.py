@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import downloads
+
+FILE_ID = "FILEID0123456789"
+URL = f"https://drive.google.com/file/d/{FILE_ID}/view?usp=sharing"
+
+
+class Drive:
+    """Drive のダウンロード URL の代わりに使うローカル HTTP サーバ（ETag / 304 / Range 対応）"""
+
+    def __init__(self):
+        self.files = {FILE_ID: ('"v1"', b"0123456789" * 20_000)}
+        self.requests = []      # 受けたリクエストのヘッダ
+        self.cut = False        # True なら本文の途中で接続を切る
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                drive.requests.append(dict(self.headers))
+                etag, body = drive.files[self.path.strip("/")]
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                start, rng = 0, self.headers.get("Range")
+                if rng and self.headers.get("If-Range") == etag:
+                    start = int(rng.split("=")[1].rstrip("-"))
+                self.send_response(206 if start else 200)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(body) - start))
+                if start:
+                    self.send_header("Content-Range", f"bytes {start}-{len(body) - 1}/{len(body)}")
+                self.end_headers()
+                payload = body[start:]
+                self.wfile.write(payload[:len(payload) // 2] if drive.cut else payload)
+                self.close_connection = drive.cut
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05},
+                         daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/{{id}}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def drive(tmp_path, monkeypatch):
+    d = Drive()
+    monkeypatch.setattr(downloads, "DRIVE_DOWNLOAD_URL", d.url)
+    monkeypatch.setattr(downloads, "DOWNLOAD_DIR", tmp_path / "downloads")
+    yield d
+    d.stop()
+
+
+def test_ttl_reuses_without_request(drive):
+    first = downloads.fetch(URL)
+    again = downloads.fetch(URL)
+    assert first["downloaded"] and not again["downloaded"]
+    assert len(drive.requests) == 1
+    assert again["path"].read_bytes() == drive.files[FILE_ID][1]
+
+
+def test_not_modified_keeps_copy(drive):
+    first = downloads.fetch(URL)
+    again = downloads.fetch(URL, ttl=0)
+    assert drive.requests[-1]["If-None-Match"] == '"v1"'
+    assert not again["downloaded"] and again["sha1"] == first["sha1"]
+    assert again["checked"] >= first["checked"]
+
+
+def test_changed_etag_downloads_again(drive):
+    first = downloads.fetch(URL)
+    drive.files[FILE_ID] = ('"v2"', b"changed" * 1_000)
+    again = downloads.fetch(URL, ttl=0)
+    assert again["downloaded"] and again["etag"] == '"v2"'
+    assert again["sha1"] != first["sha1"]
+    assert again["path"].read_bytes() == b"changed" * 1_000
+
+
+def test_interrupted_transfer_resumes(drive):
+    body = drive.files[FILE_ID][1]
+    drive.cut = True
+    with pytest.raises(requests.RequestException):
+        downloads.fetch(URL)
+    part = downloads._paths(FILE_ID)[1]
+    done = part.stat().st_size
+    assert 0 < done < len(body)
+
+    drive.cut = False
+    res = downloads.fetch(URL)
+    assert drive.requests[-1]["Range"] == f"bytes={done}-"
+    assert drive.requests[-1]["If-Range"] == '"v1"'
+    assert res["downloaded"] and res["path"].read_bytes() == body
+    assert not part.exists()
+
+
+def test_stale_copy_when_server_is_down(drive):
+    first = downloads.fetch(URL)
+    drive.stop()
+    res = downloads.fetch(URL, ttl=0, timeout=2)
+    assert res["stale"] and not res["downloaded"]
+    assert res["path"].read_bytes() == drive.files[FILE_ID][1]
+    assert res["sha1"] == first["sha1"]
+
+
+def test_fetch_without_cache_raises_when_server_is_down(drive):
+    drive.stop()
+    with pytest.raises(requests.RequestException):
+        downloads.fetch(URL, timeout=2)
+
+
+def test_evict_by_size_and_age(drive):
+    drive.files["OTHERFILE0123456"] = ('"o1"', b"x" * 50_000)
+    old = downloads.fetch(URL)
+    new = downloads.fetch("https://drive.google.com/uc?id=OTHERFILE0123456")
+    past = time.time() - 3600
+    os.utime(old["path"], (past, past))
+
+    downloads.evict_downloads(max_bytes=new["size"])
+    assert not any(p.exists() for p in downloads._paths(old["key"]))
+    assert new["path"].exists()
+
+    stale_part = downloads.DOWNLOAD_DIR / "abandoned.part"
+    fresh_part = downloads.DOWNLOAD_DIR / "running.part"
+    for p in (stale_part, fresh_part):
+        p.write_bytes(b"partial")
+    os.utime(stale_part, (past, past))
+    downloads.evict_downloads(max_age=600)
+    assert not stale_part.exists() and fresh_part.exists()
+    assert new["path"].exists()
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+
+import pipeline as pl
+import ledger, snapshots
+
+
+def _totals(name):
+    daily, _, _ = ledger.ledger_daily(name, pl.load_id_map())
+    return daily[[c for c in ["売上高", *pl.EXPENSE_TARGETS] if c in daily.columns]].sum()
+
+
+def _read(path):
+    return pl.read_csv_bytes(path.read_bytes(), path.name, schema=pl.JOURNAL_SCHEMA)
+
+
+def test_fold_upload_then_snapshot_adds_nothing(cache_dir, journal_csv):
+    first = ledger.fold_journal("t", _read(journal_csv), "upload")
+    before = _totals("t")
+    assert first["added"] > 0
+
+    snapshots.save_snapshot("journal", "snap", _read(journal_csv), journal_csv.name)
+    again = ledger.fold_snapshot("t", "snap")
+    assert again["added"] == 0
+    assert again["skipped"] == first["added"]
+    pd.testing.assert_series_equal(_totals("t"), before)
+
+
+def test_fold_snapshot_then_upload_adds_nothing(cache_dir, journal_csv):
+    snapshots.save_snapshot("journal", "snap", _read(journal_csv), journal_csv.name)
+    first = ledger.fold_snapshot("t", "snap")
+    before = _totals("t")
+    assert ledger.fold_journal("t", _read(journal_csv), "upload")["added"] == 0
+    assert first["added"] > 0
+    pd.testing.assert_series_equal(_totals("t"), before)
+
+
+def test_fold_rejects_remapped_snapshot(cache_dir, journal_csv):
+    snapshots.save_snapshot("journal", "old", pl.prepare_journal(_read(journal_csv)), "old")
+    meta_p = snapshots._paths("journal", "old")[1]
+    meta_p.write_text(meta_p.read_text(encoding="utf-8").replace(', "raw": true', ""),
+                      encoding="utf-8")
+    with pytest.raises(ValueError):
+        ledger.fold_snapshot("t", "old")
+    assert ledger.ledger_meta("t") is None
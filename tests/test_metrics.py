@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import pipeline as pl
+
+N_DEALS = 30_000
+
+
+def _rowwise(daily):
+    """列演算化する前の compute_metrics（DataFrame.apply の行ごと計算）"""
+    for c in ["売上高","外注費","交際費","旅費交通費","人件費"]:
+        if c not in daily.columns:
+            daily[c] = 0
+        daily[c] = pd.to_numeric(daily[c], errors="coerce").fillna(0)
+    daily["月数"] = daily.apply(
+        lambda r: max((r["日付（最大）"].year - r["日付（最小）"].year)*12 +
+                      (r["日付（最大）"].month - r["日付（最小）"].month) + 1, 1),
+        axis=1)
+    daily["月次売上"] = daily.apply(
+        lambda r: r["売上高"]/r["月数"] if r["月数"] else 0, axis=1)
+    daily["粗利"] = (daily["売上高"] - daily["外注費"] - daily["交際費"]
+                     - daily["旅費交通費"] - daily["人件費"])
+    daily["粗利率"] = daily.apply(
+        lambda r: (r["粗利"]/r["売上高"]*100) if r["売上高"]>0 else 0, axis=1)
+    return daily.rename(columns={"取引コード":"レコードID"})
+
+
+@pytest.fixture(scope="module")
+def deals():
+    """合成 daily : 売上 / 原価の NaN・0・負値、赤字案件、同月・複数年の期間、NaT を含む"""
+    rng = np.random.default_rng(0)
+    d0 = pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 1500, N_DEALS), "D")
+    d1 = d0 + pd.to_timedelta(rng.choice([0, 0, 20, 45, 400, 900], N_DEALS), "D")
+    sales = rng.choice([np.nan, 0, -50_000, 1e6, 3_333_333], N_DEALS) * rng.random(N_DEALS).round(2)
+    df = pd.DataFrame({
+        "取引コード": [f"D{i:05d}" for i in range(N_DEALS)],
+        "日付（最小）": d0, "日付（最大）": d1,
+        "売上高": sales,
+        "外注費": rng.choice([np.nan, 0, 2e6], N_DEALS) * rng.random(N_DEALS).round(2),
+        "交際費": rng.integers(0, 10_000, N_DEALS),
+        "人件費": pd.Series(rng.integers(0, 1_000_000, N_DEALS)).astype(object),
+    })
+    df.loc[::7, "人件費"] = "-"          # 数値化できない値は 0 扱い
+    df.loc[::997, ["日付（最小）", "日付（最大）"]] = pd.NaT
+    return df                              # 旅費交通費 列は無い（0 で補う）
+
+
+def test_compute_metrics_matches_rowwise(deals):
+    expected = _rowwise(deals.copy())
+    actual = pl.compute_metrics(deals.copy())
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+def test_compute_metrics_guards(deals):
+    m = pl.compute_metrics(deals.copy())
+    dated = m["日付（最小）"].notna()
+    no_sales = m["売上高"] <= 0
+    assert (m.loc[dated, "月数"] >= 1).all()
+    assert (no_sales & dated).any() and (m.loc[no_sales, "粗利率"] == 0).all()
+    assert (m["売上高"].isna() | m["粗利"].isna()).sum() == 0
+    loss = (m["売上高"] > 0) & (m["粗利"] < 0)
+    assert loss.any() and (m.loc[loss, "粗利率"] < 0).all()
+    assert np.isfinite(m.loc[dated, ["月次売上", "粗利率"]].to_numpy()).all()
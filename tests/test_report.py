@@ -0,0 +1,33 @@
+import pandas as pd
+
+import pipeline as pl
+import batch
+
+
+def test_report_tables_no_match(daily):
+    start, end = daily["日付（最小）"].min(), daily["日付（最大）"].max()
+    tables = pl.report_tables(daily, start, end, id_query="該当なしの取引ID")
+    assert tables["粗利集計"].empty and tables["月次売上一覧"].empty
+    summary = tables["月次サマリー"]
+    assert list(summary.columns) == ["レコードID", "取引先"]
+    assert summary["取引先"].tolist() == ["①月次売上合計", "②平均売上単価",
+                                         "③月次粗利合計", "④平均粗利単価", "案件数"]
+
+
+def test_report_tables_period_without_data(daily):
+    tables = pl.report_tables(daily, pd.Timestamp("1990-01-01"), pd.Timestamp("1990-12-31"))
+    assert tables["月次サマリー"].shape == (5, 2)
+
+
+def test_monthly_summary_matches_columns(daily):
+    start, end = daily["日付（最小）"].min(), daily["日付（最大）"].max()
+    sales, _, _, time_cols = pl.expand_monthly(daily, start, end)
+    s = pl.monthly_summary(sales, time_cols, ["合計", "平均"])
+    assert time_cols and list(s.columns) == ["レコードID", "取引先", *time_cols]
+    assert s.loc[0, time_cols].tolist() == sales[time_cols].sum().tolist()
+
+
+def test_batch_empty_period(journal_csv, tmp_path):
+    assert batch.main(["--journal", str(journal_csv), "--period", "1990-01:1990-12",
+                       "--out", str(tmp_path)]) == 0
+    assert (tmp_path / "19900101_19901231").is_dir()
@@ -0,0 +1,57 @@
+import io
+import zipfile
+
+import pandas as pd
+import pytest
+
+import pipeline as pl
+
+
+def _streamed(data, name, schema=None, memory_mb=0.05):
+    return pd.concat(pl.read_csv_chunks(data, name, schema=schema, memory_mb=memory_mb),
+                     ignore_index=True)
+
+
+@pytest.fixture(scope="module")
+def late_cp932() -> bytes:
+    """先頭 SNIFF_BYTES を超えるまで ASCII のみ、その後に cp932 の取引先名が出る稼働コスト CSV"""
+    rows = ["RecordID,cost,client,name,hours,date"]
+    rows += [f"R{i:05d},{1000 + i},ACME,Sato,{i % 9}.5,2024-0{i % 9 + 1}-01" for i in range(3_000)]
+    rows += [f"R{i:05d},{1000 + i},株式会社テスト{i},佐藤,1.5,2024-10-01" for i in range(3_000, 3_500)]
+    data = "\n".join(rows).encode("cp932")
+    assert data[:pl.SNIFF_BYTES].isascii()
+    return data
+
+
+def test_stream_falls_back_after_ascii_head(late_cp932):
+    expected = pl.read_csv_bytes(late_cp932, "cost.csv", schema=pl.COST_SCHEMA)
+    actual = _streamed(late_cp932, "cost.csv", pl.COST_SCHEMA)
+    assert actual["client"].iloc[-1] == "株式会社テスト3499"
+    pd.testing.assert_frame_equal(actual, expected)
+
+
+def test_stream_falls_back_in_zip(late_cp932):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        zf.writestr("cost.csv", late_cp932)
+    expected = pl.read_csv_bytes(late_cp932, "cost.csv")
+    pd.testing.assert_frame_equal(_streamed(buf.getvalue(), "cost.zip"), expected)
+
+
+def test_stream_matches_in_memory_journal(journal_csv):
+    data = journal_csv.read_bytes()
+    expected = pl.read_csv_bytes(data, journal_csv.name, schema=pl.JOURNAL_SCHEMA)
+    chunks = list(pl.read_csv_chunks(data, journal_csv.name, schema=pl.JOURNAL_SCHEMA,
+                                     memory_mb=0.05))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.dtypes.astype(str).tolist() == expected.dtypes.astype(str).tolist()
+    # カテゴリはチャンクごとに異なるため、結合後は値で比べる
+    cats = {c: object for c in expected.select_dtypes("category").columns}
+    pd.testing.assert_frame_equal(pd.concat(chunks, ignore_index=True).astype(cats),
+                                  expected.astype(cats))
+
+
+def test_stream_rejects_undecodable():
+    with pytest.raises(ValueError):
+        _streamed(b"a,b\n" * 20_000 + b"\x81\x7f,1\n", "bad.csv")
@@ -0,0 +1,14 @@
+import numpy as np
+
+import pipeline as pl
+
+
+def test_holidays_cover_2027():
+    months = np.array(["2027-01", "2027-05", "2027-12"], dtype="datetime64[M]")
+    assert pl.business_days(months).tolist() == [19, 18, 23]
+
+
+def test_holiday_gaps():
+    cols = ["22/12", "23/01", "26/12", "27/12", "28/01"]
+    assert pl.holiday_gaps(cols) == ["22/12", "28/01"]
+    assert pl.holiday_gaps(cols, np.array([], dtype="datetime64[D]")) == cols
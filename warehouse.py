@@ -0,0 +1,368 @@
+"""
+SQL バックエンド（DuckDB / SQLite、Streamlit 非依存）
+仕訳行 / 稼働コスト / 取引マスタをローカルの DB ファイルへチャンクごとに読み込み、
+daily の組み立て・月次展開・稼働時間の集計を SQL で実行して pandas 版と同じ形の DataFrame を返す
+DuckDB があれば DuckDB（並列実行、メモリに載らない集計も可）、無ければ標準ライブラリの SQLite を使う
+SQL は両方で動く書き方（CTE / CASE / 集計 / 結合）に留め、日付は整数（マイクロ秒 / 月序数）で持つ
+"""
+import sqlite3
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+import pipeline as pl
+
+try:
+    import duckdb
+except ImportError:                 # 任意依存（無ければ SQLite）
+    duckdb = None
+
+WAREHOUSE_DIR = pl.CACHE_DIR / "warehouse"
+ENGINES = ("duckdb", "sqlite")
+EXPENSE_ORDER = 1 << 40             # 費用行の 順 に足す（取引先は売上行を優先して先頭の値を取る）
+METRIC_COLS = ["売上高", "外注費", "交際費", "旅費交通費", "人件費"]
+
+# 表定義（列 → 型）: 日時 = UNIX 時刻（マイクロ秒）、月 = 1970-01 からの月数
+JOURNAL_TABLE = {"順": "BIGINT", "取引コード": "TEXT", "キー": "TEXT", "取引先": "TEXT",
+                 "勘定科目": "TEXT", "金額": "DOUBLE", "日時": "BIGINT", "月": "INTEGER"}
+COST_TABLE    = {"順": "BIGINT", "キー": "TEXT", "人件費": "DOUBLE", "稼働取引先": "TEXT",
+                 "コンサル": "TEXT", "稼働時間": "DOUBLE", "月": "INTEGER"}
+EXPAND_TABLE  = {"レコードID": "TEXT", "取引先": "TEXT", "開始月": "INTEGER", "日": "INTEGER",
+                 "月数": "INTEGER", "月次売上": "DOUBLE", "月次粗利": "DOUBLE"}
+CALENDAR_TABLE = {"月": "INTEGER", "初日": "INTEGER", "日数": "INTEGER"}
+
+# 案件 × 月 の展開（暦の月が 開始月 〜 開始月 + 月数 - 1、各月の日付が期間内のもの）
+EXPAND_SQL = '''
+FROM "月次元" s JOIN "暦" c ON c."月" BETWEEN s."開始月" AND s."開始月" + s."月数" - 1
+WHERE c."初日" + CASE WHEN s."日" < c."日数" THEN s."日" ELSE c."日数" - 1 END BETWEEN ? AND ?'''
+
+
+def _q(name) -> str:
+    """識別子の引用"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _lit(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _masked(values: np.ndarray, missing: np.ndarray):
+    return pd.arrays.IntegerArray(values.astype(np.int64), missing)
+
+
+def _micros(dates) -> pd.api.extensions.ExtensionArray:
+    """日時 → UNIX 時刻（マイクロ秒、欠損は NA）"""
+    d = pd.to_datetime(dates, errors="coerce").to_numpy().astype("datetime64[us]")
+    return _masked(d.view(np.int64), np.isnat(d))
+
+
+def _month_codes(dates) -> pd.api.extensions.ExtensionArray:
+    """日時 → 1970-01 からの月数（欠損は NA）"""
+    m = pd.to_datetime(dates, errors="coerce").to_numpy().astype("datetime64[M]")
+    return _masked(m.view(np.int64), np.isnat(m))
+
+
+class Warehouse:
+    """
+    ローカル DB 1 つ分の接続（読み込みのたびに表を作り直す）
+    engine は "duckdb" / "sqlite"（省略時は DuckDB があれば DuckDB）、path は DB ファイル
+    """
+
+    def __init__(self, engine=None, path=None):
+        engine = engine or ("duckdb" if duckdb is not None else "sqlite")
+        if engine not in ENGINES:
+            raise ValueError(f"未対応のエンジンです: {engine}")
+        if engine == "duckdb" and duckdb is None:
+            raise ValueError("duckdb がインストールされていません（pip install duckdb）。")
+        self.engine = engine
+        self.path = Path(path or WAREHOUSE_DIR / f"ledger.{engine}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if engine == "duckdb":
+            self.con = duckdb.connect(str(self.path))
+        else:
+            self.con = sqlite3.connect(str(self.path))
+            self.con.execute("PRAGMA journal_mode=OFF")      # 作り直せる DB なので書込の保護はしない
+            self.con.execute("PRAGMA synchronous=OFF")
+        self.accounts, self.cost_cols, self.master_cols = [], None, None
+
+    def close(self):
+        self.con.close()
+
+    # ── 入出力 ----------------------------------------------------------------
+    def query(self, sql: str, params=()) -> pd.DataFrame:
+        """SQL の結果を DataFrame で返す（読み込んだ 仕訳 / 稼働 / 取引マスタ への任意の集計にも使う）"""
+        if self.engine == "duckdb":
+            return self.con.execute(sql, list(params)).df()
+        return pd.read_sql_query(sql, self.con, params=list(params))
+
+    def _create(self, table: str, columns: dict):
+        self.con.execute(f"DROP TABLE IF EXISTS {_q(table)}")
+        self.con.execute(f"CREATE TABLE {_q(table)} ("
+                         + ", ".join(f"{_q(c)} {t}" for c, t in columns.items()) + ")")
+
+    def _insert(self, table: str, df: pd.DataFrame):
+        """df（列は表定義の順）を追加"""
+        if not len(df):
+            return
+        if self.engine == "duckdb":
+            self.con.register("_frame", df)
+            self.con.execute(f"INSERT INTO {_q(table)} SELECT * FROM _frame")
+            self.con.unregister("_frame")
+        else:
+            rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+            self.con.executemany(f"INSERT INTO {_q(table)} VALUES ({', '.join('?' * df.shape[1])})",
+                                 rows)
+
+    def _index(self, table: str, column: str):
+        """SQLite の結合用索引（DuckDB はハッシュ結合なので作らない）"""
+        if self.engine == "sqlite":
+            self.con.execute(f"CREATE INDEX {_q(f'{table}_{column}')} ON {_q(table)} ({_q(column)})")
+
+    def _commit(self):
+        if self.engine == "sqlite":
+            self.con.commit()
+
+    # ── 読込 ------------------------------------------------------------------
+    def load_journal(self, items, id_map=None, memory_mb=pl.STREAM_MEMORY_MB, progress=None):
+        """
+        仕訳帳 → 仕訳 表（対象勘定科目の仕訳行のみ、チャンクごと。引数は pl.stream_journal と同じ）
+        戻り値: 取引日の最小, 最大
+        """
+        self._create("仕訳", JOURNAL_TABLE)
+        d_min, d_max, seq = pd.NaT, pd.NaT, 0
+        for chunk, lo, hi in pl.journal_chunks(items, id_map, memory_mb, progress):
+            d_min = min(d_min, lo) if pd.notna(d_min) else lo
+            d_max = max(d_max, hi) if pd.notna(d_max) else hi
+            lines = pl.journal_lines(chunk)
+            sales = lines["勘定科目"].to_numpy(dtype=object) == "売上高"
+            self._insert("仕訳", pd.DataFrame({
+                "順":       np.arange(seq, seq + len(lines)) + np.where(sales, 0, EXPENSE_ORDER),
+                "取引コード": lines["取引コード"].to_numpy(dtype=object),
+                "キー":     pl.normalize_ids(lines["取引コード"]).to_numpy(),
+                "取引先":   lines["取引先"].to_numpy(dtype=object),
+                "勘定科目": lines["勘定科目"].to_numpy(dtype=object),
+                "金額":     lines["金額"].to_numpy(dtype=float),
+                "日時":     _micros(lines["日付"]),
+                "月":       _month_codes(lines["日付"]),
+            }))
+            seq += len(lines)
+        self._index("仕訳", "順")
+        self._commit()
+        self.accounts = sorted(self.query('SELECT DISTINCT "勘定科目" FROM "仕訳"')["勘定科目"])
+        return d_min, d_max
+
+    def load_cost(self, items, memory_mb=pl.STREAM_MEMORY_MB):
+        """稼働コスト → 稼働 表（チャンクごと）。ID / コスト列が無くても稼働時間の集計には使う"""
+        self._create("稼働", COST_TABLE)
+        self.cost_cols, seq = None, 0
+        for item in items:
+            for chunk in pl.read_csv_chunks(*item, schema=pl.COST_SCHEMA, memory_mb=memory_mb):
+                chunk = pl.prepare_cost(chunk)
+                cc = self.cost_cols = self.cost_cols or pl.cost_columns(chunk.columns)
+                col = lambda k: chunk[cc[k]].to_numpy(dtype=object) if cc[k] else None
+                self._insert("稼働", pd.DataFrame({
+                    "順":        np.arange(seq, seq + len(chunk)),
+                    "キー":      col("id"),
+                    "人件費":    pd.to_numeric(chunk[cc["cost"]], errors="coerce").fillna(0)
+                                   .to_numpy(dtype=float) if cc["cost"] else 0.0,
+                    "稼働取引先": col("name"),
+                    "コンサル":   col("cons"),
+                    "稼働時間":   pl.parse_hours(chunk[cc["hours"]]) if cc["hours"] else 0.0,
+                    "月":        _month_codes(chunk[cc["date"]]) if cc["date"] else None,
+                }, columns=list(COST_TABLE)))
+                seq += len(chunk)
+        self._index("稼働", "順")
+        self._commit()
+
+    def load_master(self, master_map):
+        """pl.build_master_map の表 → 取引マスタ 表（None なら結合しない）"""
+        self.con.execute('DROP TABLE IF EXISTS "取引マスタ"')
+        self.master_cols = None
+        if master_map is None:
+            return
+        df = master_map.reset_index(drop=True)
+        df.insert(0, "順", np.arange(len(df)))
+        self._create("取引マスタ", {c: "BIGINT" if c == "順" else
+                                   "DOUBLE" if pd.api.types.is_numeric_dtype(df[c]) else "TEXT"
+                                   for c in df.columns})
+        self._insert("取引マスタ", df)
+        self._commit()
+        self.master_cols = [c for c in df.columns if c not in ("順", "取引コード")]
+
+    def load_inputs(self, journal_paths, cost_path=None, master_path=None, id_map=None,
+                    memory_mb=None):
+        """
+        pl.load_inputs の SQL 版（仕訳帳 / 稼働コストは常にチャンクごとに読み込む）
+        戻り値も同じ形。ただし 稼働コスト は DataFrame の代わりに表名（build_utilization に渡す）
+        """
+        memory_mb = memory_mb or pl.STREAM_MEMORY_MB
+        id_map = pl.load_id_map() if id_map is None else id_map
+        d_min, d_max = self.load_journal(pl.path_items(journal_paths), id_map, memory_mb)
+        if cost_path:
+            self.load_cost(pl.path_items([cost_path]), memory_mb)
+        else:
+            self.con.execute('DROP TABLE IF EXISTS "稼働"')
+            self.cost_cols = None
+        self.load_master(pl.build_master_map(pl.prepare_master(
+            pl.read_items(pl.path_items([master_path]), pl.MASTER_SCHEMA))) if master_path else None)
+        daily, unmatched = self.daily_tables()
+        return daily, d_min, d_max, "稼働" if cost_path else None, unmatched
+
+    # ── daily ----------------------------------------------------------------
+    def _has_cost(self) -> bool:
+        return bool(self.cost_cols and self.cost_cols["id"] and self.cost_cols["cost"])
+
+    def daily_sql(self) -> str:
+        """
+        pl.build_daily と同じ列・並びの daily を返す SQL
+        j : 取引コード単位の集計（勘定科目別金額 / 日付の最小・最大 / 取引先は売上行優先の先頭）
+        c : 取引 ID 単位の人件費（稼働取引先は先頭）、m : 取引マスタ
+        """
+        has_cost, has_master = self._has_cost(), self.master_cols is not None
+        cost_name = has_cost and self.cost_cols["name"]
+        sales = 'j."売上高"' if "売上高" in self.accounts else "0"
+
+        cols = [('j."キー"' if has_cost else 'j."取引コード"', "取引コード")]
+        for a in self.accounts:
+            cols.append((f'CASE WHEN j."売上高" = 0 THEN m."マスター金額" ELSE j."売上高" END'
+                         if a == "売上高" and has_master else f"j.{_q(a)}", a))
+        cols += [('j."日付（最小）"', "日付（最小）"), ('j."日付（最大）"', "日付（最大）"),
+                 (f'CASE WHEN {sales} = 0 AND n."稼働取引先" IS NOT NULL '
+                  f'THEN n."稼働取引先" ELSE p."取引先" END' if has_master and cost_name
+                  else 'p."取引先"', "取引先")]
+        if "売上高" not in self.accounts:
+            cols.append(('m."マスター金額"' if has_master else "0", "売上高"))
+        cols.append(('c."人件費"' if has_cost else "0", "人件費"))
+        if cost_name:
+            cols.append(('n."稼働取引先"', "稼働取引先"))
+        cols += [(f"m.{_q(c)}", c) for c in self.master_cols or []]
+        cols += [("0", c) for c in METRIC_COLS if c not in [n for _, n in cols]]
+        cols = [(f"COALESCE({e}, 0)" if n in METRIC_COLS else e, n) for e, n in cols]
+        months = 'j."月（最大）" - j."月（最小）" + 1'
+        cols.append((f"CASE WHEN {months} < 1 THEN 1 ELSE {months} END", "月数"))
+
+        profit = 'd."売上高" - d."外注費" - d."交際費" - d."旅費交通費" - d."人件費"'
+        outer = [f"d.{_q(n)}" for _, n in cols] + [
+            'CASE WHEN d."月数" = 0 THEN 0 ELSE d."売上高" / d."月数" END AS "月次売上"',
+            f'{profit} AS "粗利"',
+            f'CASE WHEN d."売上高" > 0 THEN ({profit}) / d."売上高" * 100 ELSE 0 END AS "粗利率"']
+        sums = "".join(f',\n           SUM(CASE WHEN "勘定科目" = {_lit(a)} THEN "金額" ELSE 0 END) AS {_q(a)}'
+                       for a in self.accounts)
+        joins = 'LEFT JOIN "仕訳" p ON p."順" = j."先頭"'
+        ctes = f'''j AS (
+    SELECT "取引コード", MIN("キー") AS "キー"{sums},
+           MIN("日時") AS "日付（最小）", MAX("日時") AS "日付（最大）",
+           MIN("月") AS "月（最小）", MAX("月") AS "月（最大）",
+           MIN(CASE WHEN "取引先" IS NOT NULL THEN "順" END) AS "先頭"
+    FROM "仕訳" GROUP BY "取引コード")'''
+        if has_cost:
+            ctes += f''',
+c AS (
+    SELECT "キー", SUM("人件費") AS "人件費",
+           MIN(CASE WHEN "稼働取引先" IS NOT NULL THEN "順" END) AS "先頭"
+    FROM "稼働" WHERE "キー" IS NOT NULL GROUP BY "キー")'''
+            joins += '\n    LEFT JOIN c ON c."キー" = j."キー"'
+            joins += '\n    LEFT JOIN "稼働" n ON n."順" = c."先頭"'
+        if has_master:
+            joins += '\n    LEFT JOIN "取引マスタ" m ON m."取引コード" = j."キー"'
+        inner = ",\n           ".join(f"{e} AS {_q(n)}" for e, n in cols)
+        return f'''WITH {ctes}
+SELECT {", ".join(outer)}
+FROM (
+    SELECT {inner},
+           j."取引コード" AS "_並び"
+    FROM j {joins}
+) d
+ORDER BY d."_並び"'''
+
+    def daily_tables(self):
+        """
+        (daily, 結合できなかった取引コード)。pl.build_daily / pl.join_deals と同じ列・値
+        （勘定科目別金額の合計順だけが違うため、端数のある金額では末尾の桁が変わることがある）
+        """
+        daily = self.query(self.daily_sql())
+        for c in ["日付（最小）", "日付（最大）"]:
+            daily[c] = pd.to_datetime(daily[c], unit="us")
+        if daily["月数"].dtype == np.int64:                  # pandas 版は dt.year 由来の int32
+            daily["月数"] = daily["月数"].astype(np.int32)
+        daily = daily.rename(columns={"取引コード": "レコードID"})
+
+        side_keys = {}
+        if self._has_cost():
+            side_keys["cost"] = self.query(
+                'SELECT DISTINCT "キー" FROM "稼働" WHERE "キー" IS NOT NULL ORDER BY "キー"')["キー"]
+        if self.master_cols is not None:
+            side_keys["master"] = self.query(
+                'SELECT "取引コード" FROM "取引マスタ" ORDER BY "順"')["取引コード"]
+        return daily, pl.unmatched_keys(pl.normalize_ids(daily["レコードID"]), side_keys)
+
+    # ── 月次展開 / Utilization ------------------------------------------------
+    def expand_monthly(self, df: pd.DataFrame, start_date, end_date):
+        """pl.expand_monthly の SQL 版（案件 × 月 の展開と月ごとの集計を DB で行う）。戻り値も同じ"""
+        n, sales, profit = pl.monthly_values(df)
+        d_min = df["日付（最小）"].to_numpy(dtype="datetime64[D]")
+        m0 = d_min.astype("datetime64[M]")
+        src = pd.DataFrame({
+            "レコードID": df["レコードID"].to_numpy(dtype=object),
+            "取引先":     df["取引先"].to_numpy(dtype=object),
+            "開始月":     m0.view(np.int64),
+            "日":         (d_min - m0.astype("datetime64[D]")).view(np.int64),
+            "月数": n, "月次売上": sales, "月次粗利": profit,
+        })[n > 0]
+        if src.empty:
+            return pl.expand_monthly(df, start_date, end_date)
+
+        months = np.arange(src["開始月"].min(), (src["開始月"] + src["月数"]).max()).astype("datetime64[M]")
+        first = months.astype("datetime64[D]")
+        self._create("月次元", EXPAND_TABLE)
+        self._insert("月次元", src)
+        self._create("暦", CALENDAR_TABLE)
+        self._insert("暦", pd.DataFrame({
+            "月": months.view(np.int64), "初日": first.view(np.int64),
+            "日数": ((months + 1).astype("datetime64[D]") - first).view(np.int64)}))
+        self._index("暦", "月")
+
+        span = [int(np.datetime64(d, "D").view(np.int64)) for d in (start_date, end_date)]
+        long = self.query(f'''SELECT s."レコードID", s."取引先", c."月",
+       AVG(s."月次売上") AS "月次売上", AVG(s."月次粗利") AS "月次粗利"{EXPAND_SQL}
+GROUP BY s."レコードID", s."取引先", c."月"''', span)
+        counts = self.query(f'''SELECT c."月",
+       COUNT(DISTINCT CASE WHEN s."月次売上" > 0 THEN s."レコードID" END) AS "件数"{EXPAND_SQL}
+GROUP BY c."月" ORDER BY c."月"''', span)
+
+        labels = pd.DatetimeIndex(counts["月"].to_numpy(dtype=np.int64).astype("datetime64[M]")) \
+                   .strftime("%y/%m")
+        time_cols = labels.tolist()
+        long["年月表示"] = long.pop("月").map(dict(zip(counts["月"], time_cols)))
+        df_sales_p, df_profit_p = pl.pivot_monthly(long, time_cols)
+        count_series = pd.Series(counts["件数"].to_numpy(dtype=np.int64), name="レコードID",
+                                 index=pd.Index(time_cols, name="年月表示"))
+        return df_sales_p, df_profit_p, count_series, time_cols
+
+    def report_tables(self, daily: pd.DataFrame, start_date, end_date, id_query="",
+                      selections=None) -> dict:
+        """pl.report_tables の月次展開を SQL で行う版"""
+        return pl.report_tables(daily, start_date, end_date, id_query, selections,
+                                expand=self.expand_monthly)
+
+    def build_utilization(self, table="稼働", start=pl.UTIL_START, holidays=None):
+        """pl.build_utilization の SQL 版（コンサル × 月 の稼働時間の合計を DB で集計）。戻り値も同じ"""
+        cc = self.cost_cols
+        if table is None or not (cc and cc["cons"] and cc["hours"] and cc["date"]):
+            return None
+        where, params = '"月" IS NOT NULL', []
+        if start is not None:
+            where += ' AND "月" >= ?'
+            params.append(int(np.datetime64(start, "M").view(np.int64)))
+        df = self.query(f'''SELECT "コンサル", "月", SUM("稼働時間") AS "稼働時間"
+FROM {_q(table)} WHERE {where} GROUP BY "コンサル", "月"''', params)
+
+        # 月は稼働のある全行から、コンサルは名前のある行から（pl.build_utilization と同じ）
+        month_u = np.unique(df["月"].to_numpy(dtype=np.int64))
+        named = df[df["コンサル"].notna()]
+        cons, ci = np.unique(named["コンサル"].to_numpy(dtype=object), return_inverse=True)
+        mat = np.zeros((len(cons), len(month_u)))
+        mat[ci, np.searchsorted(month_u, named["月"].to_numpy(dtype=np.int64))] = \
+            named["稼働時間"].to_numpy(dtype=float)
+        return pl.utilization_tables(mat, pd.Index(cons, dtype=object),
+                                     month_u.astype("datetime64[M]"), cc["cons"], holidays)